@@ -0,0 +1,386 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from bm25 import BM25
+from bm25_shards import ShardedBM25, load_bm25
+from rag_embedding import build_document_texts
+from refactoring_entity import RefactoringStore
+from refactoring_reader import iter_refactorings
+from retrieval import HybridRetriever, format_historical_refactorings
+from vector_store import LocalVectorStore
+
+# Stages of retrieval.HybridRetriever (rerank includes reading the candidate texts), the prompt examples
+# and the LLM call that follows them, in pipeline order
+STAGES = ("vector", "bm25", "rrf", "rerank", "prompt", "llm")
+
+_TOKEN = re.compile(r'\w+')
+
+_WORDS = ("item", "hero", "level", "count", "value", "buffer", "index", "node", "result", "state", "target",
+          "damage", "window", "cell", "actor", "assert", "message", "stream", "reader", "element")
+_TYPES = ("int", "long", "String", "boolean", "float", "List<String>", "Item", "Hero", "Object")
+
+
+class HashingEmbeddingFunction:
+    def __init__(self, dimensions: int = 384):
+        """
+        Deterministic stand-in for the sentence embedding model: a normalized bag of hashed tokens.
+        Similar texts get similar vectors, and no model has to be downloaded.
+        """
+        self.dimensions = dimensions
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        vectors = np.zeros((len(input), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(input):
+            columns = [zlib.crc32(token.encode('utf-8')) % self.dimensions for token in _TOKEN.findall(text.lower())]
+            np.add.at(vectors[row], columns, 1.0)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return list(vectors / np.maximum(norms, 1e-12))
+
+
+class StubReranker:
+    def rerank(self, query: str, documents: List[str], doc_ids: List[str]) -> List[dict]:
+        """
+        Deterministic stand-in for the ColBERT reranker: scores documents by the token overlap
+        (Jaccard) with the query; ties keep the fused order.
+        """
+        query_tokens = set(_TOKEN.findall(query.lower()))
+        scored = []
+        for position, (document, doc_id) in enumerate(zip(documents, doc_ids)):
+            tokens = set(_TOKEN.findall(document.lower()))
+            score = len(query_tokens & tokens) / max(len(query_tokens | tokens), 1)
+            scored.append((-score, position, doc_id))
+        return [{"rank": rank + 1, "score": -score, "doc_id": doc_id}
+                for rank, (score, _, doc_id) in enumerate(sorted(scored))]
+
+    def rerank_ids(self, queries: List[str], documents: List[List[str]], doc_ids: List[List[str]],
+                   top_k: int) -> List[List[str]]:
+        """The rerank function of HybridRetriever: the top_k doc_ids of every query."""
+        return [[ranked["doc_id"] for ranked in self.rerank(query, query_documents, query_doc_ids)[:top_k]]
+                for query, query_documents, query_doc_ids in zip(queries, documents, doc_ids)]
+
+
+class StubLLM:
+    def __init__(self, latency: float = 0.0):
+        """Stand-in for the chat model: sleeps for a fixed latency and returns a fixed-size answer."""
+        self.latency = latency
+
+    def invoke(self, prompt: str) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        return f"// refactored ({len(prompt)} prompt characters)\n" + prompt[-200:]
+
+
+def synthetic_refactorings(size: int, seed: int = 0):
+    """
+    Yields size Extract Method refactorings with generated Java-like methods. Methods are built from
+    a small vocabulary, so BM25 and the vector search see realistic term overlap between documents.
+    """
+    generator = random.Random(seed)
+    for number in range(size):
+        words = generator.sample(_WORDS, 4)
+        method = words[0] + ''.join(word.capitalize() for word in words[1:3])
+        statements = []
+        for line in range(generator.randint(3, 12)):
+            left, right = generator.sample(_WORDS, 2)
+            statements.append(f"        {generator.choice(_TYPES)} {left}{line} = {right}.get{left.capitalize()}"
+                              f"({generator.randint(0, 99)});")
+        body = '\n'.join(statements)
+        source = (f"    // {words[3]} handling\n    public void {method}() {{\n{body}\n    }}")
+        yield {
+            "type": "Extract Method",
+            "sourceCodeBeforeRefactoring": source,
+            "sourceCodeAfterRefactoring": source.replace(statements[-1], f"        extracted{number}();"),
+            "diffSourceCode": f"-{statements[-1]}\n+        extracted{number}();",
+            "filePathBefore": f"src/main/java/bench/{words[1].capitalize()}.java",
+            "isPureRefactoring": True,
+            "commitId": f"{number:040x}",
+            "packageNameBefore": "bench",
+            "classNameBefore": words[1].capitalize(),
+            "methodNameBefore": method,
+            "classSignatureBefore": f"public class {words[1].capitalize()}",
+            "uniqueId": f"{number:040x}_{number}",
+            "contextDescription": f"Method {method} of class {words[1].capitalize()} updates the {words[3]}.",
+        }
+
+
+def fixture_refactorings(file_path: str, size: int):
+    """
+    Yields size refactorings from a RefactoringMiner JSON file, cycling over it with fresh uniqueIds
+    when the file holds fewer than size refactorings.
+    """
+    refactorings = [refactoring for refactoring in iter_refactorings(file_path)
+                    if refactoring.get('sourceCodeBeforeRefactoring')]
+    if not refactorings:
+        raise ValueError(f"No refactorings with source code in {file_path}")
+    for number in range(size):
+        refactoring = dict(refactorings[number % len(refactorings)])
+        refactoring['uniqueId'] = f"{refactoring.get('uniqueId')}#{number // len(refactorings)}"
+        refactoring.setdefault('contextDescription', refactoring.get('methodNameBefore') or '')
+        for key in ('sourceCodeAfterRefactoring', 'diffSourceCode'):
+            refactoring.setdefault(key, '')
+        yield refactoring
+
+
+def index_paths(directory: str, bm25_shards: int = 1) -> Dict[str, str]:
+    # Every shard count gets its own BM25 index, next to the vector and refactoring stores they share
+    bm25_name = 'bm25' if bm25_shards <= 1 else f'bm25-{bm25_shards}shards'
+    return {'vectors': os.path.join(directory, 'vectors.idx'), 'bm25': os.path.join(directory, f'{bm25_name}.idx'),
+            'refactorings': os.path.join(directory, 'refactorings.idx')}
+
+
+def build_indexes(directory: str, refactorings: List[dict], embedding_function, bm25_shards: int = 1,
+                  bm25_processes: Optional[int] = None,
+                  indexes: Iterable[str] = ('vectors', 'bm25', 'refactorings')) -> Dict[str, float]:
+    """
+    Builds the vector store, the BM25 index (sharded if bm25_shards > 1) and the refactoring store, or
+    only the given ones of them; returns the build time of each.
+    """
+    os.makedirs(directory, exist_ok=True)
+    ids = [refactoring['uniqueId'] for refactoring in refactorings]
+    seconds = {}
+    started = time.perf_counter()
+    documents = build_document_texts(refactorings)
+    seconds['documents'] = time.perf_counter() - started
+    paths = index_paths(directory, bm25_shards)
+
+    if 'vectors' in indexes:
+        started = time.perf_counter()
+        store = LocalVectorStore(paths['vectors'], embedding_function=embedding_function, keep_texts=False)
+        for start in range(0, len(ids), 4096):
+            store.add(ids[start:start + 4096], documents[start:start + 4096], [{}] * len(ids[start:start + 4096]))
+        store.save()
+        seconds['vector'] = time.perf_counter() - started
+
+    if 'bm25' in indexes:
+        started = time.perf_counter()
+        if bm25_shards > 1:
+            ShardedBM25.build(paths['bm25'], documents, num_shards=bm25_shards, processes=bm25_processes, ids=ids,
+                              keep_texts=False)
+        else:
+            BM25(documents, ids=ids, keep_texts=False).save_model(paths['bm25'])
+        seconds['bm25'] = time.perf_counter() - started
+
+    if 'refactorings' in indexes:
+        started = time.perf_counter()
+        RefactoringStore.write(paths['refactorings'], refactorings)
+        seconds['store'] = time.perf_counter() - started
+    return seconds
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Returns p50, p95 and the mean of durations in seconds, in milliseconds."""
+    values = np.asarray(samples) * 1000.0
+    return {"p50_ms": round(float(np.percentile(values, 50)), 3),
+            "p95_ms": round(float(np.percentile(values, 95)), 3),
+            "mean_ms": round(float(values.mean()), 3)}
+
+
+def prepare_indexes(size: int, directory: str, fixture: Optional[str] = None, dimensions: int = 384,
+                    seed: int = 0, rebuild: bool = False, bm25_shards: int = 1,
+                    bm25_processes: Optional[int] = None) -> Optional[Dict[str, float]]:
+    """
+    Builds the indexes of a corpus of the given size in directory, unless they exist already. When
+    only the BM25 index of the requested shard count is missing, only it is built.
+
+    Returns:
+        Optional[Dict[str, float]]: The build time of every index built, or None if they were reused.
+    """
+    paths = index_paths(directory, bm25_shards)
+    missing = [name for name, path in paths.items() if rebuild or not os.path.exists(path)]
+    if not missing:
+        return None
+    if missing != ['bm25']:
+        # The vector store appends to an existing file, so a rebuild or an interrupted build starts from scratch
+        missing = list(paths)
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+    refactorings = list(fixture_refactorings(fixture, size) if fixture else synthetic_refactorings(size, seed))
+    return {name: round(seconds, 3) for name, seconds
+            in build_indexes(directory, refactorings, HashingEmbeddingFunction(dimensions), bm25_shards=bm25_shards,
+                             bm25_processes=bm25_processes, indexes=missing).items()}
+
+
+def run_size(size: int, directory: str, queries: int = 200, llm_latency: float = 0.0, dimensions: int = 384,
+             seed: int = 0, bm25_shards: int = 1, bm25_processes: Optional[int] = None) -> dict:
+    """
+    Benchmarks retrieval.HybridRetriever, the retrieval path process_commits runs, on the indexes built
+    by prepare_indexes: vector search, BM25, reciprocal rank fusion, reranking (with the record lookup),
+    the prompt examples and the LLM call, each timed per query. The vector search runs on the local
+    store and the reranker and LLM are stand-ins, so nothing beyond numpy has to be installed.
+
+    Parameters:
+        size (int): Number of documents in the corpus.
+        directory (str): Directory of the indexes.
+        queries (int): Number of queries run (default is 200).
+        llm_latency (float): Seconds every stub LLM call takes (default is 0).
+        dimensions (int): Embedding dimensions the indexes were built with (default is 384, as MiniLM).
+        seed (int): Seed of the query sample.
+        bm25_shards (int): Number of BM25 shards (default is 1, a single index).
+        bm25_processes (Optional[int]): Query worker processes the BM25 shards fan out to (default is none).
+
+    Returns:
+        dict: Load times, per-stage latency percentiles, queries per second and peak RSS.
+    """
+    embedding_function = HashingEmbeddingFunction(dimensions)
+    paths = index_paths(directory, bm25_shards)
+    result = {"size": size, "queries": queries, "bm25_shards": bm25_shards}
+
+    load_seconds = {}
+    started = time.perf_counter()
+    store = LocalVectorStore(paths['vectors'], embedding_function=embedding_function)
+    load_seconds['vector'] = time.perf_counter() - started
+    started = time.perf_counter()
+    bm25_model = load_bm25(paths['bm25'], processes=bm25_processes)
+    load_seconds['bm25'] = time.perf_counter() - started
+    started = time.perf_counter()
+    records = RefactoringStore.open(paths['refactorings'])
+    load_seconds['store'] = time.perf_counter() - started
+    result["index_load_seconds"] = {name: round(seconds, 4) for name, seconds in load_seconds.items()}
+
+    # Queries are the sources of sampled refactorings, as process_commits searches with the code to refactor
+    generator = random.Random(seed + 1)
+    query_texts = [records[records.ids[generator.randrange(len(records))]]['sourceCodeBeforeRefactoring']
+                   for _ in range(queries)]
+    retriever = HybridRetriever(
+        records, bm25_model,
+        lambda texts, n_results: store.query(texts, n_results=n_results, include=["distances"])['ids'],
+        StubReranker().rerank_ids)
+    llm = StubLLM(llm_latency)
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+
+    for query in query_texts:
+        marks = [time.perf_counter()]
+        embedding_ids = retriever.search_vectors([query])
+        marks.append(time.perf_counter())
+        bm25_ids = retriever.search_bm25([query])
+        marks.append(time.perf_counter())
+        candidates = retriever.fuse(embedding_ids[0], bm25_ids[0])
+        marks.append(time.perf_counter())
+        top_doc_ids = retriever.rerank_many([query], [candidates])[0]
+        marks.append(time.perf_counter())
+        prompt = format_historical_refactorings(top_doc_ids, records) + "\n" + query
+        marks.append(time.perf_counter())
+        llm.invoke(prompt)
+        marks.append(time.perf_counter())
+        for stage, start, stop in zip(STAGES, marks, marks[1:]):
+            timings[stage].append(stop - start)
+        totals.append(marks[-1] - marks[0])
+
+    result["stages"] = {stage: percentiles(samples) for stage, samples in timings.items()}
+    result["total"] = percentiles(totals)
+    result["queries_per_second"] = round(len(totals) / sum(totals), 2)
+    if isinstance(bm25_model, ShardedBM25):
+        bm25_model.close()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = round(peak_rss / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+    return result
+
+
+def run_benchmark(sizes: List[int], output_path: str, directory: str = 'data/benchmark', queries: int = 200,
+                  fixture: Optional[str] = None, llm_latency: float = 0.0, dimensions: int = 384, seed: int = 0,
+                  rebuild: bool = False, bm25_shards: int = 1, bm25_processes: Optional[int] = None) -> dict:
+    """
+    Benchmarks every corpus size and writes all results to a JSON file. Indexes are built in one
+    process and queried in a fresh one, so peak RSS and load times reflect querying only and are
+    not affected by the previous size. Built indexes are kept per corpus and size and reused.
+
+    Returns:
+        dict: The written results.
+    """
+    corpus = os.path.splitext(os.path.basename(fixture))[0] if fixture else 'synthetic'
+    results = []
+    for size in sizes:
+        size_directory = os.path.join(directory, f'{corpus}-{size}')
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            build_seconds = executor.submit(prepare_indexes, size, size_directory, fixture=fixture,
+                                            dimensions=dimensions, seed=seed, rebuild=rebuild,
+                                            bm25_shards=bm25_shards, bm25_processes=bm25_processes).result()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_size, size, size_directory, queries=queries, llm_latency=llm_latency,
+                                     dimensions=dimensions, seed=seed, bm25_shards=bm25_shards,
+                                     bm25_processes=bm25_processes).result()
+        if build_seconds is not None:
+            result["build_seconds"] = build_seconds
+        results.append(result)
+        print(format_result(result))
+
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "corpus": corpus,
+        "options": {"queries": queries, "llm_latency": llm_latency, "dimensions": dimensions, "seed": seed,
+                    "bm25_shards": bm25_shards, "bm25_processes": bm25_processes},
+        "results": results,
+    }
+    output_directory = os.path.dirname(output_path)
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {output_path}")
+    return report
+
+
+def format_result(result: dict) -> str:
+    lines = [f"{result['size']} documents: {result['queries_per_second']} queries/sec, "
+             f"p50 {result['total']['p50_ms']} ms, p95 {result['total']['p95_ms']} ms, "
+             f"peak RSS {result['peak_rss_mb']} MB, index load "
+             + ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in result['index_load_seconds'].items())]
+    for stage, stats in result['stages'].items():
+        lines.append(f"  {stage:<7} p50 {stats['p50_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms")
+    return "\n".join(lines)
+
+
+def compare(baseline_path: str, current_path: str) -> str:
+    """Returns the change of p95 latency per stage and of queries/sec between two result files."""
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = {result['size']: result for result in json.load(file)['results']}
+    with open(current_path, encoding='utf-8') as file:
+        current = {result['size']: result for result in json.load(file)['results']}
+    lines = []
+    for size in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[size], current[size]
+        lines.append(f"{size} documents: queries/sec {before['queries_per_second']} -> {after['queries_per_second']}")
+        for stage in STAGES:
+            old, new = before['stages'][stage]['p95_ms'], after['stages'][stage]['p95_ms']
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            lines.append(f"  {stage:<7} p95 {old:>9.3f} -> {new:>9.3f} ms ({change})")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the hybrid retrieval path")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--fixture', help="RefactoringMiner JSON file to use instead of the synthetic corpus")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="seconds per stub LLM call")
+    parser.add_argument('--dimensions', type=int, default=384)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bm25-shards', type=int, default=1, help="split the BM25 index into this many shards")
+    parser.add_argument('--bm25-processes', type=int, help="worker processes building and searching the BM25 shards")
+    parser.add_argument('--rebuild', action='store_true', help="rebuild the indexes even if they exist")
+    parser.add_argument('--directory', default='data/benchmark')
+    parser.add_argument('--output', default=f"data/benchmark/results-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument('--compare', metavar='BASELINE', help="result file to compare the new results against")
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.output, directory=args.directory, queries=args.queries, fixture=args.fixture,
+                  llm_latency=args.llm_latency, dimensions=args.dimensions, seed=args.seed, rebuild=args.rebuild,
+                  bm25_shards=args.bm25_shards, bm25_processes=args.bm25_processes)
+    if args.compare:
+        print(compare(args.compare, args.output))
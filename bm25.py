@@ -1,24 +1,51 @@
+import logging
 import pickle
 
-from rank_bm25 import BM25Okapi
-from typing import List
+import numpy as np
+
+from bm25_index import InvertedIndex
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 
 class BM25:
-    def __init__(self, corpus: List[str], preprocess_func=None):
+    def __init__(self, corpus: List[str], preprocess_func=None, ids: Optional[List[str]] = None,
+                 keep_texts: bool = True):
         """
         Initializes the BM25 model with the given corpus and an optional preprocessing function.
 
         Parameters:
             corpus (List[str]): A list of documents, where each document is a string.
             preprocess_func (callable, optional): A function to preprocess documents and queries.
+            ids (List[str], optional): An external id for every document, such as its uniqueId.
+            keep_texts (bool): Keep the document texts in the model and its file (default is True). Models
+                keyed by uniqueId can leave them out and resolve the ids through the refactoring store;
+                search then is not available.
         """
         # Use the provided preprocess function if it exists; otherwise, just split the strings.
-        self.tokenized_corpus = [self.preprocess(doc) if preprocess_func is None else preprocess_func(doc) for doc in
-                                 corpus]
-        self.bm25 = BM25Okapi(self.tokenized_corpus)
+        self.preprocess_func = preprocess_func
+        self.index = InvertedIndex(self._tokenize(doc) for doc in corpus)
+
+        self.corpus = list(corpus) if keep_texts else None
+        self.ids = list(ids) if ids is not None else None
+
+    def __len__(self) -> int:
+        """Number of document ids, including those of removed documents."""
+        return len(self.index.doc_len)
 
-        self.corpus = corpus
+    def __setstate__(self, state):
+        # Models pickled before the inverted index still carry a rank_bm25.BM25Okapi; rebuild from their tokens.
+        state.pop('bm25', None)
+        tokenized_corpus = state.pop('tokenized_corpus', None)
+        self.__dict__.update(state)
+        self.__dict__.setdefault('preprocess_func', None)
+        self.__dict__.setdefault('ids', None)
+        if 'index' not in state:
+            self.index = InvertedIndex(tokenized_corpus)
+
+    def _tokenize(self, document: str) -> List[str]:
+        return self.preprocess(document) if self.preprocess_func is None else self.preprocess_func(document)
 
     @staticmethod
     def preprocess(document: str) -> List[str]:
@@ -44,47 +71,183 @@ class BM25:
         Returns:
             List[str]: A list of top N relevant documents.
         """
+        if self.corpus is None:
+            raise ValueError("The model has no document texts; use search_unique_ids and resolve the ids instead")
+        doc_ids, _ = self.search_ids(query, top_n=top_n)
+        return [self.corpus[doc_id] for doc_id in doc_ids]
+
+    def search_ids(self, query: str, top_n: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the corpus and returns positions into the corpus instead of the document text.
+
+        Parameters:
+            query (str): The search query as a string.
+            top_n (int): Number of top relevant documents to return (default is 5).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The ids of the top N documents and their BM25 scores, best first.
+        """
         tokenized_query = self.preprocess(query)  # Tokenize the query
-        return self.bm25.get_top_n(tokenized_query, self.corpus, n=top_n)
+        return self.index.top_n(tokenized_query, n=top_n)
+
+    def search_unique_ids(self, query: str, top_n: int = 5) -> List[str]:
+        """
+        Searches the corpus and returns the external ids (e.g. uniqueId) of the top documents.
 
-    def add_document(self, document: str):
+        Parameters:
+            query (str): The search query as a string.
+            top_n (int): Number of top relevant documents to return (default is 5).
+
+        Returns:
+            List[str]: The external ids of the top N documents.
+        """
+        doc_ids, _ = self.search_ids(query, top_n=top_n)
+        return [self.ids[doc_id] for doc_id in doc_ids]
+
+    def search_many(self, queries: List[str], top_n: int = 5) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Searches the corpus for many queries at once with vectorized scoring.
+
+        Parameters:
+            queries (List[str]): The search queries as strings.
+            top_n (int): Number of top relevant documents to return per query (default is 5).
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: Per query, the ids of the top N documents and their BM25 scores.
         """
-        Adds a new document to the corpus and updates the BM25 model.
+        return self.index.top_n_many([self.preprocess(query) for query in queries], n=top_n)
+
+    def add_document(self, document: str, unique_id: Optional[str] = None) -> int:
+        """
+        Adds a new document to the corpus and updates the BM25 index in place.
 
         Parameters:
             document (str): The new document as a string.
+            unique_id (str, optional): The external id of the document, required if the model has ids.
+
+        Returns:
+            int: The id of the new document.
         """
-        self.tokenized_corpus.append(self.preprocess(document))  # Preprocess and append the document
-        self.bm25 = BM25Okapi(self.tokenized_corpus)  # Rebuild the model with the updated corpus
+        return self.add_documents([document], ids=None if unique_id is None else [unique_id])[0]
+
+    def add_documents(self, documents: List[str], ids: Optional[List[str]] = None) -> List[int]:
+        """
+        Adds new documents to the corpus. Document frequencies, the average document length and
+        the postings are updated in place, so the cost is proportional to the new documents only.
+
+        Parameters:
+            documents (List[str]): The new documents as strings.
+            ids (List[str], optional): The external ids of the new documents, required if the model has ids.
+
+        Returns:
+            List[int]: The ids of the new documents.
+        """
+        if (ids is None) != (self.ids is None):
+            raise ValueError("External ids must be given for every document of the model or for none")
+        if ids is not None and len(ids) != len(documents):
+            raise ValueError(f"Got {len(ids)} ids for {len(documents)} documents")
+        doc_ids = self.index.add_documents(self._tokenize(doc) for doc in documents)
+        if self.corpus is not None:
+            self.corpus.extend(documents)
+        if ids is not None:
+            self.ids.extend(ids)
+        return doc_ids
+
+    def remove_document(self, doc_id: int, document: Optional[str] = None):
+        """
+        Removes a document from the corpus and the BM25 index. Ids of other documents do not change.
+
+        Parameters:
+            doc_id (int): The id of the document, as returned by search_ids or add_documents.
+            document (str, optional): The text the document was indexed with; required if the model
+                has no document texts.
+        """
+        if document is None:
+            if self.corpus is None:
+                raise ValueError("The model has no document texts; pass the text of the removed document")
+            document = self.corpus[doc_id]
+        self.index.remove_document(doc_id, self._tokenize(document))
+        if self.corpus is not None:
+            self.corpus[doc_id] = None
 
     def save_model(self, filepath: str):
         """
-        Saves the BM25 model to a file using pickle.
+        Saves the BM25 index and the corpus, if the model keeps it, to a versioned binary file
+        (see bm25_index.InvertedIndex.save).
 
         Parameters:
             filepath (str): Path to save the model.
         """
-        with open(filepath, 'wb') as file:
-            pickle.dump(self, file)
-        print(f"Model saved to {filepath}")
+        self.index.save(filepath, self.corpus, ids=self.ids)
+        logger.info("Model saved to %s", filepath)
 
     @staticmethod
-    def load_model(filepath: str) -> 'BM25':
+    def load_model(filepath: str, preprocess_func=None) -> 'BM25':
         """
-        Loads a BM25 model from a file.
+        Loads a BM25 model from a file written by save_model. The file is memory-mapped, so loading
+        does not depend on the corpus size and worker processes share the same pages.
 
         Parameters:
             filepath (str): Path to load the model from.
+            preprocess_func (callable, optional): The preprocessing function the model was built with.
 
         Returns:
             BM25: The loaded BM25 model object.
         """
-        with open(filepath, 'rb') as file:
+        model = BM25.__new__(BM25)
+        model.preprocess_func = preprocess_func
+        model.index, model.corpus, model.ids = InvertedIndex.open(filepath)
+        logger.info("Model loaded from %s", filepath)
+        return model
+
+    @staticmethod
+    def from_records(records, preprocess_func=None, keep_texts: bool = False) -> 'BM25':
+        """
+        Builds a model over every record of a refactoring store, keyed by uniqueId. The document
+        texts come from records.document_text, so they are exactly the texts the store resolves;
+        by default they are not kept in the model, the store stays their only copy.
+
+        Parameters:
+            records (RefactoringStore): The store; iterating it yields the uniqueIds.
+            preprocess_func (callable, optional): A function to preprocess documents and queries.
+            keep_texts (bool): Keep the document texts in the model as well (default is False).
+
+        Returns:
+            BM25: The new BM25 model object.
+        """
+        ids = list(records)
+        return BM25([records.document_text(unique_id) for unique_id in ids], preprocess_func=preprocess_func, ids=ids,
+                    keep_texts=keep_texts)
+
+    @staticmethod
+    def convert_model(pickle_path: str, filepath: str, records=None) -> 'BM25':
+        """
+        Converts a model pickled by earlier versions of save_model into the binary index format.
+        Pickles holding a rank_bm25.BM25Okapi need rank_bm25 installed to be read.
+
+        Pickled models without external ids are rebuilt from the refactoring store instead (see
+        from_records); their document texts are never matched against the store to guess ids.
+
+        Parameters:
+            pickle_path (str): Path of the pickled model.
+            filepath (str): Path to write the converted model to.
+            records (RefactoringStore, optional): The store to rebuild a model without ids from.
+
+        Returns:
+            BM25: The converted BM25 model object.
+        """
+        with open(pickle_path, 'rb') as file:
             model = pickle.load(file)
-        print(f"Model loaded from {filepath}")
+        if model.ids is None:
+            if records is None:
+                raise ValueError(f"{pickle_path} has no uniqueIds; pass the refactoring store to rebuild it from")
+            logger.info("%s has no uniqueIds, rebuilding it from %d stored refactorings", pickle_path, len(records))
+            model = BM25.from_records(records, preprocess_func=model.preprocess_func)
+        model.save_model(filepath)
         return model
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
 
     # Define the query and documents
     query = "London windy"
@@ -102,13 +265,18 @@ if __name__ == "__main__":
     # print(f"Search result: {result}")
 
     # Save the model to a file
-    bm25_model.save_model('data/model/bm25result.pkl')
+    bm25_model.save_model('data/model/bm25result.idx')
 
     # Load the model from the file
-    loaded_model = BM25.load_model('data/model/bm25result.pkl')
+    loaded_model = BM25.load_model('data/model/bm25result.idx')
 
     # Verify the loaded model by searching again
     loaded_result = loaded_model.search(query, top_n=1)
     print(f"Loaded model search result: {loaded_result}")
 
+    # Cross-check the inverted index against the full-corpus rank_bm25 scorer
+    from rank_bm25 import BM25Okapi
+    okapi = BM25Okapi([BM25.preprocess(doc) for doc in documents])
+    print(f"BM25Okapi search result: {okapi.get_top_n(BM25.preprocess(query), documents, n=1)}")
+
 
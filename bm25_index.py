@@ -0,0 +1,464 @@
+import math
+from collections import Counter
+from collections.abc import Sequence
+from itertools import chain
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from mmap_store import MappedTexts, pack_strings, read_sections, write_sections
+
+# Version 2 added the optional external document ids ('id_offsets' and 'ids' sections).
+MAGIC = b'BM25IDX\x00'
+FORMAT_VERSION = 2
+_READABLE_VERSIONS = (1, 2)
+
+
+def _ensure_capacity(array: np.ndarray, size: int) -> np.ndarray:
+    """Returns ``array`` or a copy of it with room for at least ``size`` entries, growing geometrically."""
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array), 16), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def okapi_idf(df: Iterable[int], num_docs: int, epsilon: float) -> Tuple[np.ndarray, float]:
+    """
+    Computes the BM25Okapi idf of every term from its document frequency.
+
+    The idf values are computed with ``math.log`` and summed sequentially in the given term order,
+    which is the order BM25Okapi uses, so the epsilon floor is bit-for-bit identical when the terms
+    come in the order they first occur in the corpus. Terms with a zero frequency get an idf of 0
+    and do not count towards the average.
+
+    Returns:
+        Tuple[np.ndarray, float]: The idf per term and the average idf the floor is taken from.
+    """
+    df = list(df)
+    idf = np.zeros(len(df), dtype=np.float64)
+    idf_sum = 0.0
+    num_terms = 0
+    for term_id, freq in enumerate(df):
+        if not freq:
+            continue
+        value = math.log(num_docs - freq + 0.5) - math.log(freq + 0.5)
+        idf[term_id] = value
+        idf_sum += value
+        num_terms += 1
+    average_idf = idf_sum / num_terms if num_terms else 0.0
+    idf[idf < 0] = epsilon * average_idf
+    return idf, average_idf
+
+
+def select_top(candidates: np.ndarray, scores: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the N best scoring candidates, best first, breaking ties towards the higher candidate id.
+    """
+    k = min(n, len(scores))
+    if k <= 0:
+        return candidates[:0], scores[:0]
+    # Partial sort: only the entries at or above the k-th best score are fully ordered.
+    kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+    selected = np.flatnonzero(scores >= kth)
+    order = np.lexsort((-candidates[selected], -scores[selected]))[:k]
+    selected = selected[order]
+    return candidates[selected], scores[selected]
+
+
+class InvertedIndex:
+    def __init__(self, tokenized_corpus: Iterable[List[str]] = (), k1: float = 1.5, b: float = 0.75,
+                 epsilon: float = 0.25, compact_ratio: float = 0.25):
+        """
+        Builds an Okapi BM25 index over a postings-list inverted index.
+
+        The postings are stored CSR-style: the documents containing term ``t`` are
+        ``doc_ids[indptr[t]:indptr[t + 1]]`` and their term frequencies are the same slice of ``tfs``.
+        Scores are computed exactly like rank_bm25.BM25Okapi (same idf floor, same accumulation
+        order), but only the documents that contain at least one query term are touched.
+
+        Documents added later go to small per-term tail postings and are merged into the CSR arrays
+        once the tail grows past ``compact_ratio`` of the base postings. Removed documents are
+        tombstoned, so document ids stay stable.
+
+        Parameters:
+            tokenized_corpus (Iterable[List[str]]): Documents to index, where each document is a list of tokens.
+            k1 (float): Term frequency saturation (default is 1.5, as in BM25Okapi).
+            b (float): Document length normalization (default is 0.75, as in BM25Okapi).
+            epsilon (float): Floor for negative idf values, as a fraction of the average idf (default is 0.25).
+            compact_ratio (float): Tail-to-base postings ratio that triggers a merge (default is 0.25).
+        """
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.compact_ratio = compact_ratio
+
+        self.vocab = {}
+        self.df = []  # live document frequency per term id
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.int32)
+
+        self._tail = {}  # term id -> ([doc ids], [term frequencies]) added since the last compaction
+        self._tail_size = 0
+        self._doc_len = np.zeros(0, dtype=np.int64)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._size = 0  # document slots, including removed documents
+        self._num_deleted = 0
+        self._unpurged = 0  # removed documents whose postings are still in the index
+        self._total_len = 0
+        self._collection = None  # (idf per term id, avgdl) of the collection this index is a shard of
+        self._stale = True
+
+        self.add_documents(tokenized_corpus)
+        self.compact()
+
+    @classmethod
+    def open(cls, filepath: str) -> Tuple['InvertedIndex', Optional[MappedTexts], Optional[MappedTexts]]:
+        """
+        Opens an index written by save through mmap, without unpickling or copying the arrays.
+
+        The file is mapped copy-on-write, so processes opening the same file share its pages, and
+        later updates to the index never touch the file.
+
+        Parameters:
+            filepath (str): Path of the index file.
+
+        Returns:
+            Tuple[InvertedIndex, Optional[MappedTexts], Optional[MappedTexts]]: The index, the document texts
+            stored with it and the external document ids; either is None if the file does not have them.
+        """
+        try:
+            _, header, arrays = read_sections(filepath, MAGIC, _READABLE_VERSIONS)
+        except ValueError as error:
+            raise ValueError(f"{error} (pickled models can be converted with BM25.convert_model)") from error
+
+        index = cls(k1=header['k1'], b=header['b'], epsilon=header['epsilon'],
+                    compact_ratio=header['compact_ratio'])
+        term_offsets, terms = arrays['term_offsets'], arrays['terms'].tobytes()
+        index.vocab = {terms[term_offsets[i]:term_offsets[i + 1]].decode('utf-8'): i
+                       for i in range(len(term_offsets) - 1)}
+        index.indptr = arrays['indptr']
+        index.doc_ids = arrays['doc_ids']
+        index.tfs = arrays['tfs']
+        index.df = np.diff(index.indptr).tolist()
+        index._doc_len = arrays['doc_len']
+        index._deleted = arrays['deleted'].view(bool)
+        index._size = len(index._doc_len)
+        index._num_deleted = int(index._deleted.sum())
+        index._total_len = int(index._doc_len[~index._deleted].sum())
+        index._stale = True
+
+        texts = MappedTexts(arrays['text_offsets'], arrays['texts'], removed=np.flatnonzero(index._deleted).tolist()) \
+            if 'texts' in arrays else None
+        ids = MappedTexts(arrays['id_offsets'], arrays['ids']) if 'ids' in arrays else None
+        return index, texts, ids
+
+    def save(self, filepath: str, texts: Optional[Sequence], ids: Optional[Sequence] = None):
+        """
+        Writes the index and the document texts to a versioned binary file that open can mmap.
+
+        Pending tail postings and removed documents are merged first. The file is written next to
+        the target and then renamed over it, so readers never see a partial file.
+
+        Parameters:
+            filepath (str): Path of the index file.
+            texts (Optional[Sequence]): The document text of every document id; removed documents may be None.
+                None leaves the texts out, e.g. when they are resolved through the ids.
+            ids (Optional[Sequence]): External string ids of every document id, such as the uniqueId (optional).
+        """
+        self.compact()
+        term_offsets, terms = pack_strings(sorted(self.vocab, key=self.vocab.get))
+        arrays = {
+            'indptr': self.indptr,
+            'doc_ids': self.doc_ids,
+            'tfs': self.tfs,
+            'doc_len': self.doc_len,
+            'deleted': self._deleted[:self._size].view(np.uint8),
+            'term_offsets': term_offsets,
+            'terms': terms,
+        }
+        if texts is not None:
+            arrays['text_offsets'], arrays['texts'] = pack_strings('' if text is None else text for text in texts)
+        if ids is not None:
+            arrays['id_offsets'], arrays['ids'] = pack_strings(ids)
+        write_sections(filepath, MAGIC, FORMAT_VERSION,
+                       {'k1': self.k1, 'b': self.b, 'epsilon': self.epsilon, 'compact_ratio': self.compact_ratio},
+                       arrays)
+
+    @property
+    def num_docs(self) -> int:
+        """Number of live (not removed) documents."""
+        return self._size - self._num_deleted
+
+    @property
+    def doc_len(self) -> np.ndarray:
+        return self._doc_len[:self._size]
+
+    @property
+    def total_len(self) -> int:
+        """Number of tokens in the live documents."""
+        return self._total_len
+
+    def use_collection_stats(self, idf: Optional[np.ndarray], avgdl: float = 0.0):
+        """
+        Scores with the idf and average document length of a larger collection this index is one
+        shard of, so that scores of different shards are comparable. Adding or removing documents
+        returns to the statistics of this index until they are set again.
+
+        Parameters:
+            idf (Optional[np.ndarray]): The collection idf of every term id of this index, or None to
+                use the statistics of this index.
+            avgdl (float): The average document length of the collection.
+        """
+        self._collection = None if idf is None else (idf, avgdl)
+        self._stale = True
+
+    def add_documents(self, tokenized_docs: Iterable[List[str]]) -> List[int]:
+        """
+        Adds documents to the index in time proportional to their size.
+
+        Parameters:
+            tokenized_docs (Iterable[List[str]]): The new documents, each a list of tokens.
+
+        Returns:
+            List[int]: The ids assigned to the new documents.
+        """
+        start = self._size
+        for tokens in tokenized_docs:
+            doc_id = self._size
+            self._doc_len = _ensure_capacity(self._doc_len, doc_id + 1)
+            self._doc_len[doc_id] = len(tokens)
+            self._total_len += len(tokens)
+            self._size += 1
+            for term, tf in Counter(tokens).items():
+                term_id = self.vocab.get(term)
+                if term_id is None:
+                    term_id = self.vocab[term] = len(self.df)
+                    self.df.append(0)
+                self.df[term_id] += 1
+                postings = self._tail.get(term_id)
+                if postings is None:
+                    postings = self._tail[term_id] = ([], [])
+                postings[0].append(doc_id)
+                postings[1].append(tf)
+                self._tail_size += 1
+        self._deleted = _ensure_capacity(self._deleted, self._size)
+        self._collection = None
+        self._stale = True
+
+        if self._tail_size > self.compact_ratio * len(self.doc_ids):
+            self.compact()
+        return list(range(start, self._size))
+
+    def remove_document(self, doc_id: int, tokens: List[str]):
+        """
+        Removes a document. Its id is never reused.
+
+        Parameters:
+            doc_id (int): The id of the document to remove.
+            tokens (List[str]): The tokens the document was indexed with, used to update document frequencies.
+        """
+        if not 0 <= doc_id < self._size or self._deleted[doc_id]:
+            raise KeyError(f"Document {doc_id} is not in the index")
+        for term in set(tokens):
+            self.df[self.vocab[term]] -= 1
+        self._deleted[doc_id] = True
+        self._num_deleted += 1
+        self._unpurged += 1
+        self._total_len -= int(self._doc_len[doc_id])
+        self._collection = None
+        self._stale = True
+
+    def compact(self):
+        """Merges the tail postings into the CSR arrays and drops postings of removed documents."""
+        if not self._tail and not self._unpurged:
+            return
+        num_terms = len(self.df)
+        base_terms = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        tail_term_ids = list(self._tail)
+        tail_terms = np.repeat(np.array(tail_term_ids, dtype=np.int64),
+                               [len(self._tail[term_id][0]) for term_id in tail_term_ids])
+        tail_docs = np.fromiter(chain.from_iterable(self._tail[t][0] for t in tail_term_ids), dtype=np.int32,
+                                count=len(tail_terms))
+        tail_tfs = np.fromiter(chain.from_iterable(self._tail[t][1] for t in tail_term_ids), dtype=np.int32,
+                               count=len(tail_terms))
+
+        terms = np.concatenate([base_terms, tail_terms])
+        docs = np.concatenate([self.doc_ids, tail_docs])
+        tfs = np.concatenate([self.tfs, tail_tfs])
+        keep = ~self._deleted[docs]
+        terms, docs, tfs = terms[keep], docs[keep], tfs[keep]
+
+        # Tail documents are always newer than base documents, so a stable sort by term keeps doc ids ascending.
+        order = np.argsort(terms, kind='stable')
+        self.doc_ids = docs[order]
+        self.tfs = tfs[order]
+        self.indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(terms, minlength=num_terms))
+        self._tail = {}
+        self._tail_size = 0
+        self._unpurged = 0
+
+    def _refresh(self):
+        """
+        Recomputes avgdl and the idf table after the index changed (see okapi_idf).
+
+        The idf is bit-for-bit identical to BM25Okapi as long as no document was removed
+        (afterwards it may differ in the last bits).
+        """
+        if not self._stale:
+            return
+        if self._collection is not None:
+            self.idf, self.avgdl = self._collection
+            self._stale = False
+            return
+        num_docs = self.num_docs
+        self.avgdl = self._total_len / num_docs if num_docs else 0.0
+        self.idf, self.average_idf = okapi_idf(self.df, num_docs, self.epsilon)
+        self._stale = False
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        if term_id + 1 < len(self.indptr):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        else:  # term first seen since the last compaction
+            start = end = 0
+        docs = self.doc_ids[start:end]
+        tfs = self.tfs[start:end]
+        tail = self._tail.get(term_id)
+        if tail is not None:
+            docs = np.concatenate([docs, np.array(tail[0], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.array(tail[1], dtype=np.int32)])
+        if self._unpurged:
+            live = ~self._deleted[docs]
+            docs, tfs = docs[live], tfs[live]
+        return docs, tfs
+
+    def score(self, query_tokens: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores every document that contains at least one of the query tokens.
+
+        Parameters:
+            query_tokens (List[str]): The tokenized query. Repeated tokens count once per occurrence.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The sorted candidate document ids and their BM25 scores.
+        """
+        self._refresh()
+        term_ids = [self.vocab[token] for token in query_tokens if token in self.vocab]
+        if not term_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        postings = {term_id: self._postings(term_id) for term_id in set(term_ids)}
+        candidates = np.unique(np.concatenate([docs for docs, _ in postings.values()])).astype(np.int64)
+        scores = np.zeros(len(candidates), dtype=np.float64)
+
+        # Accumulate term by term in query order so the float sums match BM25Okapi.get_scores.
+        contributions = {}
+        for term_id in term_ids:
+            if term_id not in contributions:
+                docs, tf = postings[term_id]
+                norm = self.k1 * (1 - self.b + self.b * self._doc_len[docs] / self.avgdl)
+                contributions[term_id] = (
+                    np.searchsorted(candidates, docs),
+                    self.idf[term_id] * (tf * (self.k1 + 1) / (tf + norm)),
+                )
+            positions, contribution = contributions[term_id]
+            scores[positions] += contribution
+        return candidates, scores
+
+    def top_n(self, query_tokens: List[str], n: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the N best scoring documents for the query.
+
+        The ranking matches BM25Okapi.get_top_n over the live documents wherever scores differ. Ties
+        are broken towards the higher document id, which is what a stable ``np.argsort(scores)[::-1]``
+        yields; BM25Okapi sorts with the default (unstable) quicksort, so its order among equal scores
+        is unspecified. Unless N documents score above zero, every live document takes part in the
+        ranking, so matching documents that score zero (a term with idf 0) or below (a floored idf)
+        rank among the non-matching ones exactly as with the full-corpus scorer.
+
+        Parameters:
+            query_tokens (List[str]): The tokenized query.
+            n (int): Number of documents to return (default is 5).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The top document ids and their scores, best first.
+        """
+        candidates, scores = self.score(query_tokens)
+        if np.count_nonzero(scores > 0) < min(n, self.num_docs):
+            dense = np.zeros(self._size, dtype=np.float64)
+            dense[candidates] = scores
+            candidates = np.flatnonzero(~self._deleted[:self._size])
+            scores = dense[candidates]
+        return select_top(candidates, scores, n)
+
+    def top_n_many(self, queries: List[List[str]], n: int = 5,
+                   batch_size: int = 256) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns the N best scoring documents for every query, scoring a whole batch at once.
+
+        Each batch is scored as a sparse (query x term) by (term x document) product: the postings
+        of every query term are gathered in one go and summed per (query, document) pair with a
+        single bincount, and the per-query top N is cut from one segmented sort. Rankings match
+        top_n; scores match up to floating-point rounding, since repeated query terms are
+        weighted by their count instead of being added one by one.
+
+        Parameters:
+            queries (List[List[str]]): The tokenized queries.
+            n (int): Number of documents to return per query (default is 5).
+            batch_size (int): Number of queries scored together, which bounds memory (default is 256).
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: Per query, the top document ids and their scores, best first.
+        """
+        self.compact()
+        self._refresh()
+        results = []
+        for start in range(0, len(queries), batch_size):
+            results.extend(self._top_n_batch(queries[start:start + batch_size], n))
+        return results
+
+    def _top_n_batch(self, queries: List[List[str]], n: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        pair_query, pair_term, pair_count = [], [], []
+        for query_id, tokens in enumerate(queries):
+            for term, count in Counter(tokens).items():
+                term_id = self.vocab.get(term)
+                if term_id is not None:
+                    pair_query.append(query_id)
+                    pair_term.append(term_id)
+                    pair_count.append(count)
+        pair_query = np.array(pair_query, dtype=np.int64)
+        pair_term = np.array(pair_term, dtype=np.int64)
+        pair_count = np.array(pair_count, dtype=np.float64)
+
+        # Gather the postings slice of every (query, term) pair without a Python loop.
+        starts = self.indptr[pair_term]
+        lengths = self.indptr[pair_term + 1] - starts
+        pair_of_posting = np.repeat(np.arange(len(pair_term)), lengths)
+        positions = starts[pair_of_posting] + np.arange(len(pair_of_posting)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        docs = self.doc_ids[positions].astype(np.int64)
+        tf = self.tfs[positions]
+        norm = self.k1 * (1 - self.b + self.b * self._doc_len[docs] / self.avgdl)
+        weights = (pair_count * self.idf[pair_term])[pair_of_posting] * (tf * (self.k1 + 1) / (tf + norm))
+
+        keys, inverse = np.unique(pair_query[pair_of_posting] * self._size + docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights, minlength=len(keys))
+        query_of, docs = np.divmod(keys, self._size)
+
+        order = np.lexsort((-docs, -scores, query_of))
+        query_of, docs, scores = query_of[order], docs[order], scores[order]
+        group_start = np.searchsorted(query_of, np.arange(len(queries)))
+        group_size = np.bincount(query_of, minlength=len(queries))
+        positive = np.bincount(query_of[scores > 0], minlength=len(queries))
+
+        results = []
+        for query_id, tokens in enumerate(queries):
+            if positive[query_id] < min(n, self.num_docs):
+                # Zero-scored documents take part in the ranking, see top_n.
+                results.append(self.top_n(tokens, n))
+                continue
+            selected = slice(group_start[query_id], group_start[query_id] + min(n, group_size[query_id]))
+            results.append((docs[selected], scores[selected]))
+        return results
@@ -0,0 +1,425 @@
+import logging
+import os
+from bisect import bisect_right
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from bm25 import BM25
+from bm25_index import okapi_idf, select_top
+from mmap_store import read_sections, write_sections
+
+logger = logging.getLogger(__name__)
+
+# The manifest lists the shard files, which are ordinary BM25 model files next to it.
+MAGIC = b'BM25SHRD'
+FORMAT_VERSION = 1
+
+# Shards of this query worker process, opened by _init_worker
+_worker_shards = {}
+
+
+def _shard_path(filepath: str, number: int) -> str:
+    return f"{filepath}.shard{number}"
+
+
+def _build_shard(filepath: str, documents: List[str], ids: Optional[List[str]], preprocess_func,
+                 keep_texts: bool) -> str:
+    # Runs in a build worker: tokenizes and indexes one slice of the corpus and writes it to its own file
+    BM25(documents, preprocess_func=preprocess_func, ids=ids, keep_texts=keep_texts).save_model(filepath)
+    return filepath
+
+
+def _init_worker(shards: List[Tuple[int, str, np.ndarray, float]]):
+    # Every query worker opens only the shards it serves; the files are mmapped, so the pages are shared
+    for number, filepath, idf, avgdl in shards:
+        model = BM25.load_model(filepath)
+        model.index.use_collection_stats(idf, avgdl)
+        _worker_shards[number] = model.index
+
+
+def _search_shard(number: int, queries: List[List[str]], n: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    return _top_n(_worker_shards[number], queries, n)
+
+
+def _top_n(index, queries: List[List[str]], n: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    if len(queries) == 1:
+        return [index.top_n(queries[0], n=n)]
+    return index.top_n_many(queries, n=n)
+
+
+class _ChainedTexts(Sequence):
+    def __init__(self, parts: List[Sequence]):
+        """Read-only list-like view of the per-shard corpora or ids, indexed by global document id."""
+        self._parts = parts
+        self._starts = np.cumsum([0] + [len(part) for part in parts]).tolist()
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        shard = bisect_right(self._starts, position) - 1
+        return self._parts[shard][position - self._starts[shard]]
+
+
+class ShardedBM25:
+    def __init__(self, filepath: str, shards: List[BM25], shard_size: int, processes: Optional[int] = None,
+                 preprocess_func=None):
+        """
+        A BM25 model split into shards over consecutive ranges of documents. Use build or load_model
+        to get one.
+
+        Every shard is an ordinary BM25 model file. Scores use the idf and average document length of
+        the whole collection, merged from the per-shard statistics, so they equal the scores of a single
+        BM25 model over the same corpus and the merged per-shard top N is the global top N (ties are
+        broken towards the higher document id, as in InvertedIndex.top_n). Document ids are global:
+        shard i holds the ids from the sum of the sizes of the shards before it.
+
+        With processes > 1, queries fan out to a pool of worker processes, each serving a fixed group of
+        shards, and building spreads the tokenizing and indexing of the shards over a process pool. The
+        query workers read the saved shard files, so searches of a model with unsaved changes run in
+        this process.
+
+        Parameters:
+            filepath (str): Path of the manifest; the shards are stored next to it.
+            shards (List[BM25]): The shard models, in document order.
+            shard_size (int): Number of documents a shard is filled up to before documents added later
+                go to a new shard.
+            processes (Optional[int]): Worker processes for building and querying; None or 1 does
+                everything in this process (default is None).
+            preprocess_func (callable, optional): The preprocessing function the shards were built with.
+        """
+        self.filepath = filepath
+        self.shards = shards
+        self.shard_size = shard_size
+        self.processes = processes
+        self.preprocess_func = preprocess_func
+        self._ids = None
+        self._executors = None
+        self._dirty = set()  # shards changed in place since the last save
+        self._unsaved = False  # the saved manifest and shard files are behind this model
+        self._refresh()
+
+    @classmethod
+    def build(cls, filepath: str, corpus: List[str], num_shards: int = 4, processes: Optional[int] = None,
+              preprocess_func=None, ids: Optional[List[str]] = None, keep_texts: bool = True) -> 'ShardedBM25':
+        """
+        Builds the shards of a corpus in parallel and saves them with their manifest.
+
+        Parameters:
+            filepath (str): Path of the manifest; shard i is written to ``{filepath}.shard{i}``.
+            corpus (List[str]): A list of documents, where each document is a string.
+            num_shards (int): Number of shards (default is 4).
+            processes (Optional[int]): Worker processes for building and querying (default is None).
+            preprocess_func (callable, optional): A function to preprocess documents; it must be picklable
+                (e.g. a module-level function) to build in worker processes.
+            ids (List[str], optional): An external id for every document, such as its uniqueId.
+            keep_texts (bool): Keep the document texts in the shard files (default is True, see BM25).
+
+        Returns:
+            ShardedBM25: The built model, with its shards mapped from the written files.
+        """
+        corpus = list(corpus)
+        shard_size = max(-(-len(corpus) // max(num_shards, 1)), 1)
+        model = cls(filepath, [], shard_size, processes=processes, preprocess_func=preprocess_func)
+        model._add_shards(corpus, ids, keep_texts)
+        model._refresh()
+        model._write_manifest(filepath)
+        logger.info("Built %d BM25 shards of up to %d documents at %s", len(model.shards), shard_size, filepath)
+        return model
+
+    @staticmethod
+    def load_model(filepath: str, preprocess_func=None, processes: Optional[int] = None) -> 'ShardedBM25':
+        """
+        Loads a sharded model saved by build or save_model; the shard files are memory-mapped.
+
+        Parameters:
+            filepath (str): Path of the manifest.
+            preprocess_func (callable, optional): The preprocessing function the model was built with.
+            processes (Optional[int]): Worker processes for querying and for building new shards (default is None).
+
+        Returns:
+            ShardedBM25: The loaded model.
+        """
+        _, header, _ = read_sections(filepath, MAGIC, (FORMAT_VERSION,))
+        directory = os.path.dirname(filepath)
+        shards = [BM25.load_model(os.path.join(directory, name), preprocess_func) for name in header['shards']]
+        logger.info("Sharded model loaded from %s (%d shards)", filepath, len(shards))
+        return ShardedBM25(filepath, shards, header['shard_size'], processes=processes,
+                           preprocess_func=preprocess_func)
+
+    @property
+    def corpus(self) -> Optional[Sequence]:
+        if any(shard.corpus is None for shard in self.shards):
+            return None
+        return _ChainedTexts([shard.corpus for shard in self.shards])
+
+    @property
+    def ids(self) -> Optional[Sequence]:
+        if self._ids is not None:
+            return self._ids
+        if not self.shards or self.shards[0].ids is None:
+            return None
+        return _ChainedTexts([shard.ids for shard in self.shards])
+
+    @ids.setter
+    def ids(self, ids: Optional[Sequence]):
+        # Models built without ids can be given them afterwards, as with BM25.ids; they are not saved
+        self._ids = ids
+
+    preprocess = staticmethod(BM25.preprocess)
+
+    def _refresh(self):
+        """
+        Merges the document frequencies, document counts and lengths of all shards into the collection
+        statistics and hands every shard the collection idf of its terms.
+
+        Terms are numbered in the order they first occur in the shards, which is the order they first
+        occur in the corpus, so the idf equals that of a single BM25 model over the same documents.
+        """
+        self._offsets = np.cumsum([0] + [len(shard) for shard in self.shards]).astype(np.int64)
+        if not self.shards:
+            return
+        collection_terms = {}
+        df = []
+        shard_terms = []
+        num_docs = total_len = 0
+        for shard in self.shards:
+            index = shard.index
+            terms = np.zeros(len(index.df), dtype=np.int64)
+            for term, term_id in index.vocab.items():
+                position = collection_terms.get(term)
+                if position is None:
+                    position = collection_terms[term] = len(df)
+                    df.append(0)
+                df[position] += index.df[term_id]
+                terms[term_id] = position
+            shard_terms.append(terms)
+            num_docs += index.num_docs
+            total_len += index.total_len
+        self._idf, _ = okapi_idf(df, num_docs, self.shards[0].index.epsilon)
+        self._avgdl = total_len / num_docs if num_docs else 0.0
+        self._shard_idf = [self._idf[terms] for terms in shard_terms]
+        for shard, idf in zip(self.shards, self._shard_idf):
+            shard.index.use_collection_stats(idf, self._avgdl)
+
+    def _add_shards(self, documents: List[str], ids: Optional[List[str]], keep_texts: bool):
+        # Slices the documents into new shards of shard_size documents and builds them, in parallel if allowed
+        numbers = range(len(self.shards), len(self.shards) + -(-len(documents) // self.shard_size))
+        tasks = [(_shard_path(self.filepath, number), documents[start:start + self.shard_size],
+                  None if ids is None else ids[start:start + self.shard_size], self.preprocess_func, keep_texts)
+                 for number, start in zip(numbers, range(0, len(documents), self.shard_size))]
+        if self.processes and self.processes > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.processes, len(tasks))) as executor:
+                paths = list(executor.map(_build_shard, *zip(*tasks)))
+        else:
+            paths = [_build_shard(*task) for task in tasks]
+        self.shards.extend(BM25.load_model(path, self.preprocess_func) for path in paths)
+
+    def _write_manifest(self, filepath: str):
+        write_sections(filepath, MAGIC, FORMAT_VERSION,
+                       {'shards': [os.path.basename(_shard_path(filepath, number))
+                                   for number in range(len(self.shards))],
+                        'shard_size': self.shard_size},
+                       {})
+
+    def _search(self, queries: List[List[str]], n: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Searches every shard for every query and merges the per-shard top N into the global top N."""
+        if not self.shards:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)) for _ in queries]
+        if self.processes and self.processes > 1 and len(self.shards) > 1 and not self._unsaved:
+            executors = self._query_executors()
+            futures = [executors[number % len(executors)].submit(_search_shard, number, queries, n)
+                       for number in range(len(self.shards))]
+            per_shard = [future.result() for future in futures]
+        else:
+            per_shard = [_top_n(shard.index, queries, n) for shard in self.shards]
+
+        results = []
+        for query_id in range(len(queries)):
+            doc_ids = np.concatenate([self._offsets[number] + results_of_shard[query_id][0].astype(np.int64)
+                                      for number, results_of_shard in enumerate(per_shard)])
+            scores = np.concatenate([results_of_shard[query_id][1] for results_of_shard in per_shard])
+            results.append(select_top(doc_ids, scores, n))
+        return results
+
+    def _query_executors(self) -> List[ProcessPoolExecutor]:
+        # One single-process pool per group of shards, so every shard is always searched by the same
+        # worker and each worker maps and keeps only its own shards
+        if self._executors is None:
+            workers = min(self.processes, len(self.shards))
+            self._executors = [
+                ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=([
+                    (number, _shard_path(self.filepath, number), self._shard_idf[number], self._avgdl)
+                    for number in range(worker, len(self.shards), workers)],))
+                for worker in range(workers)]
+        return self._executors
+
+    def close(self):
+        """Shuts the query worker processes down; they are started again by the next search."""
+        if self._executors is not None:
+            for executor in self._executors:
+                executor.shutdown()
+            self._executors = None
+
+    def search(self, query: str, top_n: int = 5) -> List[str]:
+        """
+        Searches the corpus for the most relevant documents to the query.
+
+        Parameters:
+            query (str): The search query as a string.
+            top_n (int): Number of top relevant documents to return (default is 5).
+
+        Returns:
+            List[str]: A list of top N relevant documents.
+        """
+        corpus = self.corpus
+        if corpus is None:
+            raise ValueError("The model has no document texts; use search_unique_ids and resolve the ids instead")
+        doc_ids, _ = self.search_ids(query, top_n=top_n)
+        return [corpus[doc_id] for doc_id in doc_ids]
+
+    def search_ids(self, query: str, top_n: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the corpus and returns global document ids instead of the document text.
+
+        Parameters:
+            query (str): The search query as a string.
+            top_n (int): Number of top relevant documents to return (default is 5).
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The ids of the top N documents and their BM25 scores, best first.
+        """
+        return self._search([self.preprocess(query)], top_n)[0]
+
+    def search_unique_ids(self, query: str, top_n: int = 5) -> List[str]:
+        """
+        Searches the corpus and returns the external ids (e.g. uniqueId) of the top documents.
+
+        Parameters:
+            query (str): The search query as a string.
+            top_n (int): Number of top relevant documents to return (default is 5).
+
+        Returns:
+            List[str]: The external ids of the top N documents.
+        """
+        doc_ids, _ = self.search_ids(query, top_n=top_n)
+        ids = self.ids
+        return [ids[doc_id] for doc_id in doc_ids]
+
+    def search_many(self, queries: List[str], top_n: int = 5) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Searches the corpus for many queries at once; every shard scores the whole batch.
+
+        Parameters:
+            queries (List[str]): The search queries as strings.
+            top_n (int): Number of top relevant documents to return per query (default is 5).
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: Per query, the ids of the top N documents and their BM25 scores.
+        """
+        return self._search([self.preprocess(query) for query in queries], top_n)
+
+    def add_document(self, document: str, unique_id: Optional[str] = None) -> int:
+        """
+        Adds a new document (see add_documents).
+
+        Returns:
+            int: The global id of the new document.
+        """
+        return self.add_documents([document], ids=None if unique_id is None else [unique_id])[0]
+
+    def add_documents(self, documents: List[str], ids: Optional[List[str]] = None) -> List[int]:
+        """
+        Adds new documents. They fill up the last shard in place, and the rest are built into new shards
+        of shard_size documents in parallel. The collection statistics are merged again afterwards.
+
+        Parameters:
+            documents (List[str]): The new documents as strings.
+            ids (List[str], optional): The external ids of the new documents, required if the model has ids.
+
+        Returns:
+            List[int]: The global ids of the new documents.
+        """
+        if self.shards and (ids is None) != (self.shards[0].ids is None):
+            raise ValueError("External ids must be given for every document of the model or for none")
+        if ids is not None and len(ids) != len(documents):
+            raise ValueError(f"Got {len(ids)} ids for {len(documents)} documents")
+        start = int(self._offsets[-1])
+        room = self.shard_size - len(self.shards[-1]) if self.shards else 0
+        if room > 0 and documents:
+            self.shards[-1].add_documents(documents[:room], ids=None if ids is None else ids[:room])
+            self._dirty.add(len(self.shards) - 1)
+            documents = documents[room:]
+            ids = None if ids is None else ids[room:]
+        if documents:
+            # The new shard files are written right away, but only listed in the manifest by the next save
+            # New shards keep texts if the existing ones do
+            self._add_shards(documents, ids, keep_texts=not self.shards or self.shards[0].corpus is not None)
+        self._unsaved = True
+        self._refresh()
+        return list(range(start, int(self._offsets[-1])))
+
+    def remove_document(self, doc_id: int, document: Optional[str] = None):
+        """
+        Removes a document. Ids of other documents do not change.
+
+        Parameters:
+            doc_id (int): The global id of the document, as returned by search_ids or add_documents.
+            document (str, optional): The text the document was indexed with; required if the model
+                has no document texts.
+        """
+        number = int(np.searchsorted(self._offsets, doc_id, side='right')) - 1
+        if not 0 <= number < len(self.shards):
+            raise KeyError(f"Document {doc_id} is not in the index")
+        self.shards[number].remove_document(doc_id - int(self._offsets[number]), document)
+        self._dirty.add(number)
+        self._unsaved = True
+        self._refresh()
+
+    def save_model(self, filepath: Optional[str] = None):
+        """
+        Saves the changed shards and then the manifest, which is replaced atomically. Saving to another
+        path writes every shard there.
+
+        Parameters:
+            filepath (Optional[str]): Path of the manifest (default is the path the model was built or loaded from).
+        """
+        filepath = filepath or self.filepath
+        if filepath != self.filepath:
+            changed = range(len(self.shards))
+        else:
+            changed = sorted(self._dirty)
+        for number in changed:
+            self.shards[number].save_model(_shard_path(filepath, number))
+        self._write_manifest(filepath)
+        self.filepath = filepath
+        self._dirty.clear()
+        self._unsaved = False
+        # Query workers mapped the previous files
+        self.close()
+        logger.info("Sharded model saved to %s (%d shards, %d rewritten)", filepath, len(self.shards), len(changed))
+
+
+def load_bm25(filepath: str, preprocess_func=None, processes: Optional[int] = None) -> Union[BM25, ShardedBM25]:
+    """
+    Loads the BM25 model at filepath, whether it is a single model file or the manifest of a sharded one.
+
+    Parameters:
+        filepath (str): Path of the model file or manifest.
+        preprocess_func (callable, optional): The preprocessing function the model was built with.
+        processes (Optional[int]): Worker processes of a sharded model (default is None).
+    """
+    with open(filepath, 'rb') as file:
+        magic = file.read(len(MAGIC))
+    if magic == MAGIC:
+        return ShardedBM25.load_model(filepath, preprocess_func, processes=processes)
+    return BM25.load_model(filepath, preprocess_func)
@@ -0,0 +1,220 @@
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from mmap_store import MappedTexts, pack_strings, read_sections, write_sections
+from rerank_cache import document_hash
+
+MAGIC = b'COLBERT\x00'
+# Version 2 stores the hash of the text every document was encoded from
+FORMAT_VERSION = 2
+
+
+def _check_colbert(ranker):
+    if not all(hasattr(ranker, name) for name in ('_query_encode', '_document_encode', '_to_embs')):
+        raise TypeError(f"{type(ranker).__name__} is not a ColBERT ranker; token embeddings are not available")
+
+
+def encode_query(ranker, query: str):
+    """
+    Encodes a query with a rerankers ColBERTRanker.
+
+    Returns:
+        Tuple[np.ndarray, int]: The (query tokens x dim) embeddings, including the [MASK] augmentation
+        tokens, and the number of real query tokens that the MaxSim sum is divided by.
+    """
+    _check_colbert(ranker)
+    encoding = ranker._query_encode([query])
+    embeddings = ranker._to_embs(encoding)[0].float().cpu().numpy()
+    return embeddings, int(encoding["attention_mask"].sum())
+
+
+def encode_documents(ranker, texts: List[str], batch_size: int = 32) -> Iterable[np.ndarray]:
+    """
+    Encodes documents with a rerankers ColBERTRanker and yields the (tokens x dim) embeddings of
+    every document, without the padding tokens.
+    """
+    _check_colbert(ranker)
+    for start in range(0, len(texts), batch_size):
+        encoding = ranker._document_encode(texts[start:start + batch_size])
+        embeddings = ranker._to_embs(encoding).float().cpu().numpy()
+        mask = encoding["attention_mask"].cpu().numpy().astype(bool)
+        for document_embeddings, document_mask in zip(embeddings, mask):
+            yield document_embeddings[document_mask]
+
+
+def maxsim(query_embeddings: np.ndarray, query_length: int, document_embeddings: List[np.ndarray]) -> np.ndarray:
+    """
+    ColBERT late-interaction score of one query against several documents: for every query token the
+    best matching document token, summed and divided by the number of real query tokens.
+
+    Parameters:
+        query_embeddings (np.ndarray): The (query tokens x dim) query embeddings from encode_query.
+        query_length (int): The number of real query tokens from encode_query.
+        document_embeddings (List[np.ndarray]): The (tokens x dim) embeddings of every document.
+
+    Returns:
+        np.ndarray: The score of every document.
+    """
+    lengths = np.array([len(rows) for rows in document_embeddings], dtype=np.int64)
+    # (query tokens x all candidate tokens) similarities, then the max over each document's segment
+    similarities = query_embeddings @ np.concatenate(document_embeddings).astype(np.float32).T
+    segment_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.maximum.reduceat(similarities, segment_starts, axis=1).sum(axis=0) / query_length
+
+
+class ColBERTDocumentIndex:
+    def __init__(self, model_name: str, ids: Optional[List[str]] = None, offsets: Optional[np.ndarray] = None,
+                 embeddings: Optional[np.ndarray] = None, hashes: Optional[List[str]] = None):
+        """
+        Precomputed per-token ColBERT embeddings of the corpus documents, for late-interaction reranking.
+
+        The token embeddings of all documents are stacked in one float16 matrix; the rows of document
+        ``i`` are ``embeddings[offsets[i]:offsets[i + 1]]``. At query time only the query is encoded
+        and MaxSim runs against the stored rows, so candidates are never re-encoded. Every document
+        keeps the hash of the text it was encoded from, so a document whose text changed under the
+        same id is re-encoded instead of being scored against its old embeddings.
+
+        Parameters:
+            model_name (str): Name of the model that produced the embeddings.
+            ids (Optional[List[str]]): External id (uniqueId) of every document.
+            offsets (Optional[np.ndarray]): Row offsets of every document, one more entry than documents.
+            embeddings (Optional[np.ndarray]): The stacked (total tokens x dim) token embeddings.
+            hashes (Optional[List[str]]): The document_hash of the text of every document; None for
+                documents of version 1 files, whose text is unknown.
+        """
+        self.model_name = model_name
+        self.ids = list(ids) if ids is not None else []
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.embeddings = embeddings
+        self.hashes = list(hashes) if hashes is not None else [None] * len(self.ids)
+        self._rows = {unique_id: row for row, unique_id in enumerate(self.ids)}
+
+    def __contains__(self, unique_id) -> bool:
+        return unique_id in self._rows
+
+    def has_document(self, unique_id, text: str) -> bool:
+        """Whether the stored embeddings of unique_id were encoded from this text."""
+        row = self._rows.get(unique_id)
+        return row is not None and self.hashes[row] == document_hash(text)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add_documents(self, ranker, ids: List[str], texts: List[str], batch_size: int = 32) -> int:
+        """
+        Encodes and stores the documents whose id is not in the index yet, and re-encodes the stored
+        documents whose text changed since they were encoded.
+
+        Parameters:
+            ranker: The rerankers ColBERTRanker to encode with (Reranking.ranker).
+            ids (List[str]): External ids of the documents.
+            texts (List[str]): The document texts, as given to the reranker.
+            batch_size (int): Number of documents encoded per forward pass (default is 32).
+
+        Returns:
+            int: Number of documents added or re-encoded.
+        """
+        pending = {}  # unique_id -> (text, hash), each id once
+        for unique_id, text in zip(ids, texts):
+            text_hash = document_hash(text)
+            row = self._rows.get(unique_id)
+            if row is None or self.hashes[row] != text_hash:
+                pending[unique_id] = (text, text_hash)
+        if not pending:
+            return 0
+        encoded = dict(zip(pending, encode_documents(ranker, [text for text, _ in pending.values()],
+                                                     batch_size=batch_size)))
+        if not isinstance(self.ids, list):  # ids and hashes mapped from a file
+            self.ids = list(self.ids)
+        if not isinstance(self.hashes, list):
+            self.hashes = list(self.hashes)
+
+        changed = {self._rows[unique_id]: encoded.pop(unique_id) for unique_id in list(encoded)
+                   if unique_id in self._rows}
+        if changed:
+            # Restack with the new rows of the changed documents; their token counts may differ
+            self._restack(changed)
+            for row in changed:
+                self.hashes[row] = pending[self.ids[row]][1]
+        if encoded:
+            new_embeddings = list(encoded.values())
+            stacked = np.concatenate(new_embeddings).astype(np.float16)
+            lengths = np.array([len(rows) for rows in new_embeddings], dtype=np.int64)
+            self.embeddings = stacked if self.embeddings is None else np.concatenate([self.embeddings, stacked])
+            self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+            for unique_id in encoded:
+                self._rows[unique_id] = len(self.ids)
+                self.ids.append(unique_id)
+                self.hashes.append(pending[unique_id][1])
+        return len(pending)
+
+    def _restack(self, replaced: dict):
+        rows = [replaced[row] if row in replaced else self.embeddings[self.offsets[row]:self.offsets[row + 1]]
+                for row in range(len(self.ids))]
+        lengths = np.array([len(document_rows) for document_rows in rows], dtype=np.int64)
+        self.embeddings = np.concatenate(rows).astype(np.float16)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    def score(self, ranker, query: str, ids: List[str]) -> np.ndarray:
+        """
+        Computes the ColBERT MaxSim score of the query against stored documents.
+
+        Parameters:
+            ranker: The rerankers ColBERTRanker that encoded the documents (Reranking.ranker).
+            query (str): The query string.
+            ids (List[str]): External ids of the documents to score; all must be in the index.
+
+        Returns:
+            np.ndarray: The score of every document, in the order of ids.
+        """
+        query_embeddings, query_length = encode_query(ranker, query)
+        return maxsim(query_embeddings, query_length, [self.document_embeddings(unique_id) for unique_id in ids])
+
+    def document_embeddings(self, unique_id) -> np.ndarray:
+        """
+        Returns the stored (tokens x dim) embeddings of a document.
+        """
+        row = self._rows[unique_id]
+        return self.embeddings[self.offsets[row]:self.offsets[row + 1]]
+
+    def save(self, filepath: str):
+        """
+        Writes the index to a file that open can mmap.
+
+        Parameters:
+            filepath (str): Path of the file.
+        """
+        id_offsets, id_blob = pack_strings(self.ids)
+        # Documents of a version 1 file that were never re-encoded keep an empty hash, which matches no text
+        hash_offsets, hash_blob = pack_strings([text_hash or '' for text_hash in self.hashes])
+        embeddings = self.embeddings if self.embeddings is not None else np.zeros((0, 0), dtype=np.float16)
+        write_sections(filepath, MAGIC, FORMAT_VERSION, {'model_name': self.model_name}, {
+            'offsets': self.offsets,
+            'embeddings': embeddings,
+            'id_offsets': id_offsets,
+            'ids': id_blob,
+            'hash_offsets': hash_offsets,
+            'hashes': hash_blob,
+        })
+
+    @classmethod
+    def open(cls, filepath: str) -> 'ColBERTDocumentIndex':
+        """
+        Opens an index written by save. The embeddings stay memory-mapped and shared between processes.
+        Version 1 files have no text hashes; add_documents re-encodes their documents.
+
+        Parameters:
+            filepath (str): Path of the file.
+
+        Returns:
+            ColBERTDocumentIndex: The index.
+        """
+        version, metadata, arrays = read_sections(filepath, MAGIC, (1, FORMAT_VERSION))
+        ids = MappedTexts(arrays['id_offsets'], arrays['ids'])
+        index = cls(metadata['model_name'], offsets=arrays['offsets'],
+                    embeddings=arrays['embeddings'] if len(arrays['embeddings']) else None)
+        index.ids = ids
+        index.hashes = MappedTexts(arrays['hash_offsets'], arrays['hashes']) if version >= 2 else [None] * len(ids)
+        index._rows = {unique_id: row for row, unique_id in enumerate(ids)}
+        return index
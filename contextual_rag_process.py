@@ -1,16 +1,29 @@
+import itertools
 import json
+import logging
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from langchain_core.messages import HumanMessage
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 
+import tracing
+from llm_cache import LLMResponseCache
+from llm_client import record_usage
+from refactoring_reader import iter_commits, iter_refactorings, write_commits
+
+logger = logging.getLogger(__name__)
+
 # OpenAI API key
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 # 创建一个LangChain模型
 llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=OPENAI_API_KEY)
 
+# 已经生成过的 context description 直接使用缓存（temperature=0，结果可复用）
+llm_cache = LLMResponseCache('data/cache/llm_responses.sqlite')
+
 # Load JSON data from the specified file path
 def load_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -47,51 +60,99 @@ def generate_context_description(refactoring):
 
     return context_description
 
+# Load the descriptions written by earlier runs from the JSONL checkpoint
+def load_checkpoint(checkpoint_path):
+    descriptions = {}
+    if not os.path.exists(checkpoint_path):
+        return descriptions
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 进程中断时最后一行可能只写了一半，忽略即可，下次会重新生成
+                continue
+            descriptions[entry['uniqueId']] = entry['contextDescription']
+    return descriptions
+
+# Generate the context description of one refactoring with the LLM
+def describe_refactoring(refactoring, prompt_template):
+    # Generate and print the context description
+    context_description = generate_context_description(refactoring)
+    source_code_content = refactoring.get('sourceCodeBeforeRefactoring', '')
+    prompt = PromptTemplate(
+        input_variables=["WHOLE_CONTEXT", "SOURCE_CODE"],
+        template=prompt_template,
+    )
+    logger.debug("Context Description:\n%s\n", context_description)
+
+    # Generate the final prompt
+    final_prompt = prompt.format(
+        WHOLE_CONTEXT=context_description.strip(),
+        SOURCE_CODE=source_code_content.strip(),
+    )
+
+    logger.debug("Final prompt:\n%s", final_prompt)
+    # Call the LLM to generate the refactored code
+    messages = [HumanMessage(content=final_prompt)]
+
+    def call():
+        message = llm.invoke(messages)
+        record_usage(llm.model_name, getattr(message, 'usage_metadata', None))
+        return message.content
+
+    with tracing.span("context_description", unique_id=refactoring.get('uniqueId')):
+        result = llm_cache.cached(llm.model_name, llm.temperature, [{"role": "user", "content": final_prompt}], call)
+    logger.debug("Result:\n%s", result)
+    return result
+
 # Process commits with filtering and limit on the number of refactorings
-def process_commits(file_path, prompt_file_path, output_file_path, limit=None):
-    data = load_json(file_path)
-    commits = data.get("commits", [])
-    count = 0  # Track the number of processed refactorings
+def process_commits(file_path, prompt_file_path, output_file_path, limit=None, workers=4, checkpoint_path=None):
+    # 每生成一个描述就追加到 JSONL checkpoint；重新运行时跳过 checkpoint 中已有的 uniqueId，
+    # 全部完成后再合并写回输出 JSON。workers 控制同时进行的 LLM 调用数
+    checkpoint_path = checkpoint_path or output_file_path + '.checkpoint.jsonl'
+    descriptions = load_checkpoint(checkpoint_path)
     prompt_template = load_prompt_template(prompt_file_path)
 
-    for commit in commits:
-        for refactoring in commit.get('refactorings', []):
-            # Filter only pure refactorings
-            if not refactoring.get('isPureRefactoring', False):
-                continue
-
-            # Generate and print the context description
-            context_description = generate_context_description(refactoring)
-            source_code_content = refactoring.get('sourceCodeBeforeRefactoring', '')
-            prompt = PromptTemplate(
-                input_variables=["WHOLE_CONTEXT", "SOURCE_CODE"],
-                template=prompt_template,
-            )
-            print(f"Context Description:\n{context_description}\n")
-
-            # Generate the final prompt
-            final_prompt = prompt.format(
-                WHOLE_CONTEXT=context_description.strip(),
-                SOURCE_CODE=source_code_content.strip(),
-            )
-
-            print(final_prompt)
-            # Call the LLM to generate the refactored code
-            messages = [HumanMessage(content=final_prompt)]
-            result = llm.invoke(messages).content
-            print(result)
-            refactoring['contextDescription'] = result
-
-            # Increment the counter and stop if the limit is reached
-            count += 1
-            # if limit and count >= limit:
-            #     print(f"Processed {count} refactorings (limit reached).")
-            #     save_json(output_file_path, data)  # Save the updated data to the new file
-            #     return
-    save_json(output_file_path, data)
-    print(f"Processed {count} refactorings.")
+    count = 0  # Track the number of processed refactorings
+    # Filter only pure refactorings, each uniqueId once, streamed one commit at a time
+    # limit=None processes every refactoring, limit=0 none
+    refactorings = itertools.islice(iter_refactorings(file_path, pure_only=True, dedup=True), limit)
+    pending = (refactoring for refactoring in refactorings if refactoring['uniqueId'] not in descriptions)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        in_flight = {}
+        for refactoring in itertools.chain(pending, [None]):
+            if refactoring is not None:
+                in_flight[executor.submit(describe_refactoring, refactoring, prompt_template)] = refactoring['uniqueId']
+            # 在途任务数有上限；输入读完后等待全部完成
+            while in_flight and (refactoring is None or len(in_flight) >= 2 * workers):
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    unique_id = in_flight.pop(future)
+                    descriptions[unique_id] = future.result()
+                    checkpoint.write(json.dumps({"uniqueId": unique_id, "contextDescription": descriptions[unique_id]},
+                                                ensure_ascii=False) + '\n')
+                    checkpoint.flush()
+                    count += 1
+
+    # Merge the descriptions into the data and save it, streaming the input again;
+    # top-level keys other than "commits" are copied to the output
+    fields = {}
+
+    def described_commits():
+        for commit in iter_commits(file_path, fields=fields):
+            for refactoring in commit.get('refactorings', []):
+                if refactoring.get('isPureRefactoring', False) and refactoring.get('uniqueId') in descriptions:
+                    refactoring['contextDescription'] = descriptions[refactoring['uniqueId']]
+            yield commit
+
+    write_commits(output_file_path, described_commits(), fields=fields)
+    logger.info("Processed %d refactorings.", count)
+    logger.info("LLM response cache: %s", llm_cache.stats())
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     input_json_path = 'data/refactoring_info/refactoring_miner_em_refactoring_w_sc_v2.json'  # Path to the input JSON file
     output_json_path = 'data/refactoring_info/refactoring_miner_em_refactoring_context_w_sc_v2.json'  # Path for the output JSON file
     prompt_file_path = 'data/prompts/context_refactoring_prompt.txt'  # Path to the prompt file
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+import tracing
+
+# SQLite limits the number of bound parameters per statement
+_MAX_KEYS_PER_QUERY = 500
+
+
+def text_hash(text: str) -> bytes:
+    """Returns the cache key of a document or query text."""
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, filepath: str, max_entries: int = 500000):
+        """
+        Persistent content-addressed cache of embeddings keyed by (model id, hash of the text), stored in
+        SQLite with every vector as a raw float32 blob.
+
+        Re-indexing unchanged documents or repeating evaluation queries then reuses the stored vectors.
+        When the cache grows past max_entries the least recently used entries are evicted. The number of
+        entries is counted once when the cache is opened and kept up to date by put_many.
+
+        Parameters:
+            filepath (str): Path of the SQLite database; created if it does not exist.
+            max_entries (int): Maximum number of cached vectors (default is 500000).
+        """
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, text_hash BLOB NOT NULL, "
+            "vector BLOB NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (model, text_hash)) WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self._size = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Looks up the cached embeddings of texts.
+
+        Parameters:
+            model (str): Id of the embedding model.
+            texts (List[str]): The texts.
+
+        Returns:
+            List[Optional[np.ndarray]]: The cached vector of every text, or None where it is not cached.
+        """
+        keys = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _MAX_KEYS_PER_QUERY):
+                chunk = keys[start:start + _MAX_KEYS_PER_QUERY]
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({', '.join('?' * len(chunk))})",
+                    [model, *chunk],
+                )
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._connection.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                                             [(now, model, key) for key in found])
+                self._connection.commit()
+            vectors = [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        tracing.count('cache_hits_total', hits, cache='embedding')
+        tracing.count('cache_misses_total', len(vectors) - hits, cache='embedding')
+        return vectors
+
+    def put_many(self, model: str, texts: List[str], embeddings):
+        """
+        Stores embeddings, then evicts the least recently used entries beyond max_entries.
+
+        Parameters:
+            model (str): Id of the embedding model.
+            texts (List[str]): The texts.
+            embeddings: The vector of every text.
+        """
+        now = time.time()
+        # One row per text; a text given twice keeps its last vector
+        rows = {text_hash(text): np.asarray(vector, dtype=np.float32).tobytes()
+                for text, vector in zip(texts, embeddings)}
+        keys = list(rows)
+        with self._lock:
+            # Only the keys of this batch are looked up, so the entry count stays exact without a table scan
+            existing = 0
+            for start in range(0, len(keys), _MAX_KEYS_PER_QUERY):
+                chunk = keys[start:start + _MAX_KEYS_PER_QUERY]
+                existing += self._connection.execute(
+                    f"SELECT COUNT(*) FROM embeddings WHERE model = ? AND text_hash IN ({', '.join('?' * len(chunk))})",
+                    [model, *chunk],
+                ).fetchone()[0]
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                                         [(model, key, vector, now) for key, vector in rows.items()])
+            self._size += len(rows) - existing
+            if self._size > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE (model, text_hash) IN "
+                    "(SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (self._size - self.max_entries,),
+                )
+                self._size = self.max_entries
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddingFunction:
+    def __init__(self, embedding_function, cache: EmbeddingCache, model_id: Optional[str] = None):
+        """
+        Wraps an embedding function (e.g. Chroma's DefaultEmbeddingFunction) so that only texts missing
+        from the cache are embedded.
+
+        Parameters:
+            embedding_function: Callable mapping a list of texts to a list of vectors.
+            cache (EmbeddingCache): The cache.
+            model_id (Optional[str]): Id of the model in the cache (default is the function's
+                MODEL_NAME, or its class name).
+        """
+        self.embedding_function = embedding_function
+        self.cache = cache
+        self.model_id = model_id or getattr(embedding_function, 'MODEL_NAME', type(embedding_function).__name__)
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        texts = list(input)
+        vectors = self.cache.get_many(self.model_id, texts)
+        missing = [position for position, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Texts repeated within the call are embedded once
+            unique_texts = list(dict.fromkeys(texts[position] for position in missing))
+            embedded = dict(zip(unique_texts, (np.asarray(vector, dtype=np.float32) for vector in
+                                               self.embedding_function(unique_texts))))
+            self.cache.put_many(self.model_id, unique_texts, [embedded[text] for text in unique_texts])
+            for position in missing:
+                vectors[position] = embedded[texts[position]]
+        return vectors
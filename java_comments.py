@@ -0,0 +1,89 @@
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+# One left-to-right scan over the source. Literals are matched as whole tokens, so comment markers
+# inside them are never seen; only the comment alternatives are removed. Every alternative starts with
+# a literal character, which lets the regex engine skip straight to the next quote or slash.
+_TOKENS = re.compile(r'''
+    """(?:[^\\]|\\[\s\S])*?"""            # Java 15 text block
+  | "[^"\\\n]*(?:\\.[^"\\\n]*)*"          # string literal
+  | '[^'\\\n]*(?:\\.[^'\\\n]*)*'          # char literal
+  | //[^\n]*                              # line comment, up to (not including) the newline
+  | /\*[\s\S]*?(?:\*/|\Z)                 # block and Javadoc comment, or an unterminated one
+''', re.VERBOSE)
+
+# Fan out to a process pool only when there is enough work to pay for starting it
+_MIN_PARALLEL_SOURCES = 256
+
+# Stripped sources keyed by content; the oldest entries are dropped first once it is full.
+# Callers strip from several threads (pipeline stages), so lookups and eviction hold the lock
+_MEMO_SIZE = 65536
+_memo: Dict[str, str] = {}
+_memo_lock = threading.Lock()
+
+
+def _replace(match: re.Match) -> str:
+    token = match.group()
+    return '' if token[0] == '/' else token
+
+
+def _remember(source: str, stripped: str):
+    with _memo_lock:
+        if source not in _memo and len(_memo) >= _MEMO_SIZE:
+            del _memo[next(iter(_memo))]
+        _memo[source] = stripped
+
+
+def strip_comments(source: str) -> str:
+    """
+    Removes the comments from Java source code in a single pass, leaving string literals, char literals
+    and text blocks that contain // or /* untouched. Results are memoized by content.
+
+    Parameters:
+        source (str): The Java source code.
+
+    Returns:
+        str: The source without comments; newlines ending line comments are kept.
+    """
+    with _memo_lock:
+        stripped = _memo.get(source)
+    if stripped is None:
+        stripped = _strip(source)
+        _remember(source, stripped)
+    return stripped
+
+
+def strip_many(sources: Iterable[str], processes: Optional[int] = None, chunksize: int = 64) -> List[str]:
+    """
+    Removes the comments from many sources. Repeated sources and sources seen before in this process
+    are stripped once; the rest are spread over a process pool when there are many of them.
+
+    Parameters:
+        sources (Iterable[str]): The Java sources.
+        processes (Optional[int]): Worker processes; None or 1 strips in this process (default is None).
+        chunksize (int): Sources sent to a worker at a time (default is 64).
+
+    Returns:
+        List[str]: The stripped sources, in input order.
+    """
+    sources = list(sources)
+    with _memo_lock:
+        stripped = {source: _memo[source] for source in sources if source in _memo}
+    missing = [source for source in dict.fromkeys(sources) if source not in stripped]
+    if processes and processes > 1 and len(missing) >= _MIN_PARALLEL_SOURCES:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            stripped.update(zip(missing, executor.map(_strip, missing, chunksize=chunksize)))
+    else:
+        stripped.update((source, _strip(source)) for source in missing)
+    for source in missing:
+        _remember(source, stripped[source])
+    return [stripped[source] for source in sources]
+
+
+def _strip(source: str) -> str:
+    # Without a slash there is no comment to remove
+    if '/' not in source:
+        return source
+    return _TOKENS.sub(_replace, source)
@@ -1,17 +1,30 @@
+import asyncio
 import json
+import logging
 import os
+from collections import deque
 from langchain.prompts import PromptTemplate
 from langchain_core.messages import HumanMessage
 from langchain_openai import ChatOpenAI
 from openai import OpenAI
 
-from bm25 import BM25
-from rag_embedding import search_chroma, remove_java_comments
-from reciprocal_rank_fusion import ReciprocalRankFusion
-from refactoring_entity import RefactoringRepository
-from reranking import Reranking
+import tracing
+from bm25_shards import ShardedBM25, load_bm25
+from colbert_index import ColBERTDocumentIndex
+from llm_cache import LLMResponseCache
+from llm_client import AsyncLLMClient, record_usage
+from pipeline import Pipeline, Stage
+from refactoring_reader import iter_commits
+from rag_embedding import get_vector_store, search_chroma_many
+from refactoring_entity import RefactoringRepository, RefactoringStore
+from rerank_cache import RerankScoreCache
+from retrieval import RETRIEVAL_PARAMS, HybridRetriever, format_historical_refactorings, reranker_function
+from retrieval_cache import RetrievalCache, index_version
+from reranking import get_reranker
 from util import project_name
 
+logger = logging.getLogger(__name__)
+
 # OpenAI API key
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
@@ -20,39 +33,30 @@ llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, openai_api_key=OPENAI_API_K
 
 client = OpenAI()
 
-# 调用 search_chroma 获取历史重构例子
-def get_historical_refactorings(search_text, refactoring_map, bm25_model):
-    # get embedding search result
-    embedding_result = search_chroma(search_text, n_results=10, collection_name='refactoring_miner_em_wc_context_collection')
-    embedding_document = embedding_result['documents'][0]
-    # get BM25 search result
-    bm25_document = bm25_model.search(search_text, top_n=10)
-    # reciprocal rank fusion
-    ranked_lists = [embedding_document, bm25_document]
-    rrf = ReciprocalRankFusion(k=60)
-
-    scores = rrf.fuse(ranked_lists)
-    print("RRF Scores:", scores)
-
-    # Get the top 10 documents
-    top_docs = rrf.get_top_n(scores, n=10)
-    print("Top 10 Documents:", top_docs)
-
-    top_docs_text = [doc[0] for doc in top_docs]
-    # Reranking the top 10 documents
-    reranker = Reranking("colbert")
-    query = search_text
-    ranked_results = reranker.rerank(query, top_docs_text)
-    top_ranked_result = ranked_results.top_k(3)
-    metadata_refactoring = []
-    for result in top_ranked_result:
-        print(f"Rank: {result.rank}, Score: {result.score}, Document: {result.document.text}")
-        metadata_refactoring.append(refactoring_map[result.document.text])
-    search_result = "\n".join([
-        f"Example {i + 1}:\n SourceCodeBeforeRefactoring:\n {example['sourceCodeBeforeRefactoring']}\n SourceCodeAfterRefactoring:\n{example['sourceCodeAfterRefactoring']}\n DiffSourceCode:\n{example['diffSourceCode']}\n"
-        for i, example in enumerate(metadata_refactoring)
-    ])
-    return search_result
+# 相同 (模型, temperature=0, 消息) 的 LLM 请求直接使用上次运行的结果；meta prompt 改写和代码生成都用 temperature=0，
+# 改写结果相同，生成请求的键也相同，所以重新运行时两次调用都不再请求 API
+# 数据库在第一次使用时才打开，导入模块不会创建文件
+llm_cache = LLMResponseCache('data/cache/llm_responses.sqlite')
+
+# 流水线模式下每个阶段的默认线程数：rerank 本身按模型串行，LLM 调用是网络 I/O
+DEFAULT_STAGE_WORKERS = {"retrieval": 1, "prompt": 1, "meta_prompt": 4, "generation": 4}
+
+# 各阶段之间只传递 uniqueId，文本只在 rerank 和生成最终 prompt 时获取；检索本身见 retrieval.HybridRetriever
+def get_historical_refactorings(search_text, retriever, retrieval_cache=None):
+    # retrieval_cache 命中时跳过向量检索、BM25、RRF 和 rerank，只重新读取记录生成例子文本
+    top_doc_ids = retrieval_cache.get(search_text, RETRIEVAL_PARAMS) if retrieval_cache is not None else None
+    if top_doc_ids is None:
+        top_doc_ids = retriever.rank(search_text)
+        if retrieval_cache is not None:
+            retrieval_cache.put(search_text, RETRIEVAL_PARAMS, top_doc_ids)
+    return format_historical_refactorings(top_doc_ids, retriever.records)
+
+
+# 向量检索（Chroma 或本地向量库），只返回 uniqueId，不传输文档和 metadata
+def search_vector_store(search_texts, n_results):
+    results = search_chroma_many(search_texts, n_results=n_results, collection_name=RETRIEVAL_PARAMS["collection"],
+                                 include=["distances"])
+    return [result['ids'][0] for result in results]
 
 
 # 从文件中读取 prompt 模板
@@ -99,8 +103,34 @@ def save_refactoring_results(output_file_path, results):
 #     refactored_code = llm.invoke(messages).content
 #     print(refactored_code)
 
+# 选出最新的 num_count 个 pure refactoring：commit 从后往前，commit 内部按原顺序。
+# commits 可以是列表，也可以是 refactoring_reader.iter_commits 的流；只保留最近的、足够凑满 num_count 的 commit
+def select_latest_refactorings(commits, num_count):
+    latest = deque()  # 每个 commit 一组 (commit, pure refactorings)
+    kept = 0
+    for commit in commits:
+        refactorings = [refactoring for refactoring in commit.get('refactorings', []) if refactoring['isPureRefactoring']]
+        if not refactorings:
+            continue
+        latest.append((commit, refactorings))
+        kept += len(refactorings)
+        # 去掉更早的 commit，只要剩下的仍然够 num_count 个
+        while latest and kept - len(latest[0][1]) >= num_count:
+            kept -= len(latest.popleft()[1])
+    selected = []
+    for commit, refactorings in reversed(latest):
+        selected.extend((commit, refactoring) for refactoring in refactorings)
+    return selected[:num_count]
+
+
 # Function to process each commit and refactor the code
-def process_commits(commits, output_file_path, num_count):
+def process_commits(commits, output_file_path, num_count, async_mode=False, max_concurrency=8,
+                    requests_per_minute=None, tokens_per_minute=None, base_url=None, pipelined=False,
+                    stage_workers=None, queue_size=8, bm25_processes=None):
+    # async_mode=True 时并发调用 LLM（并发数、每分钟请求/token 限流、失败重试），结果顺序与输入一致；
+    # base_url 可以指向本地的 OpenAI 兼容 stub 服务用于测试
+    # pipelined=True 时按阶段流水线执行，stage_workers 设置每个阶段的线程数（见 DEFAULT_STAGE_WORKERS）
+    # bm25_processes 设置分片 BM25 索引的查询进程数，各 shard 并发检索后合并 top N
 
     # 1. 任务介绍
     task_description = """
@@ -110,37 +140,84 @@ def process_commits(commits, output_file_path, num_count):
     # 2. 读取文件路径中的prompt模板
     prompt_file_path = 'data/prompts/refactoring_prompt_v2.txt'
     prompt_template = load_prompt_template(prompt_file_path)
-    refactoring_results = []
 
-    refactoring_map = RefactoringRepository.load_from_file("data/refactoring_info/refactoring_map_em_wc_v2.json",
-                                                           format="json")
-
-    bm25_model = BM25.load_model('data/model/refactoring_miner_em_wc_context_collection_bm25result.pkl')
-
-    count = 0
-    commits.reverse()
-    for commit in commits:
+    # refactoring 记录从以 uniqueId 为键的存储中按需读取；旧的 refactoring_map JSON 只在第一次运行时转换一次
+    store_path = 'data/refactoring_info/refactoring_store_em_wc_v2.idx'
+    if not os.path.exists(store_path):
+        refactoring_map = RefactoringRepository.load_from_file("data/refactoring_info/refactoring_map_em_wc_v2.json",
+                                                               format="json")
+        RefactoringStore.write(store_path, refactoring_map.values())
+        del refactoring_map
+    refactoring_records = RefactoringStore.open(store_path)
+
+    bm25_path = 'data/model/refactoring_miner_em_wc_context_collection_bm25result.idx'
+    bm25_model = load_bm25(bm25_path, processes=bm25_processes)
+    if bm25_model.ids is None:
+        # 旧格式的索引没有 uniqueId；不再按文档全文猜测 id，而是要求先从 refactoring 存储重建索引
+        raise ValueError(f"{bm25_path} has no uniqueIds; rebuild it from the refactoring store with "
+                         f"BM25.from_records(RefactoringStore.open({store_path!r})).save_model({bm25_path!r})")
+
+    # Rerank against precomputed ColBERT document embeddings when they were built during ingestion
+    colbert_path = 'data/model/refactoring_miner_em_wc_context_collection_colbert.idx'
+    if os.path.exists(colbert_path):
+        get_reranker("colbert").use_document_index(ColBERTDocumentIndex.open(colbert_path))
+    # Rerank scores of (query, uniqueId) pairs seen in earlier runs are reused
+    get_reranker("colbert").use_score_cache(RerankScoreCache('data/cache/rerank_scores.sqlite'))
+    # 检索结果（top_k 个 uniqueId）按去掉注释和空白的查询代码缓存；任何索引重建后版本改变，旧结果自动失效
+    retrieval_cache = RetrievalCache('data/cache/retrieval_results.sqlite', index_version(
+        [bm25_path, store_path, colbert_path], get_vector_store(RETRIEVAL_PARAMS["collection"]).version()))
+
+    # Select the refactorings to process first, so BM25 and the vector store can search them in batches
+    selected = select_latest_refactorings(commits, num_count)
+    retriever = HybridRetriever(refactoring_records, bm25_model, search_vector_store,
+                                reranker_function(get_reranker(RETRIEVAL_PARAMS["reranker"])))
+
+    META_PROMPT = load_prompt_template('data/prompts/meta_prompt.txt')
+
+    # 每个重构依次经过：检索（RRF + rerank）→ 组装 prompt → meta prompt 改写 → 生成重构代码
+    def retrieve(batch):
+        # 一批重构一起检索：只检索缓存里没有的查询，每个规范化后的查询一次；
+        # BM25、向量检索、RRF 和 rerank 对整批各执行一次
+        search_texts = [refactoring['sourceCodeBeforeRefactoring'] for _, refactoring in batch]
+        cache_keys = [retrieval_cache.key(search_text, RETRIEVAL_PARAMS) for search_text in search_texts]
+        with tracing.span("retrieval", refactorings=len(batch)):
+            missing = {}
+            for cache_key, search_text in zip(cache_keys, search_texts):
+                if cache_key not in missing and retrieval_cache.get(search_text, RETRIEVAL_PARAMS,
+                                                                    record_stats=False) is None:
+                    missing[cache_key] = search_text
+            ranked = dict(zip(missing, retriever.rank_many(list(missing.values()))))
+
+            retrieved = []
+            for (commit, refactoring), search_text, cache_key in zip(batch, search_texts, cache_keys):
+                def rank():
+                    # 上面检查时命中了缓存、但使用前该条目已被淘汰的查询，没有批量检索的结果，这里单独检索
+                    if cache_key not in ranked:
+                        return retriever.rank(search_text)
+                    return list(ranked[cache_key])
+
+                # Get historical refactoring examples; a snippet seen earlier in this run or in an earlier run
+                # is answered from the cache, even when only its comments or whitespace differ
+                top_doc_ids = retrieval_cache.cached(search_text, RETRIEVAL_PARAMS, rank)
+                historical_refactorings = format_historical_refactorings(top_doc_ids, refactoring_records)
+                logger.debug("Historical refactorings:\n%s", historical_refactorings)
+                retrieved.append((commit, refactoring, historical_refactorings))
+        return retrieved
+
+    def assemble_prompt(item):
+        commit, refactoring, historical_refactorings = item
         commitId = commit['commitId']
         branch = commit['branch']
         url = commit['url']
-        if "refactorings" not in commit:
-            continue
-        for refactoring in commit['refactorings']:
-            if count >= num_count:
-                break
-            # Get the source code before refactoring
-            source_code_before_refactoring = refactoring['sourceCodeBeforeRefactoring']
-            source_code_after_refactoring = refactoring['sourceCodeAfterRefactoring']
-            diff_source_code = refactoring['diffSourceCode']
-            if not refactoring['isPureRefactoring']:
-                continue
-            # Get historical refactoring examples
-            historical_refactorings = get_historical_refactorings(source_code_before_refactoring, refactoring_map, bm25_model)
-            print(historical_refactorings)
-
-            context_description = f"PackageName: {refactoring['packageNameBefore']}\nClassName: {refactoring['classNameBefore']}\nMethodName: {refactoring['methodNameBefore']}\n ClassSignature: {refactoring['classSignatureBefore']}\n"
-            if "invokedMethod" in refactoring:
-                context_description += f"InvokedMethod: {refactoring['invokedMethod']}"
+        # Get the source code before refactoring
+        source_code_before_refactoring = refactoring['sourceCodeBeforeRefactoring']
+        source_code_after_refactoring = refactoring['sourceCodeAfterRefactoring']
+        diff_source_code = refactoring['diffSourceCode']
+
+        context_description = f"PackageName: {refactoring['packageNameBefore']}\nClassName: {refactoring['classNameBefore']}\nMethodName: {refactoring['methodNameBefore']}\n ClassSignature: {refactoring['classSignatureBefore']}\n"
+        if "invokedMethod" in refactoring:
+            context_description += f"InvokedMethod: {refactoring['invokedMethod']}"
+        with tracing.span("prompt", unique_id=refactoring['uniqueId']):
             # Create a PromptTemplate instance
             prompt = PromptTemplate(
                 input_variables=["task_description", "historical_refactorings", "code_to_refactor", "context_description"],
@@ -154,66 +231,148 @@ def process_commits(commits, output_file_path, num_count):
                 code_to_refactor=source_code_before_refactoring.strip(),
                 context_description=context_description.strip()
             )
-            print(final_prompt)
-            META_PROMPT = load_prompt_template('data/prompts/meta_prompt.txt')
-            updated_prompt = generate_prompt(final_prompt, META_PROMPT)
-            # Call the LLM to generate the refactored code
-            messages = [HumanMessage(content=updated_prompt)]
-            refactored_code = llm.invoke(messages).content
-            print(refactored_code)
-            # Collect the result for this commit
-            refactoring_results.append({
-                "url": url,
-                "branch": branch,
-                "commitId": commitId,
-                "sourceCodeBeforeRefactoring": source_code_before_refactoring,
-                "refactoredCode": refactored_code,
-                "sourceCodeAfterRefactoring": source_code_after_refactoring,
-                "diffSourceCode": diff_source_code,
-                "uniqueId": refactoring['uniqueId'],
-                "historicalRefactorings": historical_refactorings,
-                "contextDescription": context_description,
-                "prompt": final_prompt,
-                "updatedPrompt": updated_prompt
-            })
-            count += 1
+        logger.debug("Final prompt:\n%s", final_prompt)
+        # Collect the result for this commit; the LLM output is filled in by the next stages
+        return {
+            "url": url,
+            "branch": branch,
+            "commitId": commitId,
+            "sourceCodeBeforeRefactoring": source_code_before_refactoring,
+            "refactoredCode": None,
+            "sourceCodeAfterRefactoring": source_code_after_refactoring,
+            "diffSourceCode": diff_source_code,
+            "uniqueId": refactoring['uniqueId'],
+            "historicalRefactorings": historical_refactorings,
+            "contextDescription": context_description,
+            "prompt": final_prompt,
+            "updatedPrompt": None
+        }
+
+    def rewrite_prompt(result):
+        with tracing.span("meta_prompt", unique_id=result["uniqueId"]):
+            result["updatedPrompt"] = generate_prompt(result["prompt"], META_PROMPT)
+        return result
+
+    def generate(result):
+        # Call the LLM to generate the refactored code
+        messages = [HumanMessage(content=result["updatedPrompt"])]
+
+        def call():
+            message = llm.invoke(messages)
+            record_usage(llm.model_name, getattr(message, 'usage_metadata', None))
+            return message.content
+
+        with tracing.span("generation", unique_id=result["uniqueId"]):
+            result["refactoredCode"] = llm_cache.cached(
+                llm.model_name, llm.temperature, [{"role": "user", "content": result["updatedPrompt"]}], call)
+        logger.debug("Refactored code:\n%s", result["refactoredCode"])
+        return result
+
+    if pipelined:
+        # 检索（CPU）与 LLM 调用（网络 I/O）重叠执行，阶段之间是有界队列，结果顺序与输入一致；
+        # 检索按 queue_size 个重构一批进行，第一批的 LLM 调用在后面的批次检索时就已开始
+        workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+        pipeline = Pipeline([
+            Stage("retrieval", retrieve, workers["retrieval"], batch_size=queue_size),
+            Stage("prompt", assemble_prompt, workers["prompt"]),
+            Stage("meta_prompt", rewrite_prompt, workers["meta_prompt"]),
+            Stage("generation", generate, workers["generation"]),
+        ], queue_size=queue_size)
+        try:
+            refactoring_results = pipeline.run(selected)
+        except Exception:
+            # 某个重构失败后流水线不再开始新的 LLM 调用；已经完成的结果先保存下来再抛出错误
+            save_refactoring_results(output_file_path, pipeline.completed)
+            raise
+        finally:
+            logger.info("%s", pipeline.report())
+    else:
+        refactoring_results = [assemble_prompt(item) for item in retrieve(selected)]
+        # 3. 调用 LLM 改写 prompt 并生成重构代码
+        if async_mode:
+            generated = asyncio.run(generate_refactorings_async(
+                [result["prompt"] for result in refactoring_results], META_PROMPT, max_concurrency=max_concurrency,
+                requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute, base_url=base_url))
+            for result, (updated_prompt, refactored_code) in zip(refactoring_results, generated):
+                result["updatedPrompt"] = updated_prompt
+                result["refactoredCode"] = refactored_code
+        else:
+            for result in refactoring_results:
+                generate(rewrite_prompt(result))
 
     # Save all results to a file
     save_refactoring_results(output_file_path, refactoring_results)
+    logger.info("LLM response cache: %s", llm_cache.stats())
+    logger.info("Retrieval result cache: %s", retrieval_cache.stats())
+    logger.info("Stage timings: %s", tracing.tracer.summary())
+    if isinstance(bm25_model, ShardedBM25):
+        bm25_model.close()
+
+
 
 
 
 
+def build_meta_prompt_messages(task_or_prompt: str, META_PROMPT: str):
+    return [
+        {
+            "role": "system",
+            "content": META_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": "Task, Goal, or Current Prompt:\n" + task_or_prompt,
+        },
+    ]
 
 
 def generate_prompt(task_or_prompt: str, META_PROMPT: str):
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": META_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": "Task, Goal, or Current Prompt:\n" + task_or_prompt,
-            },
-        ],
-    )
-
-    return completion.choices[0].message.content
-
-    return json.loads(completion.choices[0].message.content)
+    messages = build_meta_prompt_messages(task_or_prompt, META_PROMPT)
+
+    def call():
+        completion = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0,
+        )
+        record_usage("gpt-4o-mini", getattr(completion, 'usage', None))
+        return completion.choices[0].message.content
+
+    return llm_cache.cached("gpt-4o-mini", 0, messages, call)
+
+
+async def generate_refactoring_async(final_prompt: str, META_PROMPT: str, llm_client: AsyncLLMClient):
+    # 与同步模式相同的两次调用：meta prompt 改写，再生成代码，都用 temperature=0，与同步模式共用缓存
+    with tracing.span("meta_prompt"):
+        updated_prompt = await llm_client.complete(build_meta_prompt_messages(final_prompt, META_PROMPT), temperature=0)
+    with tracing.span("generation"):
+        refactored_code = await llm_client.complete([{"role": "user", "content": updated_prompt}], temperature=0)
+    logger.debug("Refactored code:\n%s", refactored_code)
+    return updated_prompt, refactored_code
+
+
+async def generate_refactorings_async(final_prompts, META_PROMPT: str, **client_options):
+    llm_client = AsyncLLMClient(model="gpt-4o-mini", api_key=OPENAI_API_KEY, cache=llm_cache, **client_options)
+    try:
+        # gather 按输入顺序返回结果
+        return await asyncio.gather(*(generate_refactoring_async(final_prompt, META_PROMPT, llm_client)
+                                      for final_prompt in final_prompts))
+    finally:
+        await llm_client.close()
+
+
 if __name__ == "__main__":
+    # LOG_LEVEL=DEBUG 打印检索结果、prompt 和生成的代码；RAG_TRACE_FILE 记录每个 span，RAG_METRICS_FILE 写出 Prometheus 指标
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     # project_name = 'gson'
     # Load the JSON data with commits and refactorings
     file_path = 'data/refactoring_info/refactoring_miner_em_refactoring_context_w_sc_v2.json'
-    with open(file_path, 'r') as file:
-        data = json.load(file)
 
-    # Process all commits and save results
+    # Process all commits and save results; commits are streamed from the file one at a time
     output_file_path = 'data/output/refactoring_miner_em_refactoring_context_result_meta_prompt_w_sc_v2.json'
-    process_commits(data['commits'], output_file_path, 10)
+    process_commits(iter_commits(file_path), output_file_path, 10)
+    if os.getenv('RAG_METRICS_FILE'):
+        tracing.tracer.write_prometheus(os.getenv('RAG_METRICS_FILE'))
 
     # Print confirmation
     print(f"Refactored code for all commits saved to {output_file_path}")
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional
+
+import tracing
+
+
+def request_key(model: str, temperature: Optional[float], messages: List[dict]) -> str:
+    """Returns the cache key of a chat request: a hash of the model, the temperature and the full message list."""
+    # 0 and 0.0 are the same request
+    temperature = None if temperature is None else float(temperature)
+    request = json.dumps({"model": model, "temperature": temperature, "messages": messages},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    def __init__(self, filepath: str, max_entries: int = 100000, cache_sampled: bool = False):
+        """
+        Persistent cache of chat completion responses keyed by (model, temperature, message list hash),
+        stored in SQLite.
+
+        Re-running a script then only pays for requests it has not sent before. When the cache grows
+        past max_entries the least recently used responses are evicted. Only requests with temperature
+        0 are cached by default: a sampled response (e.g. at the model default temperature, None) would
+        otherwise be frozen into every later run. The database is opened on first use.
+
+        Parameters:
+            filepath (str): Path of the SQLite database; created if it does not exist.
+            max_entries (int): Maximum number of cached responses (default is 100000).
+            cache_sampled (bool): Also cache requests with a non-zero or default temperature (default is False).
+        """
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.cache_sampled = cache_sampled
+        self._db = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # Called with the lock held
+        if self._db is None:
+            directory = os.path.dirname(self.filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (request_key TEXT PRIMARY KEY, model TEXT NOT NULL, "
+                "response TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._db.commit()
+        return self._db
+
+    def should_cache(self, temperature: Optional[float]) -> bool:
+        """Returns whether responses at this temperature are cached."""
+        return self.cache_sampled or (temperature is not None and float(temperature) == 0)
+
+    def get(self, model: str, temperature: Optional[float], messages: List[dict]) -> Optional[str]:
+        """
+        Returns the cached response of a request, or None.
+        """
+        key = request_key(model, temperature, messages)
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM responses WHERE request_key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                tracing.count('cache_misses_total', cache='llm')
+                return None
+            self.hits += 1
+            tracing.count('cache_hits_total', cache='llm')
+            self._connection.execute("UPDATE responses SET last_used = ? WHERE request_key = ?", (time.time(), key))
+            self._connection.commit()
+        return row[0]
+
+    def put(self, model: str, temperature: Optional[float], messages: List[dict], response: str):
+        """
+        Stores the response of a request, then evicts the least recently used entries beyond max_entries.
+        """
+        key = request_key(model, temperature, messages)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                     (key, model, response, time.time()))
+            excess = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE request_key IN "
+                    "(SELECT request_key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+            self._connection.commit()
+
+    def cached(self, model: str, temperature: Optional[float], messages: List[dict], call: Callable[[], str]) -> str:
+        """
+        Returns the cached response of a request, or runs call to get it and stores the result.
+        Requests that are not cached at their temperature (see should_cache) always run call.
+
+        Parameters:
+            model (str): The chat model.
+            temperature (Optional[float]): The sampling temperature, or None for the model default.
+            messages (List[dict]): The chat messages, as role/content dicts.
+            call (Callable[[], str]): Sends the request and returns the response content.
+
+        Returns:
+            str: The response content.
+        """
+        if not self.should_cache(temperature):
+            return call()
+        response = self.get(model, temperature, messages)
+        if response is None:
+            response = call()
+            self.put(model, temperature, messages, response)
+        return response
+
+    def stats(self) -> dict:
+        """Returns the hits and misses of this process and the number and total size of stored responses."""
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(response)), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,167 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import List, Optional
+
+import tracing
+from llm_cache import LLMResponseCache
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
+
+# Errors worth retrying: throttling, transient network failures and server-side errors
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """Rough token count of a message list (about 4 characters per token), for rate limiting."""
+    return sum(len(message.get("content") or "") for message in messages) // 4 + 4 * len(messages)
+
+
+def record_usage(model: str, usage):
+    """
+    Adds the token usage of one response to the llm_tokens_total counters. Accepts the usage of an
+    OpenAI completion (prompt_tokens/completion_tokens) or the usage_metadata dict of a LangChain
+    message (input_tokens/output_tokens); None is ignored.
+    """
+    if usage is None:
+        return
+    if isinstance(usage, dict):
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    else:
+        input_tokens, output_tokens = usage.prompt_tokens, usage.completion_tokens
+    tracing.count('llm_tokens_total', input_tokens, model=model, direction='in')
+    tracing.count('llm_tokens_total', output_tokens, model=model, direction='out')
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 period: float = 60.0):
+        """
+        Sliding-window limiter for requests and tokens per minute, shared by concurrent coroutines.
+
+        Parameters:
+            requests_per_minute (Optional[int]): Maximum requests started per period (default is unlimited).
+            tokens_per_minute (Optional[int]): Maximum estimated tokens per period (default is unlimited).
+            period (float): Length of the window in seconds (default is 60).
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.period = period
+        self._events = deque()  # (start time, tokens) of the requests in the window
+        self._tokens = 0
+        self._lock = asyncio.Lock()
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        while self._events and self._events[0][0] <= now - self.period:
+            self._tokens -= self._events.popleft()[1]
+        wait = 0.0
+        if self.requests_per_minute and len(self._events) >= self.requests_per_minute:
+            wait = self._events[len(self._events) - self.requests_per_minute][0] + self.period - now
+        if self.tokens_per_minute and self._events and self._tokens + tokens > self.tokens_per_minute:
+            # Wait until enough of the oldest requests leave the window; a request larger than the
+            # whole budget still runs once the window is empty
+            freed = 0
+            for started, event_tokens in self._events:
+                freed += event_tokens
+                if self._tokens - freed + tokens <= self.tokens_per_minute:
+                    break
+            wait = max(wait, started + self.period - now)
+        return wait
+
+    async def acquire(self, tokens: int = 0):
+        """Waits until a request of the given estimated size fits in the window, then records it."""
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+            await asyncio.sleep(wait)
+
+
+class AsyncLLMClient:
+    def __init__(self, model: str = "gpt-4o-mini", max_concurrency: int = 8,
+                 requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 max_retries: int = 5, initial_backoff: float = 1.0, max_backoff: float = 60.0,
+                 base_url: Optional[str] = None, api_key: Optional[str] = None,
+                 cache: Optional[LLMResponseCache] = None):
+        """
+        Asynchronous chat completion client with a concurrency limit, a requests/tokens per minute
+        limiter and retries with exponential backoff.
+
+        base_url points it at any OpenAI-compatible server, e.g. a local stub in tests (the OpenAI
+        client also reads OPENAI_BASE_URL).
+
+        Parameters:
+            model (str): The chat model (default is 'gpt-4o-mini').
+            max_concurrency (int): Maximum number of requests in flight (default is 8).
+            requests_per_minute (Optional[int]): Request rate limit (default is unlimited).
+            tokens_per_minute (Optional[int]): Estimated token rate limit (default is unlimited).
+            max_retries (int): Retries of a failed request before the error is raised (default is 5).
+            initial_backoff (float): Delay before the first retry in seconds, doubled on every retry.
+            max_backoff (float): Upper bound of the delay between retries in seconds.
+            base_url (Optional[str]): Base URL of the API (default is the OpenAI API).
+            api_key (Optional[str]): API key (default is OPENAI_API_KEY).
+            cache (Optional[LLMResponseCache]): Response cache consulted before sending a request, for the
+                temperatures it caches.
+        """
+        self.model = model
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        # Retries are done here, so that they also go through the limiter
+        self._client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None) -> str:
+        """
+        Sends one chat completion request and returns the content of the answer.
+
+        Parameters:
+            messages (List[dict]): The chat messages.
+            temperature (Optional[float]): Sampling temperature (default is the model default).
+
+        Returns:
+            str: The message content of the first choice.
+        """
+        use_cache = self.cache is not None and self.cache.should_cache(temperature)
+        if use_cache:
+            response = self.cache.get(self.model, temperature, messages)
+            if response is not None:
+                return response
+        response = await self._send(messages, temperature)
+        if use_cache:
+            self.cache.put(self.model, temperature, messages, response)
+        return response
+
+    async def _send(self, messages: List[dict], temperature: Optional[float]) -> str:
+        request = {"model": self.model, "messages": messages}
+        if temperature is not None:
+            request["temperature"] = temperature
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._limiter.acquire(estimate_tokens(messages))
+                try:
+                    completion = await self._client.chat.completions.create(**request)
+                    record_usage(self.model, getattr(completion, 'usage', None))
+                    return completion.choices[0].message.content
+                except RETRYABLE_ERRORS as error:
+                    tracing.count('llm_errors_total', model=self.model, error=type(error).__name__)
+                    if attempt == self.max_retries:
+                        raise
+                    # Full jitter keeps concurrent retries from hitting the server in lockstep
+                    backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+                    await asyncio.sleep(random.uniform(0, backoff))
+
+    async def complete_many(self, message_lists: List[List[dict]], temperature: Optional[float] = None) -> List[str]:
+        """
+        Sends many requests concurrently, within the limits, and returns the answers in input order.
+        """
+        return await asyncio.gather(*(self.complete(messages, temperature=temperature) for messages in message_lists))
+
+    async def close(self):
+        await self._client.close()
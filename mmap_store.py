@@ -0,0 +1,131 @@
+import json
+import mmap
+import os
+import struct
+from collections.abc import Sequence
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+# File layout: an 8 byte magic, uint32 format version, uint32 header length, a JSON header describing
+# the sections, then every section as a raw array aligned to 8 bytes.
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 8
+
+
+def pack_strings(strings: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes strings as an int64 offsets table with one more entry than strings plus one UTF-8 blob."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded], dtype=np.int64)
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def write_sections(filepath: str, magic: bytes, version: int, metadata: dict, arrays: Dict[str, np.ndarray]):
+    """
+    Writes named arrays and a JSON metadata dict to a file that read_sections can mmap.
+
+    The file is written next to the target and then renamed over it, so readers never see a
+    partial file and processes that still map the old file keep a consistent view.
+
+    Parameters:
+        filepath (str): Path of the file.
+        magic (bytes): 8 byte file type marker.
+        version (int): Format version of the file type.
+        metadata (dict): JSON-serializable values stored in the header.
+        arrays (Dict[str, np.ndarray]): The sections, written in order.
+    """
+    def header_bytes(sections):
+        return json.dumps(dict(metadata, sections=sections)).encode('utf-8')
+
+    # The section offsets depend on the header length, so lay out once with a rough header and pad it.
+    sections = {name: [0, array.dtype.str, array.shape] for name, array in arrays.items()}
+    header_len = len(header_bytes(sections)) + 32 * len(arrays)
+    offset = _PREAMBLE.size + header_len
+    for name, array in arrays.items():
+        offset += -offset % _ALIGNMENT
+        sections[name][0] = offset
+        offset += array.nbytes
+    header = header_bytes(sections).ljust(header_len)
+
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(_PREAMBLE.pack(magic, version, header_len))
+        file.write(header)
+        for name, array in arrays.items():
+            file.write(b'\x00' * (sections[name][0] - file.tell()))
+            file.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, filepath)
+
+
+def read_sections(filepath: str, magic: bytes, versions: Tuple[int, ...]) -> Tuple[int, dict, Dict[str, np.ndarray]]:
+    """
+    Maps a file written by write_sections and returns its arrays without copying them.
+
+    The file is mapped copy-on-write: processes opening the same file share its pages, and
+    writes to the returned arrays never reach the file.
+
+    Parameters:
+        filepath (str): Path of the file.
+        magic (bytes): Expected 8 byte file type marker.
+        versions (Tuple[int, ...]): Format versions the caller can read.
+
+    Returns:
+        Tuple[int, dict, Dict[str, np.ndarray]]: The format version, the metadata and the arrays.
+    """
+    with open(filepath, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    file_magic, version, header_len = _PREAMBLE.unpack_from(buffer)
+    if file_magic != magic:
+        raise ValueError(f"{filepath} is not a {magic.rstrip(bytes(1)).decode()} file")
+    if version not in versions:
+        raise ValueError(f"{filepath} has format version {version}, expected one of {versions}")
+    metadata = json.loads(buffer[_PREAMBLE.size:_PREAMBLE.size + header_len].decode('utf-8'))
+    arrays = {}
+    for name, (offset, dtype, shape) in metadata.pop('sections').items():
+        shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return version, metadata, arrays
+
+
+class MappedTexts(Sequence):
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray, removed: Iterable[int] = ()):
+        """
+        List-like view of strings stored with pack_strings in a mapped file; strings are decoded on access.
+
+        Strings appended or replaced after loading are kept in memory until the file is written again.
+
+        Parameters:
+            offsets (np.ndarray): Byte offsets of every string in the blob, one more entry than strings.
+            blob (np.ndarray): The concatenated UTF-8 encoded strings.
+            removed (Iterable[int]): Positions of removed entries, which read as None.
+        """
+        self._offsets = offsets
+        self._blob = blob
+        self._base = len(offsets) - 1
+        self._added = []
+        self._overrides = {position: None for position in removed}
+
+    def __len__(self) -> int:
+        return self._base + len(self._added)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if position in self._overrides:
+            return self._overrides[position]
+        if position >= self._base:
+            return self._added[position - self._base]
+        return self._blob[self._offsets[position]:self._offsets[position + 1]].tobytes().decode('utf-8')
+
+    def __setitem__(self, position: int, text: Optional[str]):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        self._overrides[position] = text
+
+    def extend(self, texts: Iterable[str]):
+        self._added.extend(texts)
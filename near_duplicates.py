@@ -0,0 +1,202 @@
+import json
+import os
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from mmap_store import MappedTexts, pack_strings, read_sections, write_sections
+
+MAGIC = b'MINHASHS'
+FORMAT_VERSION = 1
+
+# Identifiers, numbers and single punctuation characters; whitespace and layout are ignored
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+
+# Universal hashing (a * x + b) mod p over 32-bit shingle hashes, with p the first prime above 2^32.
+# a < 2^31 keeps a * x + b below 2^63, so the arithmetic stays exact in uint64.
+_PRIME = np.uint64(4294967311)
+
+
+def shingles(text: str, size: int = 5) -> np.ndarray:
+    """
+    Returns the 32-bit hashes of the distinct token shingles (runs of size consecutive tokens) of a text.
+    A text shorter than one shingle is a single shingle.
+    """
+    tokens = _TOKEN.findall(text)
+    count = max(len(tokens) - size + 1, 1)
+    return np.unique(np.fromiter((zlib.crc32(' '.join(tokens[start:start + size]).encode('utf-8'))
+                                  for start in range(count)), dtype=np.uint64, count=count))
+
+
+def optimal_bands(threshold: float, num_perm: int, recall: float = 0.99) -> Tuple[int, int]:
+    """
+    Picks the number of LSH bands and rows per band. Among the choices under which two documents at the
+    Jaccard threshold share a band with at least the given probability, it takes the one with the least
+    false positive probability mass below the threshold. A missed near duplicate stays in the corpus
+    for good while a false candidate only costs one signature comparison, so recall comes first.
+
+    Parameters:
+        threshold (float): The Jaccard similarity threshold.
+        num_perm (int): Number of MinHash permutations.
+        recall (float): Minimum probability that a pair at the threshold becomes a candidate (default is 0.99).
+            If no choice reaches it, the one with the highest such probability is used.
+
+    Returns:
+        Tuple[int, int]: (bands, rows), with bands * rows <= num_perm.
+    """
+    best, best_key = (1, num_perm), None
+    similarities = np.linspace(0.0, 1.0, 201)
+    step = similarities[1] - similarities[0]
+    below = similarities < threshold
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        # Probability that two documents of a given similarity share at least one band
+        candidate = 1.0 - (1.0 - similarities ** rows) ** bands
+        at_threshold = 1.0 - (1.0 - threshold ** rows) ** bands
+        false_positives = float(candidate[below].sum() * step)
+        key = (0, false_positives) if at_threshold >= recall else (1, -at_threshold)
+        if best_key is None or key < best_key:
+            best, best_key = (bands, rows), key
+    return best
+
+
+class NearDuplicateDetector:
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        """
+        Streaming near-duplicate detector: MinHash signatures over token shingles, indexed with LSH bands.
+
+        Documents are offered one at a time. The first document of a cluster is kept as its representative;
+        a later document whose estimated Jaccard similarity to a kept one reaches the threshold is
+        reported as its duplicate. Only representatives are indexed, so clusters do not chain.
+
+        The signatures of the kept documents can be saved and loaded again (save_signatures,
+        load_signatures), so that documents added by a later run are also compared with those an
+        earlier run already stored.
+
+        Parameters:
+            threshold (float): Minimum estimated Jaccard similarity of a near duplicate (default is 0.9).
+            num_perm (int): Number of MinHash permutations (default is 128).
+            shingle_size (int): Number of tokens per shingle (default is 5).
+            seed (int): Seed of the hash permutations; signatures are comparable only with the same seed.
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, 1 << 31, size=(num_perm, 1), dtype=np.uint64)
+        self._b = generator.integers(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self._buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(self.bands)]
+        self._signatures: Dict[str, np.ndarray] = {}
+        self.clusters: Dict[str, List[Tuple[str, float]]] = {}
+        self.documents = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        """Returns the MinHash signature of a text."""
+        hashes = shingles(text, self.shingle_size)
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, key: str, text: str) -> Optional[str]:
+        """
+        Offers a document to the detector.
+
+        Parameters:
+            key (str): Identifier of the document, e.g. its uniqueId.
+            text (str): The text compared, e.g. the comment-stripped source.
+
+        Returns:
+            Optional[str]: The key of the kept document this one duplicates, or None if it is kept.
+        """
+        if key in self._signatures:
+            # Kept before, e.g. by the run that saved the loaded signatures
+            return None
+        self.documents += 1
+        signature = self.signature(text)
+        band_keys = self._band_keys(signature)
+        candidates = dict.fromkeys(candidate for band, band_key in enumerate(band_keys)
+                                   for candidate in self._buckets[band].get(band_key, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is not None:
+            self.clusters.setdefault(best, []).append((key, best_similarity))
+            return best
+
+        self._keep(key, signature, band_keys)
+        return None
+
+    def _keep(self, key: str, signature: np.ndarray, band_keys: List[bytes]):
+        self._signatures[key] = signature
+        for band, band_key in enumerate(band_keys):
+            self._buckets[band].setdefault(band_key, []).append(key)
+
+    def save_signatures(self, file_path: str):
+        """Writes the keys and signatures of the kept documents to a file for load_signatures."""
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        keys = list(self._signatures)
+        key_offsets, key_blob = pack_strings(keys)
+        signatures = np.array([self._signatures[key] for key in keys], dtype=np.uint64).reshape(-1, self.num_perm)
+        write_sections(file_path, MAGIC, FORMAT_VERSION,
+                       {'num_perm': self.num_perm, 'shingle_size': self.shingle_size, 'seed': self.seed},
+                       {'key_offsets': key_offsets, 'keys': key_blob, 'signatures': signatures})
+
+    def load_signatures(self, file_path: str) -> int:
+        """
+        Indexes the kept documents saved by save_signatures as representatives. The file must have been
+        written with the same num_perm, shingle_size and seed; the threshold may differ.
+
+        Returns:
+            int: Number of loaded documents.
+        """
+        _, header, arrays = read_sections(file_path, MAGIC, (FORMAT_VERSION,))
+        settings = {'num_perm': self.num_perm, 'shingle_size': self.shingle_size, 'seed': self.seed}
+        saved = {name: header[name] for name in settings}
+        if saved != settings:
+            raise ValueError(f"{file_path} was written with {saved}, the detector uses {settings}")
+        keys = MappedTexts(arrays['key_offsets'], arrays['keys'])
+        signatures = np.array(arrays['signatures'])
+        for key, signature in zip(keys, signatures):
+            if key not in self._signatures:
+                self._keep(key, signature, self._band_keys(signature))
+        return len(signatures)
+
+    @property
+    def collapsed(self) -> int:
+        """Number of documents reported as near duplicates so far."""
+        return sum(len(duplicates) for duplicates in self.clusters.values())
+
+    def report(self) -> dict:
+        """Returns the settings, the counts and every collapsed cluster, largest first."""
+        clusters = sorted(self.clusters.items(), key=lambda item: -len(item[1]))
+        return {
+            "threshold": self.threshold,
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "rows": self.rows,
+            "shingle_size": self.shingle_size,
+            "documents": self.documents,
+            "kept": self.documents - self.collapsed,
+            "collapsed": self.collapsed,
+            "clusters": [{"representative": representative,
+                          "duplicates": [{"id": key, "similarity": round(similarity, 4)}
+                                         for key, similarity in duplicates]}
+                         for representative, duplicates in clusters],
+        }
+
+    def save_report(self, file_path: str):
+        """Writes the report as JSON."""
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=4, ensure_ascii=False)
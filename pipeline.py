@@ -0,0 +1,182 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable, workers: int = 1, batch_size: Optional[int] = None):
+        """
+        One step of a Pipeline.
+
+        Parameters:
+            name (str): Name used in the timing report.
+            func (Callable): Function applied to every item; its return value goes to the next stage.
+            workers (int): Number of threads running this stage (default is 1). Use several for
+                I/O-bound steps such as LLM calls, and one for steps serialized by a lock anyway.
+            batch_size (Optional[int]): When set, func is called with lists of up to batch_size items
+                (fewer at the end of the input) and returns a list with the output of every item, for
+                steps that are cheaper in batches; later stages still start on the first micro-batch
+                while this one works on the next (default is one item per call).
+        """
+        if workers < 1:
+            raise ValueError(f"Stage {name!r} needs at least one worker, got {workers}")
+        if batch_size is not None and batch_size < 1:
+            raise ValueError(f"Stage {name!r} needs a batch size of at least one, got {batch_size}")
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.busy_seconds = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def _record(self, seconds: float, items: int = 1):
+        with self._lock:
+            self.busy_seconds += seconds
+            self.items += items
+
+    def _apply(self, items: List) -> List:
+        if self.batch_size is None:
+            return [self.func(item) for item in items]
+        outputs = list(self.func(items))
+        if len(outputs) != len(items):
+            raise ValueError(f"Stage {self.name!r} returned {len(outputs)} outputs for {len(items)} items")
+        return outputs
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+# Marks the end of the input on a queue
+_DONE = object()
+# Replaces the items that were not processed because an earlier item failed
+_SKIPPED = object()
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 8):
+        """
+        Staged producer/consumer pipeline: every stage runs in its own worker threads and stages are
+        connected by bounded queues, so a CPU-bound stage overlaps I/O-bound ones and throughput
+        approaches that of the slowest stage. Bounded queues keep a fast stage from running far ahead.
+
+        Parameters:
+            stages (List[Stage]): The stages, in order.
+            queue_size (int): Capacity of the queue in front of every stage (default is 8).
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed_seconds = 0.0
+        # Output of every item that passed all stages in the last run, in input order; after a failure
+        # these are the items that completed before the pipeline stopped
+        self.completed = []
+
+    def run(self, items: Iterable) -> List:
+        """
+        Runs every item through all stages. Once a stage fails on an item, no further items are read from
+        the input and items already in flight skip the remaining stages, so no more work (e.g. paid LLM
+        calls) is started; the items that completed are kept in completed.
+
+        Returns:
+            List: The output of the last stage for every item, in input order.
+
+        Raises:
+            The first exception raised by a stage, once the pipeline has drained.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages] + [queue.Queue()]
+        failed = threading.Event()
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], failed), daemon=True)]
+        for position, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            remaining_lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, daemon=True,
+                    args=(stage, queues[position], queues[position + 1], remaining, remaining_lock,
+                          self.stages[position + 1].workers if position + 1 < len(self.stages) else 1, failed)))
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        outputs = {}
+        while True:
+            entry = queues[-1].get()
+            if entry is _DONE:
+                break
+            index, output = entry
+            outputs[index] = output
+        for thread in threads:
+            thread.join()
+        self.elapsed_seconds = time.perf_counter() - started
+
+        results = [outputs[index] for index in range(len(outputs))]
+        self.completed = [output for output in results if output is not _SKIPPED and not isinstance(output, _Failed)]
+        for output in results:
+            if isinstance(output, _Failed):
+                raise output.error
+        return results
+
+    def _feed(self, items: Iterable, output: queue.Queue, failed: threading.Event):
+        index = 0
+        try:
+            for item in items:
+                if failed.is_set():
+                    break
+                output.put((index, item))
+                index += 1
+        except Exception as error:
+            # An input iterator that fails (e.g. a truncated file) ends the input like a failed stage
+            output.put((index, _Failed(error)))
+        finally:
+            for _ in range(self.stages[0].workers):
+                output.put(_DONE)
+
+    @staticmethod
+    def _work(stage: Stage, source: queue.Queue, sink: queue.Queue, remaining: List[int],
+              remaining_lock: threading.Lock, next_workers: int, failed: threading.Event):
+        done = False
+        while not done:
+            # One item at a time, or a micro-batch of up to batch_size items
+            entries = []
+            while len(entries) < (stage.batch_size or 1):
+                entry = source.get()
+                if entry is _DONE:
+                    done = True
+                    break
+                entries.append(entry)
+            pending = [position for position, (_, item) in enumerate(entries)
+                       if item is not _SKIPPED and not isinstance(item, _Failed)]
+            if pending and failed.is_set():
+                for position in pending:
+                    entries[position] = (entries[position][0], _SKIPPED)
+            elif pending:
+                started = time.perf_counter()
+                try:
+                    outputs = stage._apply([entries[position][1] for position in pending])
+                except Exception as error:
+                    # Passed on instead of stopping the workers, so that the queues still drain
+                    outputs = [_Failed(error)] * len(pending)
+                    failed.set()
+                stage._record(time.perf_counter() - started, len(pending))
+                for position, output in zip(pending, outputs):
+                    entries[position] = (entries[position][0], output)
+            for entry in entries:
+                sink.put(entry)
+        # The last worker of a stage to finish tells every worker of the next stage
+        with remaining_lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(next_workers):
+                sink.put(_DONE)
+
+    def report(self) -> str:
+        """Returns the busy time of every stage from the last run, to spot the slowest one."""
+        lines = [f"Pipeline finished in {self.elapsed_seconds:.1f}s"]
+        for stage in self.stages:
+            lines.append(f"  {stage.name}: {stage.items} items, {stage.busy_seconds:.1f}s busy over "
+                         f"{stage.workers} worker(s), {stage.busy_seconds / max(stage.workers, 1):.1f}s per worker")
+        return "\n".join(lines)
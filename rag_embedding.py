@@ -1,112 +1,302 @@
-import json
-import re
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import chromadb
+import numpy as np
 
+import tracing
 from bm25 import BM25
+from bm25_shards import ShardedBM25, load_bm25
+from colbert_index import ColBERTDocumentIndex
+from embedding_cache import CachedEmbeddingFunction, EmbeddingCache
+from java_comments import strip_comments, strip_many
+from near_duplicates import NearDuplicateDetector
+from refactoring_reader import iter_refactorings
+from vector_store import QUERY_RESULT_FIELDS, ChromaVectorStore, LocalVectorStore, VectorStore
 
-chroma_client = chromadb.HttpClient(host='localhost', port=8000)
-from chromadb.utils import embedding_functions
+logger = logging.getLogger(__name__)
+
+# 向量库后端：chroma（HTTP 服务）或 local（进程内 mmap 文件，不需要启动服务）
+VECTOR_STORE = os.getenv('RAG_VECTOR_STORE', 'chroma')
 
 # refactoring_em_wc_collection 有注释的数据库
 # refactoring_em_woc_collection 无注释的数据库
 def remove_java_comments(java_code):
-    # 匹配单行注释 //... 和 多行注释 /*...*/、/**...*/
-    pattern = r"(//.*?$|/\*.*?\*/|/\*\*.*?\*/)"
-    # 使用 re.sub 移除匹配的注释
-    cleaned_code = re.sub(pattern, "", java_code, flags=re.DOTALL | re.MULTILINE)
-    return cleaned_code
+    # 单遍扫描移除 //...、/*...*/ 和 /**...*/ 注释，字符串、字符字面量和文本块中的 // 与 /* 保持不变
+    return strip_comments(java_code)
+
+
+def build_document_text(refactoring):
+    # 检索使用的文档文本：contextDescription + 去掉注释的 sourceCodeBeforeRefactoring
+    return refactoring['contextDescription'] + '\n' + remove_java_comments(refactoring['sourceCodeBeforeRefactoring'])
+
+
+def build_document_texts(refactorings, processes=None):
+    """
+    Batch version of build_document_text: the sources are stripped together, repeated ones only once,
+    and spread over a process pool when processes > 1.
+
+    Parameters:
+        refactorings (list): Refactorings with contextDescription and sourceCodeBeforeRefactoring.
+        processes (Optional[int]): Worker processes for comment stripping (default is None, in this process).
+
+    Returns:
+        list: The document texts, in input order.
+    """
+    sources = strip_many((refactoring['sourceCodeBeforeRefactoring'] for refactoring in refactorings),
+                         processes=processes)
+    return [refactoring['contextDescription'] + '\n' + source for refactoring, source in zip(refactorings, sources)]
 
 
-# Create a new collection
-default_ef = embedding_functions.DefaultEmbeddingFunction();
 # chroma_client.delete_collection(name="refactoring_collection")
 
+_chroma_client = None
+_embedding_function = None
+_vector_stores = {}
+
+
+def get_embedding_function():
+    # 带内容寻址缓存的 embedding 函数：(模型, 文本哈希) 命中缓存时不重新计算
+    # chromadb 在第一次需要 embedding 时才导入，只用建索引文本等函数时不需要安装
+    global _embedding_function
+    if _embedding_function is None:
+        from chromadb.utils import embedding_functions
+        _embedding_function = CachedEmbeddingFunction(embedding_functions.DefaultEmbeddingFunction(),
+                                                      EmbeddingCache('data/cache/embeddings.sqlite'))
+    return _embedding_function
+
+
+def get_chroma_client():
+    # 第一次使用时才连接 Chroma 服务，local 后端不需要服务
+    global _chroma_client
+    if _chroma_client is None:
+        import chromadb
+        _chroma_client = chromadb.HttpClient(host='localhost', port=8000)
+    return _chroma_client
+
+
+def get_vector_store(collection_name, backend=None) -> VectorStore:
+    backend = backend or VECTOR_STORE
+    key = (backend, collection_name)
+    if key not in _vector_stores:
+        if backend == 'local':
+            # 检索只用 uniqueId，文本和 metadata 统一从 RefactoringStore 读取，向量库不再保存一份
+            _vector_stores[key] = LocalVectorStore(f'data/model/{collection_name}_vectors.idx',
+                                                   embedding_function=get_embedding_function(), keep_texts=False)
+        elif backend == 'chroma':
+            _vector_stores[key] = ChromaVectorStore(collection_name, client=get_chroma_client(),
+                                                    embedding_function=get_embedding_function())
+        else:
+            raise ValueError(f"Unknown vector store backend {backend!r}; expected 'chroma' or 'local'")
+    return _vector_stores[key]
+
 
 #读取 JSON 文件
 # with open('data/junit4_em_refactoring_w_sc_result.json', 'r') as file:
 #     data = json.load(file)
 
-def add_documents_to_chroma(collection_name, file_path, num_count):
-    collection = chroma_client.get_or_create_collection(name=collection_name)
-    # 创建要写入 Chroma 的 documents 和 ids
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    documents = []
+def add_documents_to_chroma(collection_name, file_path, num_count, precompute_colbert=True, chunk_size=256, workers=4,
+                            write_batch_size=1024, strip_processes=None, near_duplicate_threshold=0.9, bm25_shards=1,
+                            bm25_processes=None):
+    store = get_vector_store(collection_name)
+    # 跨 fork 和 cherry-pick 的几乎相同的 Extract Method 片段只保留第一个；None 关闭近重复检测
+    detector = NearDuplicateDetector(near_duplicate_threshold) if near_duplicate_threshold is not None else None
+    # 之前运行保留下来的文档的签名一并参与比较，新文档与已入库的文档重复时同样会被折叠
+    signatures_path = f'data/model/{collection_name}_minhash.idx'
+    if detector is not None and os.path.exists(signatures_path):
+        logger.info("Loaded %d MinHash signatures of stored documents", detector.load_signatures(signatures_path))
+    # 创建要写入 Chroma 的 metadata 和 ids
     metadata_refactoring = []
     ids = []
-    unique_ids_set = set()  # 用于存储已经添加的 uniqueId
     count = 0
-    # 遍历 JSON 中的 commits
-    for commit in data['commits']:
-        if "refactorings" not in commit:
+    current_commit = None
+    # 逐个 commit 流式读取 JSON，只保留 pure refactoring，并按 uniqueId 去重
+    for commit, refactoring in iter_refactorings(file_path, pure_only=True, dedup=True, with_commit=True):
+        # 与之前一样在 commit 边界上检查数量
+        if commit is not current_commit:
+            if count >= num_count:
+                break
+            current_commit = commit
+        unique_id = refactoring['uniqueId']
+        # 在去掉注释的源码上做 MinHash/LSH 近重复检测，边读边判断
+        if detector is not None and detector.add(
+                unique_id, remove_java_comments(refactoring['sourceCodeBeforeRefactoring'])) is not None:
             continue
-        if count >= num_count:
-            break
-        for refactoring in commit['refactorings']:
-            unique_id = refactoring['uniqueId']
-
-            # 检查是否已经存在该 uniqueId
-            if unique_id not in unique_ids_set and refactoring['isPureRefactoring']:
-                # 获取所需字段
-                source_before = remove_java_comments(refactoring['sourceCodeBeforeRefactoring'])
-                context_description = refactoring['contextDescription']
-                refactoring_data_to_store = {
-                    "type": "Extract Method",
-                    "sourceCodeBeforeRefactoring": refactoring['sourceCodeBeforeRefactoring'],
-                    "filePathBefore": refactoring['filePathBefore'],
-                    "isPureRefactoring": refactoring['isPureRefactoring'],
-                    "commitId": refactoring['commitId'],
-                    "packageNameBefore": refactoring['packageNameBefore'],
-                    "classNameBefore": refactoring['classNameBefore'],
-                    "methodNameBefore": refactoring['methodNameBefore'],
-                    "invokedMethod": "invokedMethod" in refactoring and refactoring['invokedMethod'] or "",
-                    "classSignatureBefore": refactoring['classSignatureBefore'],
-                    "sourceCodeAfterRefactoring": refactoring['sourceCodeAfterRefactoring'],
-                    "diffSourceCode": refactoring['diffSourceCode'],
-                    "uniqueId": refactoring['uniqueId'],
-                    "contextDescription": refactoring['contextDescription'],
-            }
-
-                # 添加到 documents 和 ids
-                documents.append(context_description + '\n' + source_before)
-                metadata_refactoring.append(refactoring_data_to_store)
-                ids.append(unique_id)
-                count += 1
-
-                # 将 uniqueId 加入 set，避免重复添加
-                unique_ids_set.add(unique_id)
-            else:
-                if unique_id in unique_ids_set:
-                    print(f"Skipping duplicate uniqueId: {unique_id}")
-
-
-    # 将去重后的数据写入 Chroma
-    if documents:
-        collection.add(
-            documents=documents,
-            metadatas=metadata_refactoring,
-            ids=ids,
-        )
-        # add document to bm25
-        bm25_model = BM25(documents)
-        bm25_model.save_model(f'data/model/{collection_name}_bm25result.pkl')
+        # 获取所需字段
+        refactoring_data_to_store = {
+            "type": "Extract Method",
+            "sourceCodeBeforeRefactoring": refactoring['sourceCodeBeforeRefactoring'],
+            "filePathBefore": refactoring['filePathBefore'],
+            "isPureRefactoring": refactoring['isPureRefactoring'],
+            "commitId": refactoring['commitId'],
+            "packageNameBefore": refactoring['packageNameBefore'],
+            "classNameBefore": refactoring['classNameBefore'],
+            "methodNameBefore": refactoring['methodNameBefore'],
+            "invokedMethod": "invokedMethod" in refactoring and refactoring['invokedMethod'] or "",
+            "classSignatureBefore": refactoring['classSignatureBefore'],
+            "sourceCodeAfterRefactoring": refactoring['sourceCodeAfterRefactoring'],
+            "diffSourceCode": refactoring['diffSourceCode'],
+            "uniqueId": refactoring['uniqueId'],
+            "contextDescription": refactoring['contextDescription'],
+        }
+
+        # 添加到 metadata 和 ids，documents 在读完后批量生成
+        metadata_refactoring.append(refactoring_data_to_store)
+        ids.append(unique_id)
+        count += 1
+
+    if detector is not None:
+        report_path = f'data/model/{collection_name}_near_duplicates.json'
+        detector.save_report(report_path)
+        logger.info("Collapsed %d near-duplicate documents into %d clusters, see %s",
+                    detector.collapsed, len(detector.clusters), report_path)
+
+    if not ids:
+        logger.info("No new unique IDs to add.")
+        return
+    documents = build_document_texts(metadata_refactoring, processes=strip_processes)
+
+    # 向量库本身就是按 uniqueId 的断点：每批写入后即记入日志（Chroma 直接持久化），中断后重新运行只处理尚未写入的文档
+    existing_ids = store.existing_ids(ids)
+    pending = [position for position, unique_id in enumerate(ids) if unique_id not in existing_ids]
+    if pending:
+        write_vectors(store, [ids[position] for position in pending], [documents[position] for position in pending],
+                      [metadata_refactoring[position] for position in pending],
+                      chunk_size=chunk_size, workers=workers, write_batch_size=write_batch_size)
+    else:
+        logger.info("No new unique IDs to add.")
+    if detector is not None:
+        # 只在向量写入之后保存，签名文件里的文档都已入库
+        detector.save_signatures(signatures_path)
+
+    # add document to bm25, updating the existing index in place when there is one
+    # BM25 和 ColBERT 索引同样按 uniqueId 跳过已有文档，所以上次中断在写完向量之后也能补齐
+    bm25_path = f'data/model/{collection_name}_bm25result.idx'
+    if os.path.exists(bm25_path):
+        bm25_model = load_bm25(bm25_path, processes=bm25_processes)
+        if bm25_model.ids is not None:
+            indexed_ids = set(bm25_model.ids)
+            missing = [position for position, unique_id in enumerate(ids) if unique_id not in indexed_ids]
+        else:
+            # 旧的索引文件没有 uniqueId，只能按向量库的增量添加
+            missing = pending
+        if missing:
+            bm25_model.add_documents([documents[position] for position in missing],
+                                     ids=[ids[position] for position in missing] if bm25_model.ids is not None else None)
+            bm25_model.save_model(bm25_path)
+    elif bm25_shards > 1:
+        # 多项目语料按 shard 分片，多进程并行分词建索引，IDF 按全局统计合并
+        ShardedBM25.build(bm25_path, documents, num_shards=bm25_shards, processes=bm25_processes, ids=ids,
+                          keep_texts=False)
     else:
-        print("No new unique IDs to add.")
+        # 索引文件只保存 uniqueId 和倒排表，文档文本由 RefactoringStore.document_text 给出
+        BM25(documents, ids=ids, keep_texts=False).save_model(bm25_path)
+    # 预先计算 ColBERT 文档 token embedding，rerank 时只需编码 query
+    if precompute_colbert:
+        from reranking import get_reranker
+        colbert_path = f'data/model/{collection_name}_colbert.idx'
+        if os.path.exists(colbert_path):
+            document_index = ColBERTDocumentIndex.open(colbert_path)
+        else:
+            document_index = ColBERTDocumentIndex("colbert")
+        if document_index.add_documents(get_reranker("colbert").ranker, ids, documents):
+            document_index.save(colbert_path)
+
+
+def _embed_chunks(documents, chunk_size, workers):
+    # 多线程按块计算 embedding（onnxruntime 计算时释放 GIL），按输入顺序产出；
+    # 同时在途的块数有上限，内存占用不随语料增长
+    embedding_function = get_embedding_function()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for start in range(0, len(documents), chunk_size):
+            in_flight.append(executor.submit(embedding_function, documents[start:start + chunk_size]))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
 
-def search_chroma(text,n_results,collection_name):
+def write_vectors(store, ids, documents, metadatas, chunk_size=256, workers=4, write_batch_size=1024,
+                  save_every=None):
+    """
+    Embeds documents in chunks across a thread pool and writes them to the vector store in bounded
+    batches, and reports the throughput. Every batch is checkpointed by the store itself (Chroma
+    persists on add, LocalVectorStore appends it to its journal); the store file is rewritten every
+    save_every batches and once at the end.
 
-    collection = chroma_client.get_or_create_collection(name=collection_name)
+    Parameters:
+        store (VectorStore): The vector store to write to.
+        ids (List[str]): uniqueId of every document.
+        documents (List[str]): The document texts.
+        metadatas (List[dict]): The metadata of every document.
+        chunk_size (int): Number of documents embedded per task (default is 256).
+        workers (int): Number of embedding threads (default is 4).
+        write_batch_size (int): Number of documents written to the store at a time (default is 1024).
+        save_every (Optional[int]): Number of batches between saves (default is None, save only at the end).
+    """
+    started = time.perf_counter()
+    written = 0
+    batches = 0
+    batch_embeddings = []
+    for chunk_embeddings in _embed_chunks(documents, chunk_size, workers):
+        batch_embeddings.extend(chunk_embeddings)
+        if len(batch_embeddings) >= write_batch_size or written + len(batch_embeddings) == len(documents):
+            stop = written + len(batch_embeddings)
+            store.add(ids=ids[written:stop], documents=documents[written:stop], metadatas=metadatas[written:stop],
+                      embeddings=np.asarray(batch_embeddings, dtype=np.float32))
+            batches += 1
+            if save_every and batches % save_every == 0:
+                store.save()
+            written = stop
+            batch_embeddings = []
+            elapsed = time.perf_counter() - started
+            logger.info("Written %d/%d documents, %.1f docs/sec", written, len(documents), written / elapsed)
+    store.save()
+
+
+def search_chroma(text,n_results,collection_name, include=None):
+
+    store = get_vector_store(collection_name)
+    # include=["distances"] 只返回 ids 和距离，不传输文档和 metadata
     # 测试查询功能
-    results = collection.query(
-        query_texts=[text],  # 这是你要查询的文本
-        n_results=n_results  # 返回的结果数
-    )
+    with tracing.span("embedding_search", queries=1):
+        results = store.query(
+            query_texts=[text],  # 这是你要查询的文本
+            n_results=n_results,  # 返回的结果数
+            include=include
+        )
+    tracing.count('candidates_total', len(results['ids'][0]), stage='embedding_search')
+    return results
+
+def search_chroma_many(texts, n_results, collection_name, include=None, batch_size=64):
+    """
+    Searches the vector store for many query texts, submitting them in batches of batch_size.
+
+    Returns:
+        list: One result per text, in the order of texts, shaped like the result of search_chroma.
+    """
+    store = get_vector_store(collection_name)  # collection handle cached per process
+    results = []
+    with tracing.span("embedding_search", queries=len(texts)):
+        for start in range(0, len(texts), batch_size):
+            batch = store.query(query_texts=texts[start:start + batch_size], n_results=n_results, include=include)
+            for position in range(len(batch['ids'])):
+                # 拆成每个 query 单独的结果，字段保持 search_chroma 的形状（外层列表只有一个元素）
+                results.append({key: [batch[key][position]] for key in QUERY_RESULT_FIELDS
+                                if batch.get(key) is not None})
+    tracing.count('candidates_total', sum(len(result['ids'][0]) for result in results), stage='embedding_search')
     return results
 
 if __name__ == "__main__":
-    connection = chroma_client.get_or_create_collection(name='refactoring_miner_em_wc_context_collection')
+    # 进度信息通过 logging 输出，LOG_LEVEL=DEBUG 可以看到更多细节
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    connection = get_vector_store('refactoring_miner_em_wc_context_collection')
     print(connection.count())
+    # 把已有的 Chroma collection 复制到本地向量库（复用已计算的 embedding）：
+    # vector_store.copy_collection(get_vector_store(name, 'chroma'), get_vector_store(name, 'local'))
     # chroma_client.delete_collection(name='refactoring_miner_em_wc_collection')
     add_documents_to_chroma('refactoring_miner_em_wc_context_collection', 'data/refactoring_info/refactoring_miner_em_refactoring_context_w_sc_v2.json', 200)
     # result = search_chroma("@Override\n    public void start() {\n        mStorageManager = (StorageManager) mContext.getSystemService(Context.STORAGE_SERVICE);\n        final boolean connected = mStorageManager.isUsbMassStorageConnected();\n        if (DEBUG) Log.d(TAG, String.format( \"Startup with UMS connection %s (media state %s)\",\n                mUmsAvailable, Environment.getExternalStorageState()));\n\n        HandlerThread thr = new HandlerThread(\"SystemUI StorageNotification\");\n        thr.start();\n        mAsyncEventHandler = new Handler(thr.getLooper());\n\n        StorageNotificationEventListener listener = new StorageNotificationEventListener();\n        listener.onUsbMassStorageConnectionChanged(connected);\n        mStorageManager.registerListener(listener);\n    }", 3, 'refactoring_miner_em_wc_collection')
@@ -1,28 +1,49 @@
+import heapq
+from itertools import islice
+
+import numpy as np
+
+
 class ReciprocalRankFusion:
-    def __init__(self, k=60):
+    def __init__(self, k=60, weights=None, depth=None):
         """
         Initialize the RRF instance with a configurable constant k.
         Args:
             k (int): A small positive constant to prevent division by zero (default is 60).
+            weights (list of float, optional): Default weight of each ranked list (default is 1 for every list).
+            depth (int, optional): Default number of leading entries read from each ranked list (default is all).
         """
         self.k = k
+        self.weights = weights
+        self.depth = depth
+
+    def _sources(self, ranked_lists, weights, depth):
+        """Pairs every ranked list with its weight and cuts it to the depth, without materializing it."""
+        weights = self.weights if weights is None else weights
+        depth = self.depth if depth is None else depth
+        for index, ranked_list in enumerate(ranked_lists):
+            weight = 1 if weights is None else weights[index]
+            yield weight, ranked_list if depth is None else islice(ranked_list, depth)
 
-    def fuse(self, ranked_lists):
+    def fuse(self, ranked_lists, weights=None, depth=None):
         """
         Compute the Reciprocal Rank Fusion (RRF) score for each document.
 
         Args:
-            ranked_lists (list of lists): Each inner list is a ranked list of document IDs.
+            ranked_lists (iterable of iterables): Each inner iterable is a ranked list of document IDs.
+                Generators are consumed lazily.
+            weights (list of float, optional): Weight of each ranked list; overrides the instance default.
+            depth (int, optional): Number of leading entries read from each ranked list; overrides the instance default.
 
         Returns:
             dict: A dictionary with document IDs as keys and their RRF scores as values.
         """
         rrf_scores = {}
 
-        for ranked_list in ranked_lists:
+        for weight, ranked_list in self._sources(ranked_lists, weights, depth):
             for rank, doc_id in enumerate(ranked_list):
                 # Compute the reciprocal rank for the document
-                score = 1 / (self.k + rank + 1)
+                score = weight / (self.k + rank + 1)
 
                 # Accumulate the score for the document
                 if doc_id in rrf_scores:
@@ -36,6 +57,9 @@ class ReciprocalRankFusion:
         """
         Get the top N documents based on RRF scores.
 
+        Uses a bounded heap, so only N entries are kept ordered. Ties keep the order in which the
+        documents were first seen, as a stable sort would.
+
         Args:
             rrf_scores (dict): A dictionary with document IDs as keys and their RRF scores as values.
             n (int): The number of top documents to return (default is 10).
@@ -43,7 +67,59 @@ class ReciprocalRankFusion:
         Returns:
             list: A list of tuples (doc_id, score) sorted by score in descending order.
         """
-        return sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)[:n]
+        return heapq.nlargest(n, rrf_scores.items(), key=lambda x: x[1])
+
+    def fuse_top_n(self, ranked_lists, n=10, weights=None, depth=None):
+        """
+        Fuse the ranked lists and return only the top N documents.
+
+        Args:
+            ranked_lists (iterable of iterables): Each inner iterable is a ranked list of document IDs.
+            n (int): The number of top documents to return (default is 10).
+            weights (list of float, optional): Weight of each ranked list.
+            depth (int, optional): Number of leading entries read from each ranked list.
+
+        Returns:
+            list: A list of tuples (doc_id, score) sorted by score in descending order.
+        """
+        return self.get_top_n(self.fuse(ranked_lists, weights=weights, depth=depth), n=n)
+
+    def fuse_arrays(self, ranked_arrays, n=None, weights=None, depth=None):
+        """
+        Vectorized RRF for ranked lists given as arrays of integer document IDs.
+
+        Args:
+            ranked_arrays (list of array-like): Each entry is a ranked 1-D array of integer document IDs.
+            n (int, optional): The number of top documents to return (default is all fused documents).
+            weights (list of float, optional): Weight of each ranked list.
+            depth (int, optional): Number of leading entries read from each ranked list.
+
+        Returns:
+            tuple: The document IDs and their RRF scores as arrays, sorted by score in descending order.
+                Ties keep the order in which the documents were first seen, like fuse and get_top_n.
+        """
+        doc_ids = []
+        scores = []
+        for weight, ranked_array in self._sources(ranked_arrays, weights, depth):
+            ranked_array = np.fromiter(ranked_array, dtype=np.int64) if not isinstance(ranked_array, np.ndarray) \
+                else ranked_array.astype(np.int64, copy=False)
+            doc_ids.append(ranked_array)
+            scores.append(weight / (self.k + np.arange(1, len(ranked_array) + 1)))
+        if not doc_ids or (n is not None and n <= 0):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        doc_ids = np.concatenate(doc_ids)
+        unique_ids, first_seen, inverse = np.unique(doc_ids, return_index=True, return_inverse=True)
+        fused = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(unique_ids))
+
+        if n is not None and n < len(fused):
+            # Partial sort: keep everything scoring at least the n-th best score, then order that part only.
+            kth = np.partition(fused, len(fused) - n)[len(fused) - n]
+            candidates = np.flatnonzero(fused >= kth)
+        else:
+            candidates = np.arange(len(fused))
+        order = candidates[np.lexsort((first_seen[candidates], -fused[candidates]))][:n]
+        return unique_ids[order], fused[order]
 
 
 # Example usage
@@ -65,3 +141,10 @@ if __name__ == "__main__":
     # Get the top 3 documents
     top_docs = rrf.get_top_n(scores, n=3)
     print("Top 3 Documents:", top_docs)
+
+    # Weight the first source twice as much and only read the top 2 of every list
+    print("Weighted Top 3 Documents:", rrf.fuse_top_n((iter(ranked_list) for ranked_list in ranked_lists), n=3,
+                                                      weights=[2, 1, 1], depth=2))
+
+    # The same fusion over integer document IDs
+    print("Array Top 3 Documents:", rrf.fuse_arrays([[1, 2, 3, 4], [2, 4, 3, 5], [2, 1, 3, 6]], n=3))
@@ -1,7 +1,14 @@
 import json
 import pickle
+from collections.abc import Mapping
 
-from rag_embedding import remove_java_comments
+from bm25 import BM25
+from mmap_store import MappedTexts, pack_strings, read_sections, write_sections
+from rag_embedding import build_document_text, build_document_texts
+from refactoring_reader import iter_refactorings
+
+STORE_MAGIC = b'REFSTORE'
+STORE_FORMAT_VERSION = 1
 
 
 class Refactoring:
@@ -44,17 +51,24 @@ class Refactoring:
 
 class RefactoringRepository:
     def __init__(self, data):
-        self.refactoring_map = self._build_map(data)
-
-    def _build_map(self, data):
+        self.refactoring_map = self._build_map(refactoring_data for commit in data.get("commits", [])
+                                               for refactoring_data in commit.get("refactorings", []))
+
+    @classmethod
+    def from_file(cls, file_path):
+        """逐个 commit 流式读取 RefactoringMiner JSON 文件并构建仓库。"""
+        repository = cls({})
+        repository.refactoring_map = repository._build_map(
+            iter_refactorings(file_path, predicate=lambda refactoring_data: 'contextDescription' in refactoring_data))
+        return repository
+
+    def _build_map(self, refactorings):
         """构建以 contextDescription 为键的字典。"""
-        refactoring_map = {}
-        for commit in data.get("commits", []):
-            for refactoring_data in commit.get("refactorings", []):
-                if 'contextDescription' in refactoring_data:
-                    refactoring = Refactoring(refactoring_data)
-                    refactoring_map[refactoring.context_description + '\n' + remove_java_comments(refactoring.source_code_before)] = refactoring.to_dict()
-        return refactoring_map
+        refactorings = [refactoring_data for refactoring_data in refactorings if 'contextDescription' in refactoring_data]
+        # 注释去除批量进行，重复的源码只处理一次
+        documents = build_document_texts(refactorings)
+        return {document: Refactoring(refactoring_data).to_dict()
+                for document, refactoring_data in zip(documents, refactorings)}
 
     def save_to_file(self, filename, format="json"):
         """将 refactoring_map 保存为 JSON 或 Pickle 文件。"""
@@ -70,23 +84,82 @@ class RefactoringRepository:
         with open(filename, "r" if format == "json" else "rb") as f:
             return json.load(f) if format == "json" else pickle.load(f)
 
+    @staticmethod
+    def index_by_unique_id(refactoring_map):
+        """将以文档文本为键的 refactoring_map 转换为以 uniqueId 为键的字典。"""
+        return {refactoring['uniqueId']: refactoring for refactoring in refactoring_map.values()}
+
     def find_by_context_description(self, description):
         """通过 contextDescription 查找 refactoring。"""
         return self.refactoring_map.get(description, "Refactoring not found")
 
 
+class RefactoringStore(Mapping):
+    def __init__(self, ids, records):
+        """
+        以 uniqueId 为键的 refactoring 存储，每条记录只保存一份（JSON 编码）。
+
+        文件通过 mmap 打开，只有访问到的记录才会被解码；检索文本由 document_text 按需生成，
+        BM25、向量检索和 prompt 阶段都从这里取文本，不再各自保存一份。
+        """
+        self.ids = ids
+        self._records = records
+        self._rows = {unique_id: row for row, unique_id in enumerate(ids)}
+
+    @classmethod
+    def open(cls, filename):
+        """打开 write 写出的存储文件。"""
+        _, _, arrays = read_sections(filename, STORE_MAGIC, (STORE_FORMAT_VERSION,))
+        return cls(MappedTexts(arrays['id_offsets'], arrays['ids']),
+                   MappedTexts(arrays['record_offsets'], arrays['records']))
+
+    @staticmethod
+    def write(filename, refactorings):
+        """把 refactoring 字典写入存储文件；同一个 uniqueId 保留最后一条。返回记录数。"""
+        records = {}
+        for refactoring_data in refactorings:
+            records[refactoring_data['uniqueId']] = json.dumps(Refactoring(refactoring_data).to_dict(),
+                                                               ensure_ascii=False)
+        id_offsets, id_blob = pack_strings(records.keys())
+        record_offsets, record_blob = pack_strings(records.values())
+        write_sections(filename, STORE_MAGIC, STORE_FORMAT_VERSION, {}, {
+            'id_offsets': id_offsets,
+            'ids': id_blob,
+            'record_offsets': record_offsets,
+            'records': record_blob,
+        })
+        return len(records)
+
+    def __getitem__(self, unique_id):
+        return json.loads(self._records[self._rows[unique_id]])
+
+    def __contains__(self, unique_id):
+        return unique_id in self._rows
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def document_text(self, unique_id):
+        """检索使用的文档文本（与写入 BM25 和向量库的文本相同）。"""
+        return build_document_text(self[unique_id])
+
+
 if __name__ == "__main__":
     file_path = 'data/refactoring_info/refactoring_miner_em_refactoring_context_w_sc_v2.json'
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    # 初始化仓库对象
-    repo = RefactoringRepository(data)
-
-    # 保存到 JSON 文件
-    repo.save_to_file("data/refactoring_info/refactoring_map_em_wc_v2.json", format="json")
+    # 写入以 uniqueId 为键的存储，替代以文档文本为键的 refactoring_map JSON
+    store_path = "data/refactoring_info/refactoring_store_em_wc_v2.idx"
+    count = RefactoringStore.write(store_path, iter_refactorings(
+        file_path, predicate=lambda refactoring_data: 'contextDescription' in refactoring_data))
+    store = RefactoringStore.open(store_path)
+    print(f"Stored {count} refactorings, e.g.:", store[next(iter(store))] if len(store) else None)
+    # BM25 索引从存储重建，文档按 uniqueId 索引，检索结果直接是 uniqueId
+    BM25.from_records(store).save_model('data/model/refactoring_miner_em_wc_context_collection_bm25result.idx')
 
-    # 从 JSON 文件加载
-    loaded_repo = RefactoringRepository.load_from_file("data/refactoring_info/refactoring_map_em_wc_v2.json", format="json")
+    # 初始化仓库对象
+    repo = RefactoringRepository.from_file(file_path)
 
     # 查找特定 contextDescription 的 refactoring
     description_to_search = "The `reset` method in the `KeyguardAbsKeyInputView` class is responsible for resetting the key input view to its initial state. It first clears any existing password text, checks if the user is currently locked out based on the lockout deadline, and either initiates a countdown for lockout or resets the state of the input view. This method interacts with other methods such as `resetPasswordText`, `handleAttemptLockout`, and `resetState`, which manage the user interface and security logic related to password entry and lockout conditions.\npublic void reset() {\n        // start fresh\n        resetPasswordText(false /* animate */);\n        // if the user is currently locked out, enforce it.\n        long deadline = mLockPatternUtils.getLockoutAttemptDeadline();\n        if (shouldLockout(deadline)) {\n            handleAttemptLockout(deadline);\n        } else {\n            resetState();\n        }\n    }"
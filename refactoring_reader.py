@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import textwrap
+from typing import Callable, Iterable, Iterator, Optional
+
+_WHITESPACE = re.compile(r'\s*')
+_DECODER = json.JSONDecoder()
+
+
+class _JsonStream:
+    def __init__(self, file, chunk_size: int):
+        """Incremental JSON tokenizer over a text file: values are decoded one at a time from a growing buffer."""
+        self._file = file
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def _fill(self, size: int) -> bool:
+        chunk = self._file.read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        # Drop what was consumed, so memory stays bounded by the value being decoded
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it, or '' at the end of the file."""
+        while True:
+            self._position = _WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill(self._chunk_size):
+                return ''
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise ValueError(f"Expected {character!r} in JSON stream, found {self.peek()!r}")
+        self._position += 1
+
+    def value(self):
+        """Decodes the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buffer, self._position)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow geometrically so that a large value is not re-parsed once per chunk
+            self._fill(max(self._chunk_size, len(self._buffer) - self._position))
+
+
+def iter_commits(file_path: str, chunk_size: int = 1 << 20, fields: Optional[dict] = None) -> Iterator[dict]:
+    """
+    Streams the commits of a RefactoringMiner JSON file ({"commits": [...]}) one at a time, so memory is
+    bounded by one commit instead of the whole file.
+
+    Parameters:
+        file_path (str): Path of the JSON file.
+        chunk_size (int): Number of characters read at a time (default is 1M).
+        fields (Optional[dict]): Receives the other top-level values of the file as they are read, e.g.
+            to pass them on to write_commits.
+
+    Yields:
+        dict: Every commit, in file order.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        stream = _JsonStream(file, chunk_size)
+        stream.expect('{')
+        while stream.peek() not in ('}', ''):
+            key = stream.value()
+            stream.expect(':')
+            if key != 'commits':
+                value = stream.value()
+                if fields is not None:
+                    fields[key] = value
+            else:
+                stream.expect('[')
+                while stream.peek() != ']':
+                    yield stream.value()
+                    if stream.peek() == ',':
+                        stream.expect(',')
+                stream.expect(']')
+            if stream.peek() == ',':
+                stream.expect(',')
+
+
+def iter_refactorings(file_path: str, types: Optional[Iterable[str]] = None, pure_only: bool = False,
+                      dedup: bool = False, with_commit: bool = False,
+                      predicate: Optional[Callable[[dict], bool]] = None) -> Iterator:
+    """
+    Streams the refactorings of a RefactoringMiner JSON file, applying the filters while reading.
+
+    Parameters:
+        file_path (str): Path of the JSON file.
+        types (Optional[Iterable[str]]): Refactoring types to keep, e.g. ["Extract Method"] (default is all).
+        pure_only (bool): Keep only refactorings with isPureRefactoring set (default is False).
+        dedup (bool): Keep only the first refactoring of every uniqueId (default is False).
+        with_commit (bool): Yield (commit, refactoring) pairs instead of refactorings (default is False).
+        predicate (Optional[Callable[[dict], bool]]): Any further condition on a refactoring.
+
+    Yields:
+        The matching refactorings, or (commit, refactoring) pairs, in file order.
+    """
+    types = set(types) if types is not None else None
+    seen = set()
+    for commit in iter_commits(file_path):
+        for refactoring in commit.get('refactorings', []):
+            if types is not None and refactoring.get('type') not in types:
+                continue
+            if pure_only and not refactoring.get('isPureRefactoring', False):
+                continue
+            if predicate is not None and not predicate(refactoring):
+                continue
+            if dedup:
+                if refactoring.get('uniqueId') in seen:
+                    continue
+                seen.add(refactoring.get('uniqueId'))
+            yield (commit, refactoring) if with_commit else refactoring
+
+
+def _field_text(key: str, value, ensure_ascii: bool) -> str:
+    # One top-level "key": value entry, laid out as json.dump(..., indent=4) does
+    text = json.dumps(value, indent=4, ensure_ascii=ensure_ascii)
+    return f"    {json.dumps(key, ensure_ascii=ensure_ascii)}: {textwrap.indent(text, ' ' * 4)[4:]}"
+
+
+def write_commits(file_path: str, commits: Iterable[dict], ensure_ascii: bool = False,
+                  fields: Optional[dict] = None):
+    """
+    Writes commits as {"commits": [...]} one at a time, with the layout json.dump(..., indent=4) produces.
+    The file is written next to the target and renamed over it, so the output may replace the input
+    that the commits are streamed from.
+
+    Parameters:
+        file_path (str): Path of the JSON file.
+        commits (Iterable[dict]): The commits, e.g. a transformed iter_commits stream.
+        ensure_ascii (bool): Escape non-ASCII characters, as json.dump does by default (default is False).
+        fields (Optional[dict]): Other top-level values to keep, e.g. filled by iter_commits while the
+            commits are streamed. Those present once the first commit is drawn are written before the
+            commits and the rest after them, so the key order of the input file is kept.
+    """
+    fields = fields if fields is not None else {}
+    commits = iter(commits)
+    commit = next(commits, None)
+    written = set()
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write('{')
+        for key, value in list(fields.items()):
+            if key != 'commits':
+                file.write(('\n' if not written else ',\n') + _field_text(key, value, ensure_ascii))
+                written.add(key)
+        file.write(',\n    "commits": [' if written else '\n    "commits": [')
+        first = True
+        while commit is not None:
+            file.write('\n' if first else ',\n')
+            file.write(textwrap.indent(json.dumps(commit, indent=4, ensure_ascii=ensure_ascii), ' ' * 8))
+            first = False
+            commit = next(commits, None)
+        file.write(']' if first else '\n    ]')
+        for key, value in list(fields.items()):
+            if key != 'commits' and key not in written:
+                file.write(',\n' + _field_text(key, value, ensure_ascii))
+        file.write('\n}')
+    os.replace(tmp_path, file_path)
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+import tracing
+
+# SQLite limits the number of bound parameters per statement
+_MAX_IDS_PER_QUERY = 500
+
+
+def query_hash(query: str) -> str:
+    """Returns the cache key of a query text."""
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def document_hash(document: str) -> str:
+    """Returns the hash of a document text stored with its scores."""
+    return hashlib.sha256(document.encode('utf-8')).hexdigest()
+
+
+class RerankScoreCache:
+    def __init__(self, filepath: str):
+        """
+        Persistent cache of reranker scores keyed by (model, query hash, document id), stored in SQLite.
+
+        Scores survive across runs, so re-running an experiment with the same candidates does not
+        recompute them. Document ids must be stable across runs (e.g. uniqueId). Every score is
+        stored with the hash of the document text it was computed on, and is only reused while the
+        text is unchanged, e.g. not after the document texts were rebuilt with another comment stripper.
+
+        Parameters:
+            filepath (str): Path of the SQLite database; created if it does not exist.
+        """
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(scores)")]
+        if columns and 'doc_hash' not in columns:
+            # Scores of earlier versions cannot be checked against the document text
+            self._connection.execute("DROP TABLE scores")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores (model TEXT NOT NULL, query_hash TEXT NOT NULL, doc_id TEXT NOT NULL, "
+            "doc_hash TEXT NOT NULL, score REAL NOT NULL, PRIMARY KEY (model, query_hash, doc_id)) WITHOUT ROWID"
+        )
+        self._connection.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, query_key: str, doc_ids: List, documents: List[str]) -> Dict[str, float]:
+        """
+        Looks up the cached scores of documents for one query.
+
+        Parameters:
+            model (str): The reranker model key.
+            query_key (str): The query hash (see query_hash).
+            doc_ids (List): The document ids.
+            documents (List[str]): The current text of every document; scores of other texts are misses.
+
+        Returns:
+            Dict[str, float]: The cached score of every document id (as a string) that was found.
+        """
+        doc_hashes = {str(doc_id): document_hash(document) for doc_id, document in zip(doc_ids, documents)}
+        doc_keys = list(doc_hashes)
+        found = {}
+        with self._lock:
+            for start in range(0, len(doc_keys), _MAX_IDS_PER_QUERY):
+                chunk = doc_keys[start:start + _MAX_IDS_PER_QUERY]
+                rows = self._connection.execute(
+                    f"SELECT doc_id, doc_hash, score FROM scores WHERE model = ? AND query_hash = ? "
+                    f"AND doc_id IN ({', '.join('?' * len(chunk))})",
+                    [model, query_key, *chunk],
+                )
+                found.update((doc_key, score) for doc_key, doc_hash, score in rows
+                             if doc_hash == doc_hashes[doc_key])
+            self.hits += len(found)
+            self.misses += len(doc_keys) - len(found)
+        tracing.count('cache_hits_total', len(found), cache='rerank')
+        tracing.count('cache_misses_total', len(doc_keys) - len(found), cache='rerank')
+        return found
+
+    def put_many(self, model: str, scores: Iterable[Tuple[str, object, str, float]]):
+        """
+        Stores scores, replacing the scores of earlier texts of the same documents.
+
+        Parameters:
+            model (str): The reranker model key.
+            scores (Iterable[Tuple[str, object, str, float]]): (query hash, document id, document text, score) tuples.
+        """
+        rows = [(model, query_key, str(doc_id), document_hash(document), float(score))
+                for query_key, doc_id, document, score in scores]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,7 +1,13 @@
+import gc
 import os
+import threading
 
 from rerankers import Reranker, Document
-from typing import List, Optional, Any
+from rerankers.results import RankedResults, Result
+from typing import Dict, List, Optional, Any, Tuple
+
+from colbert_index import encode_documents, encode_query, maxsim
+from rerank_cache import query_hash
 
 
 class Reranking:
@@ -15,6 +21,14 @@ class Reranking:
             model_name (Optional[str]): Specific model name if using a specific cross-encoder or GPT variant.
             api_key (Optional[str]): API key for models requiring authentication (e.g., GPT).
         """
+        self.model_name = model_name
+        self.model_type = model_type
+        # Optional colbert_index.ColBERTDocumentIndex with precomputed document embeddings
+        self.document_index = None
+        # Optional rerank_cache.RerankScoreCache with scores from earlier runs
+        self.score_cache = None
+        # The underlying models are not guaranteed to be thread-safe, so calls are serialized per instance
+        self._lock = threading.Lock()
         # Specify model type for cross-encoder or any other model type to avoid warnings
         if model_type and api_key:
             self.ranker = Reranker(model_name, model_type=model_type, api_key=api_key)
@@ -37,14 +51,244 @@ class Reranking:
         Returns:
             Any: Ranked results containing the reranked documents.
         """
+        # Cached scores are keyed by document id, so the cache is only used with caller-provided ids
+        if self.score_cache is not None and doc_ids is not None:
+            return self.rerank_many([query], [documents], [doc_ids], [metadata] if metadata else None)[0]
+
         # If doc_ids are not provided, generate them
         if doc_ids is None:
             doc_ids = list(range(len(documents)))
 
+        # Use the precomputed document embeddings when every candidate has them, encoded from the same text:
+        # only the query is encoded
+        if self.document_index is not None and doc_ids and all(
+                self.document_index.has_document(doc_id, text) for doc_id, text in zip(doc_ids, documents)):
+            with self._lock:
+                scores = self.document_index.score(self.ranker, query, doc_ids)
+            return self._ranked_results(query, documents, doc_ids, metadata, scores.tolist())
+
         # Rank the documents based on the query
-        results = self.ranker.rank(query, documents, doc_ids=doc_ids, metadata=metadata)
+        with self._lock:
+            results = self.ranker.rank(query, documents, doc_ids=doc_ids, metadata=metadata)
         return results
 
+    def rerank_many(self, queries: List[str], documents: List[List[str]], doc_ids: List[List],
+                    metadata: Optional[List[Optional[List[dict]]]] = None, batch_size: int = 64) -> List[RankedResults]:
+        """
+        Reranks the candidates of many queries at once.
+
+        Scores found in the score cache are reused. For ColBERT models every distinct uncached
+        document is encoded once, across all queries, in batches of batch_size; other models rank
+        the uncached documents one query at a time. New scores are written back to the cache.
+
+        Parameters:
+            queries (List[str]): The query strings.
+            documents (List[List[str]]): The candidate documents of every query.
+            doc_ids (List[List]): Stable ids (e.g. uniqueId) of the candidates of every query.
+            metadata (Optional[List[Optional[List[dict]]]]): Metadata of the candidates of every query (optional).
+            batch_size (int): Number of documents encoded per forward pass (default is 64).
+
+        Returns:
+            List[RankedResults]: The ranked results of every query, in the order of queries.
+        """
+        query_keys = [query_hash(query) for query in queries]
+        scores = [{} for _ in queries]  # per query: str(doc_id) -> score
+        if self.score_cache is not None:
+            scores = [self.score_cache.get_many(self.cache_key, query_key, ids, docs) for query_key, ids, docs in
+                      zip(query_keys, doc_ids, documents)]
+        missing = [[position for position, doc_id in enumerate(ids) if str(doc_id) not in query_scores]
+                   for ids, query_scores in zip(doc_ids, scores)]
+
+        if any(missing):
+            with self._lock:
+                computed = self._score_missing(queries, documents, doc_ids, missing, batch_size)
+            new_scores = []
+            for query_id, (positions, values) in enumerate(zip(missing, computed)):
+                for position, score in zip(positions, values):
+                    doc_id = doc_ids[query_id][position]
+                    scores[query_id][str(doc_id)] = score
+                    new_scores.append((query_keys[query_id], doc_id, documents[query_id][position], score))
+            if self.score_cache is not None:
+                self.score_cache.put_many(self.cache_key, new_scores)
+
+        return [self._ranked_results(query, docs, ids, metadata[query_id] if metadata else None,
+                                     [scores[query_id][str(doc_id)] for doc_id in ids])
+                for query_id, (query, docs, ids) in enumerate(zip(queries, documents, doc_ids))]
+
+    def _score_missing(self, queries, documents, doc_ids, missing, batch_size) -> List[List[float]]:
+        if not hasattr(self.ranker, '_document_encode'):
+            # Other models rank one query at a time; only the uncached documents are sent
+            computed = []
+            for query, docs, positions in zip(queries, documents, missing):
+                if not positions:
+                    computed.append([])
+                    continue
+                ranked = self.ranker.rank(query, [docs[position] for position in positions], doc_ids=positions)
+                by_position = {result.document.doc_id: result.score for result in ranked.results}
+                computed.append([by_position[position] for position in positions])
+            return computed
+
+        # ColBERT: encode every distinct uncached document once, across all queries, in large batches;
+        # stored embeddings are only used if they were encoded from the candidate's current text
+        texts = {}
+        for docs, ids, positions in zip(documents, doc_ids, missing):
+            for position in positions:
+                doc_id = ids[position]
+                if doc_id not in texts and (self.document_index is None or
+                                            not self.document_index.has_document(doc_id, docs[position])):
+                    texts[doc_id] = docs[position]
+        encoded = dict(zip(texts, encode_documents(self.ranker, list(texts.values()), batch_size=batch_size)))
+
+        computed = []
+        for query, ids, positions in zip(queries, doc_ids, missing):
+            if not positions:
+                computed.append([])
+                continue
+            query_embeddings, query_length = encode_query(self.ranker, query)
+            document_embeddings = [encoded[ids[position]] if ids[position] in encoded
+                                   else self.document_index.document_embeddings(ids[position])
+                                   for position in positions]
+            computed.append(maxsim(query_embeddings, query_length, document_embeddings).tolist())
+        return computed
+
+    @staticmethod
+    def _ranked_results(query, documents, doc_ids, metadata, scores) -> RankedResults:
+        documents = [Document(text=text, doc_id=doc_id, metadata=metadata[i] if metadata else None)
+                     for i, (text, doc_id) in enumerate(zip(documents, doc_ids))]
+        ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
+        return RankedResults(results=[Result(document=document, score=score, rank=rank + 1)
+                                      for rank, (document, score) in enumerate(ranked)],
+                             query=query, has_scores=True)
+
+    @property
+    def cache_key(self) -> str:
+        """Key of this model in the score cache."""
+        return f"{self.model_name}|{self.model_type}"
+
+    def use_score_cache(self, score_cache):
+        """
+        Attaches a persistent score cache (rerank_cache.RerankScoreCache) used by rerank_many, and by
+        rerank when doc_ids are given.
+
+        Parameters:
+            score_cache (RerankScoreCache): The cache.
+        """
+        self.score_cache = score_cache
+
+    def use_document_index(self, document_index):
+        """
+        Attaches precomputed ColBERT document embeddings (colbert_index.ColBERTDocumentIndex).
+        rerank then encodes only the query whenever all candidates are in the index with the text they
+        were encoded from.
+
+        Parameters:
+            document_index (ColBERTDocumentIndex): The index, built with this model.
+        """
+        self.document_index = document_index
+
+    def warm_up(self):
+        """
+        Runs a dummy query so that lazy initialization (weights, tokenizer, kernels) happens up front.
+        """
+        self.rerank("warm up", ["warm up"])
+
+
+class RerankerRegistry:
+    def __init__(self):
+        """
+        Process-wide cache of Reranking instances, so each model is loaded once per process.
+        """
+        self._rerankers: Dict[Tuple[str, Optional[str], Optional[str]], Reranking] = {}
+        self._key_locks: Dict[Tuple[str, Optional[str], Optional[str]], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name, model_type: Optional[str] = None, api_key: Optional[str] = None,
+            warm_up: bool = True) -> Reranking:
+        """
+        Returns the shared Reranking instance for the model, loading and warming it up on first use.
+
+        Parameters:
+            model_name (str): Model name, as for Reranking.
+            model_type (Optional[str]): Model type, as for Reranking.
+            api_key (Optional[str]): API key, as for Reranking.
+            warm_up (bool): Whether to run a dummy query after loading (default is True).
+
+        Returns:
+            Reranking: The shared instance.
+        """
+        key = (model_name, model_type, api_key)
+        reranker = self._rerankers.get(key)
+        if reranker is not None:
+            return reranker
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Load outside the registry lock so that different models can load concurrently
+        with key_lock:
+            reranker = self._rerankers.get(key)
+            if reranker is None:
+                reranker = Reranking(model_name, model_type=model_type, api_key=api_key)
+                if warm_up:
+                    reranker.warm_up()
+                with self._lock:
+                    self._rerankers[key] = reranker
+        return reranker
+
+    def unload(self, model_name, model_type: Optional[str] = None, api_key: Optional[str] = None) -> bool:
+        """
+        Drops the shared instance of a model so its memory can be reclaimed.
+
+        Parameters:
+            model_name (str): Model name, as passed to get.
+            model_type (Optional[str]): Model type, as passed to get.
+            api_key (Optional[str]): API key, as passed to get.
+
+        Returns:
+            bool: True if the model was loaded.
+        """
+        with self._lock:
+            reranker = self._rerankers.pop((model_name, model_type, api_key), None)
+        if reranker is None:
+            return False
+        del reranker
+        self._release_memory()
+        return True
+
+    def unload_all(self):
+        """
+        Drops every shared instance.
+        """
+        with self._lock:
+            self._rerankers.clear()
+        self._release_memory()
+
+    def loaded(self) -> List[Tuple[str, Optional[str]]]:
+        """
+        Returns the (model_name, model_type) of every loaded model.
+        """
+        with self._lock:
+            return [(model_name, model_type) for model_name, model_type, _ in self._rerankers]
+
+    @staticmethod
+    def _release_memory():
+        gc.collect()
+        try:
+            import torch
+        except ImportError:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+# The registry shared by the whole process
+registry = RerankerRegistry()
+
+
+def get_reranker(model_name, model_type: Optional[str] = None, api_key: Optional[str] = None) -> Reranking:
+    """
+    Returns the process-wide Reranking instance for the model (see RerankerRegistry.get).
+    """
+    return registry.get(model_name, model_type=model_type, api_key=api_key)
+
 
 # Example Usage
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import logging
+from typing import Callable, List, Optional
+
+import tracing
+from reciprocal_rank_fusion import ReciprocalRankFusion
+
+logger = logging.getLogger(__name__)
+
+# 检索参数；也是检索结果缓存键的一部分，修改任何一项都不会用到旧的缓存结果
+RETRIEVAL_PARAMS = {
+    "collection": 'refactoring_miner_em_wc_context_collection',
+    "n_results": 10,      # 向量检索的候选数
+    "bm25_top_n": 10,     # BM25 的候选数
+    "rrf_k": 60,
+    "rerank_top_n": 10,   # RRF 之后送去 rerank 的候选数
+    "top_k": 3,           # 作为例子放进 prompt 的数量
+    "reranker": "colbert",
+}
+
+
+class HybridRetriever:
+    def __init__(self, records, bm25_model,
+                 search_embeddings: Callable[[List[str], int], List[List[str]]],
+                 rerank: Callable[[List[str], List[List[str]], List[List[str]], int], List[List[str]]],
+                 params: Optional[dict] = None):
+        """
+        Hybrid retrieval of historical refactorings: vector search and BM25, fused with RRF and reranked.
+        Only uniqueIds pass between the stages; texts are read from the records when reranking.
+
+        The vector search and the reranker are passed in, so the same path runs against Chroma and
+        ColBERT in process_commits and against local stand-ins in the benchmark.
+
+        Parameters:
+            records (RefactoringStore): The uniqueId-keyed records; document_text gives the reranked texts.
+            bm25_model (BM25 or ShardedBM25): A BM25 model with uniqueIds.
+            search_embeddings (Callable): Maps query texts and a result count to the uniqueIds of the
+                nearest documents of every query.
+            rerank (Callable): Maps query texts, the candidate texts and candidate uniqueIds of every query
+                and a count k to the k best candidate uniqueIds of every query, best first.
+            params (Optional[dict]): Retrieval parameters (default is RETRIEVAL_PARAMS).
+        """
+        self.records = records
+        self.bm25_model = bm25_model
+        self.params = RETRIEVAL_PARAMS if params is None else params
+        self._search_embeddings = search_embeddings
+        self._rerank = rerank
+
+    def search_vectors(self, search_texts: List[str]) -> List[List[str]]:
+        """Returns the uniqueIds found by the vector search for every query."""
+        return self._search_embeddings(search_texts, self.params["n_results"])
+
+    def search_bm25(self, search_texts: List[str]) -> List[List[str]]:
+        """Returns the uniqueIds found by BM25 for every query, searched in one batch."""
+        with tracing.span("bm25", queries=len(search_texts)):
+            results = self.bm25_model.search_many(search_texts, top_n=self.params["bm25_top_n"])
+            ids = self.bm25_model.ids
+            bm25_ids = [[ids[doc_id] for doc_id in doc_ids] for doc_ids, _ in results]
+        tracing.count('candidates_total', sum(len(query_ids) for query_ids in bm25_ids), stage='bm25')
+        return bm25_ids
+
+    def fuse(self, embedding_ids: List[str], bm25_ids: List[str]) -> List[str]:
+        """Fuses the two result lists of one query with reciprocal rank fusion; returns the candidates to rerank."""
+        rrf = ReciprocalRankFusion(k=self.params["rrf_k"])
+        with tracing.span("fusion"):
+            scores = rrf.fuse([embedding_ids, bm25_ids])
+            top_docs = rrf.get_top_n(scores, n=self.params["rerank_top_n"])
+        tracing.count('candidates_total', len(top_docs), stage='fusion')
+        logger.debug("RRF Scores: %s", scores)
+        logger.debug("Top %d Documents: %s", self.params["rerank_top_n"], top_docs)
+        return [doc[0] for doc in top_docs]
+
+    def rerank_many(self, search_texts: List[str], candidates: List[List[str]]) -> List[List[str]]:
+        """Reranks the candidates of every query in one batch; returns the top_k uniqueIds of every query."""
+        with tracing.span("rerank", queries=len(search_texts), candidates=sum(len(ids) for ids in candidates)):
+            candidate_texts = [[self.records.document_text(unique_id) for unique_id in candidate_ids]
+                               for candidate_ids in candidates]
+            ranked = self._rerank(search_texts, candidate_texts, candidates, self.params["top_k"])
+        tracing.count('candidates_total', sum(len(top_ids) for top_ids in ranked), stage='rerank')
+        return ranked
+
+    def rank_many(self, search_texts: List[str], bm25_ids: Optional[List[List[str]]] = None,
+                  embedding_ids: Optional[List[List[str]]] = None) -> List[List[str]]:
+        """
+        Retrieves the top_k uniqueIds of every query. Every stage runs once for the whole batch, so
+        candidates shared by several queries are only encoded once by the reranker.
+
+        Parameters:
+            search_texts (List[str]): The query texts.
+            bm25_ids (Optional[List[List[str]]]): BM25 results computed beforehand (default is to search).
+            embedding_ids (Optional[List[List[str]]]): Vector search results computed beforehand (default is to search).
+
+        Returns:
+            List[List[str]]: The top_k uniqueIds of every query, best first.
+        """
+        if not search_texts:
+            return []
+        if bm25_ids is None:
+            bm25_ids = self.search_bm25(search_texts)
+        if embedding_ids is None:
+            embedding_ids = self.search_vectors(search_texts)
+        candidates = [self.fuse(query_embedding_ids, query_bm25_ids)
+                      for query_embedding_ids, query_bm25_ids in zip(embedding_ids, bm25_ids)]
+        return self.rerank_many(search_texts, candidates)
+
+    def rank(self, search_text: str) -> List[str]:
+        """Retrieves the top_k uniqueIds of one query (see rank_many)."""
+        return self.rank_many([search_text])[0]
+
+
+def reranker_function(reranker) -> Callable[[List[str], List[List[str]], List[List[str]], int], List[List[str]]]:
+    """
+    Adapts a reranking.Reranking (or anything with the same rerank_many) to the rerank argument of
+    HybridRetriever.
+    """
+    def rerank(search_texts, candidate_texts, candidates, top_k):
+        ranked_results = reranker.rerank_many(search_texts, candidate_texts, candidates)
+        top_ids = []
+        for ranked in ranked_results:
+            top_ranked = ranked.top_k(top_k)
+            for result in top_ranked:
+                logger.debug("Rank: %s, Score: %s, Document: %s", result.rank, result.score, result.document.doc_id)
+            top_ids.append([result.document.doc_id for result in top_ranked])
+        return top_ids
+    return rerank
+
+
+# 按 uniqueId 读取记录，生成放进 prompt 的例子文本
+def format_historical_refactorings(unique_ids, refactoring_records):
+    metadata_refactoring = [refactoring_records[unique_id] for unique_id in unique_ids]
+    search_result = "\n".join([
+        f"Example {i + 1}:\n SourceCodeBeforeRefactoring:\n {example['sourceCodeBeforeRefactoring']}\n SourceCodeAfterRefactoring:\n{example['sourceCodeAfterRefactoring']}\n DiffSourceCode:\n{example['diffSourceCode']}\n"
+        for i, example in enumerate(metadata_refactoring)
+    ])
+    return search_result
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional
+
+import tracing
+from java_comments import strip_comments
+
+
+def normalize_query(code: str) -> str:
+    """Returns the form of a query snippet used as cache key: comments removed and whitespace collapsed."""
+    return ' '.join(strip_comments(code).split())
+
+
+def index_version(paths: Iterable[str] = (), *extra: str) -> str:
+    """
+    Returns a fingerprint of the retrieval indexes: the size and modification time of every index
+    file (missing files included), plus any extra version strings such as VectorStore.version().
+    Rebuilding or extending an index changes it.
+    """
+    parts = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+        else:
+            parts.append(f"{path}:missing")
+    parts.extend(extra)
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class RetrievalCache:
+    def __init__(self, filepath: str, version: str, memory_entries: int = 1024, max_entries: int = 100000):
+        """
+        Cache of retrieval results keyed by (normalized query, index version, retrieval parameters),
+        with an in-memory LRU in front of a SQLite file.
+
+        Queries that differ only in comments or whitespace share an entry. Entries of other index
+        versions are deleted when the cache is opened, so results never outlive a rebuilt index. The
+        number of entries on disk is counted once when the cache is opened and kept up to date by put.
+
+        Parameters:
+            filepath (str): Path of the SQLite database; created if it does not exist.
+            version (str): Version of the indexes the results come from (see index_version).
+            memory_entries (int): Number of results kept in memory (default is 1024).
+            max_entries (int): Maximum number of results on disk; the least recently used are
+                evicted beyond it (default is 100000).
+        """
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.version = version
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, version TEXT NOT NULL, "
+            "result TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.invalidated = self._connection.execute("DELETE FROM results WHERE version != ?", (version,)).rowcount
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def key(self, query: str, params: dict) -> str:
+        """Returns the cache key of a query under the given retrieval parameters."""
+        request = json.dumps({"query": normalize_query(query), "version": self.version, "params": params},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, query: str, params: dict, record_stats: bool = True) -> Optional[List]:
+        """
+        Returns the cached result of a query, or None.
+
+        Parameters:
+            query (str): The query code.
+            params (dict): The retrieval parameters.
+            record_stats (bool): Count the lookup as a hit or miss (default is True); turn it off to
+                check ahead which queries need searching, e.g. before a batch search.
+        """
+        key = self.key(query, params)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                if record_stats:
+                    self.memory_hits += 1
+                    tracing.count('cache_hits_total', cache='retrieval', tier='memory')
+                return self._memory[key]
+            row = self._connection.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                if record_stats:
+                    self.misses += 1
+                    tracing.count('cache_misses_total', cache='retrieval')
+                return None
+            self._connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            result = json.loads(row[0])
+            self._remember(key, result)
+            if record_stats:
+                self.disk_hits += 1
+                tracing.count('cache_hits_total', cache='retrieval', tier='disk')
+        return result
+
+    def put(self, query: str, params: dict, result: List):
+        """
+        Stores the result of a query (any JSON-serializable value, e.g. the ranked uniqueIds).
+        """
+        key = self.key(query, params)
+        with self._lock:
+            self._remember(key, result)
+            exists = self._connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+            self._connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                     (key, self.version, json.dumps(result, ensure_ascii=False), time.time()))
+            if not exists:
+                self._size += 1
+            excess = self._size - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (excess,))
+                self._size = self.max_entries
+            self._connection.commit()
+
+    def cached(self, query: str, params: dict, compute: Callable[[], List]) -> List:
+        """
+        Returns the cached result of a query, or runs compute to get it and stores the result.
+        """
+        result = self.get(query, params)
+        if result is None:
+            result = compute()
+            self.put(query, params, result)
+        return result
+
+    def stats(self) -> dict:
+        """Returns the hits and misses of this process and the number of results stored on disk."""
+        with self._lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "entries": self._size, "invalidated": self.invalidated}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
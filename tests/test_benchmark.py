@@ -0,0 +1,9 @@
+import benchmark
+
+
+def test_benchmark_runs_offline(tmp_path):
+    directory = str(tmp_path / 'indexes')
+    benchmark.prepare_indexes(200, directory, dimensions=32)
+    result = benchmark.run_size(200, directory, queries=5, dimensions=32)
+    assert set(result["stages"]) == set(benchmark.STAGES)
+    assert result["queries_per_second"] > 0
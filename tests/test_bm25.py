@@ -0,0 +1,92 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from bm25 import BM25
+
+
+def test_search_term_only_in_tail_postings():
+    model = BM25(['a b c'] * 20)
+    doc_id = model.add_document('zzz q')
+
+    # 'zzz' was added after the last compaction, so it only has tail postings
+    assert model.search('zzz', top_n=2)[0] == 'zzz q'
+    assert model.search_ids('zzz', top_n=1)[0].tolist() == [doc_id]
+    assert model.search_many(['zzz', 'a'], top_n=1)[0][0].tolist() == [doc_id]
+
+
+class _Records(dict):
+    def document_text(self, unique_id):
+        return self[unique_id]
+
+
+def test_convert_model_without_ids_rebuilds_from_records(tmp_path):
+    pickle_path = tmp_path / 'model.pkl'
+    with open(pickle_path, 'wb') as file:
+        pickle.dump(BM25(['stale text', 'other text']), file)
+    with pytest.raises(ValueError, match='no uniqueIds'):
+        BM25.convert_model(str(pickle_path), str(tmp_path / 'model.idx'))
+
+    records = _Records({'id-1': 'windy london', 'id-2': 'sunny paris', 'id-3': 'rainy rome'})
+    BM25.convert_model(str(pickle_path), str(tmp_path / 'model.idx'), records=records)
+    loaded = BM25.load_model(str(tmp_path / 'model.idx'))
+    assert loaded.search_unique_ids('london', top_n=1) == ['id-1']
+
+
+def test_model_without_texts_resolves_ids_only(tmp_path):
+    path = str(tmp_path / 'model.idx')
+    BM25(['windy london', 'sunny paris', 'rainy london'], ids=['a', 'b', 'c'], keep_texts=False).save_model(path)
+    loaded = BM25.load_model(path)
+    assert loaded.corpus is None
+    assert loaded.search_unique_ids('paris', top_n=1) == ['b']
+    with pytest.raises(ValueError, match='no document texts'):
+        loaded.search('paris')
+
+    loaded.add_documents(['foggy paris'], ids=['d'])
+    loaded.remove_document(1, 'sunny paris')
+    assert loaded.search_unique_ids('paris', top_n=1) == ['d']
+    with pytest.raises(ValueError, match='no document texts'):
+        loaded.remove_document(0)
+
+
+def _random_corpus(generator, num_docs):
+    # 'half' occurs in exactly half of the documents (idf 0) and 'common' in all but one (negative idf,
+    # floored to epsilon * average idf)
+    corpus = []
+    for number in range(num_docs):
+        words = [f'w{generator.randint(30)}' for _ in range(generator.randint(2, 8))]
+        if number % 2:
+            words.append('half')
+        if number:
+            words.append('common')
+        generator.shuffle(words)
+        corpus.append(' '.join(words))
+    return corpus
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_bm25okapi(seed):
+    rank_bm25 = pytest.importorskip('rank_bm25')
+    generator = np.random.RandomState(seed)
+    corpus = _random_corpus(generator, 2 * generator.randint(4, 20))
+    okapi = rank_bm25.BM25Okapi([document.split(' ') for document in corpus])
+    model = BM25(corpus)
+    queries = [' '.join([f'w{generator.randint(30)}' for _ in range(generator.randint(1, 4))]
+                        + list(generator.choice(['half', 'common', 'absent'], generator.randint(0, 3))))
+               for _ in range(10)]
+
+    for query, (batch_ids, batch_scores) in zip(queries, model.search_many(queries, top_n=5)):
+        expected = okapi.get_scores(query.split(' '))
+        # Every document in BM25Okapi order, ties towards the higher document id
+        expected_order = sorted(range(len(corpus)), key=lambda doc_id: (-expected[doc_id], -doc_id))
+        positive = [doc_id for doc_id in expected_order if expected[doc_id] > 0]
+
+        doc_ids, scores = model.search_ids(query, top_n=len(corpus))
+        np.testing.assert_allclose(scores, expected[doc_ids], rtol=1e-12, atol=1e-12)
+        assert doc_ids[:len(positive)].tolist() == positive
+
+        doc_ids, scores = model.search_ids(query, top_n=5)
+        assert doc_ids.tolist() == expected_order[:5]
+        assert batch_ids.tolist() == expected_order[:5]
+        np.testing.assert_allclose(batch_scores, expected[batch_ids], rtol=1e-9, atol=1e-12)
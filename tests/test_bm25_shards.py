@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from bm25 import BM25
+from bm25_shards import ShardedBM25, load_bm25
+
+
+def _documents(generator, count, prefix):
+    # A small vocabulary, so documents share terms and many scores tie; 'half' occurs in the first half of
+    # the documents only, so its idf is 0 and some shards have no document containing it
+    documents = [' '.join([f'w{generator.randint(40)}' for _ in range(generator.randint(2, 12))]
+                          + ['half'] * (number < count // 2))
+                 for number in range(count)]
+    return documents, [f'{prefix}{number}' for number in range(count)]
+
+
+def assert_same_results(single, sharded, queries):
+    for query in queries:
+        expected_ids, expected_scores = single.search_ids(query, top_n=10)
+        doc_ids, scores = sharded.search_ids(query, top_n=10)
+        assert doc_ids.tolist() == expected_ids.tolist()
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-12)
+        assert sharded.search_unique_ids(query, top_n=10) == single.search_unique_ids(query, top_n=10)
+    for (expected_ids, expected_scores), (doc_ids, scores) in zip(single.search_many(queries, top_n=10),
+                                                                  sharded.search_many(queries, top_n=10)):
+        assert doc_ids.tolist() == expected_ids.tolist()
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-9)
+
+
+@pytest.fixture
+def corpus():
+    generator = np.random.RandomState(0)
+    documents, ids = _documents(generator, 150, 'id')
+    new_documents, new_ids = _documents(generator, 70, 'new')
+    queries = [' '.join(f'w{generator.randint(45)}' for _ in range(generator.randint(1, 5))) for _ in range(30)]
+    # Matches that score 0 rank among the documents that do not match at all
+    queries += ['half', 'half w41', 'w42 half w43']
+    return documents, ids, new_documents, new_ids, queries
+
+
+def test_sharded_model_matches_single_model(tmp_path, corpus):
+    documents, ids, new_documents, new_ids, queries = corpus
+    path = str(tmp_path / 'bm25.idx')
+    single = BM25(documents, ids=ids)
+    sharded = ShardedBM25.build(path, documents, num_shards=3, processes=2, ids=ids)
+    reloaded = None
+    try:
+        assert len(sharded.shards) == 3
+        assert_same_results(single, sharded, queries)
+
+        # New documents fill up the last shard and go to new ones; searched in this process until saved
+        assert single.add_documents(new_documents, ids=new_ids) == sharded.add_documents(new_documents, ids=new_ids)
+        assert len(sharded.shards) == 5
+        assert_same_results(single, sharded, queries)
+
+        sharded.save_model()
+        reloaded = load_bm25(path, processes=2)
+        assert isinstance(reloaded, ShardedBM25)
+        assert_same_results(single, reloaded, queries)
+        assert reloaded.corpus[len(documents) + 1] == new_documents[1]
+    finally:
+        sharded.close()
+        if reloaded is not None:
+            reloaded.close()
+
+
+def test_removed_documents_match_single_model(tmp_path, corpus):
+    documents, ids, _, _, queries = corpus
+    single = BM25(documents, ids=ids, keep_texts=False)
+    sharded = ShardedBM25.build(str(tmp_path / 'bm25.idx'), documents, num_shards=4, ids=ids, keep_texts=False)
+    for doc_id in (3, 60, 149):
+        single.remove_document(doc_id, documents[doc_id])
+        sharded.remove_document(doc_id, documents[doc_id])
+    assert sharded.corpus is None
+    assert_same_results(single, sharded, queries)
@@ -0,0 +1,94 @@
+import zlib
+
+import numpy as np
+
+from colbert_index import MAGIC, ColBERTDocumentIndex
+from mmap_store import pack_strings, write_sections
+
+
+class _Tensor:
+    """The few torch.Tensor methods colbert_index calls, over a numpy array."""
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, position):
+        return _Tensor(self.array[position])
+
+    def float(self):
+        return self
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+    def sum(self):
+        return self.array.sum()
+
+
+class StubColBERT:
+    """Encodes every word as a fixed pseudo-random vector and counts the documents it encodes."""
+    def __init__(self):
+        self.encoded = []
+
+    @staticmethod
+    def _encode(texts):
+        tokens = [text.split() for text in texts]
+        width = max(len(words) for words in tokens)
+        embeddings = np.zeros((len(texts), width, 4), dtype=np.float32)
+        mask = np.zeros((len(texts), width), dtype=np.int64)
+        for row, words in enumerate(tokens):
+            for column, word in enumerate(words):
+                embeddings[row, column] = np.random.RandomState(zlib.crc32(word.encode())).rand(4)
+                mask[row, column] = 1
+        return {"embeddings": embeddings, "attention_mask": _Tensor(mask)}
+
+    def _query_encode(self, queries):
+        return self._encode(queries)
+
+    def _document_encode(self, texts):
+        self.encoded.extend(texts)
+        return self._encode(texts)
+
+    def _to_embs(self, encoding):
+        return _Tensor(encoding["embeddings"])
+
+
+def test_changed_text_is_re_encoded(tmp_path):
+    ranker = StubColBERT()
+    path = str(tmp_path / 'colbert.idx')
+    index = ColBERTDocumentIndex("colbert")
+    assert index.add_documents(ranker, ['a', 'b', 'c'], ['red apple', 'green pear tree', 'blue sky']) == 3
+    index.save(path)
+
+    index = ColBERTDocumentIndex.open(path)
+    del ranker.encoded[:]
+    assert index.add_documents(ranker, ['a', 'b', 'c'], ['red apple', 'green pear tree', 'blue sky']) == 0
+    # 'b' was regenerated under the same id with fewer tokens; 'd' is new
+    assert index.add_documents(ranker, ['b', 'c', 'd'], ['pear', 'blue sky', 'grey cloud']) == 2
+    assert ranker.encoded == ['pear', 'grey cloud']
+    assert not index.has_document('b', 'green pear tree') and index.has_document('b', 'pear')
+    index.save(path)
+
+    index = ColBERTDocumentIndex.open(path)
+    expected = StubColBERT._encode(['pear'])["embeddings"][0].astype(np.float16)
+    np.testing.assert_array_equal(index.document_embeddings('b'), expected)
+    np.testing.assert_array_equal(index.document_embeddings('c'),
+                                  StubColBERT._encode(['blue sky'])["embeddings"][0].astype(np.float16))
+    assert [index.has_document(unique_id, text) for unique_id, text in
+            [('a', 'red apple'), ('b', 'pear'), ('d', 'grey cloud'), ('d', 'white cloud')]] == [True, True, True, False]
+
+
+def test_version_1_index_is_re_encoded(tmp_path):
+    path = str(tmp_path / 'colbert.idx')
+    embeddings = StubColBERT._encode(['red apple'])["embeddings"][0].astype(np.float16)
+    id_offsets, ids = pack_strings(['a'])
+    write_sections(path, MAGIC, 1, {'model_name': 'colbert'}, {
+        'offsets': np.array([0, 2], dtype=np.int64), 'embeddings': embeddings, 'id_offsets': id_offsets, 'ids': ids})
+
+    index = ColBERTDocumentIndex.open(path)
+    assert 'a' in index and not index.has_document('a', 'red apple')
+    ranker = StubColBERT()
+    assert index.add_documents(ranker, ['a'], ['red apple']) == 1
+    assert index.has_document('a', 'red apple')
@@ -0,0 +1,86 @@
+import itertools
+import threading
+import types
+
+import numpy as np
+
+import embedding_cache
+from embedding_cache import CachedEmbeddingFunction, EmbeddingCache
+
+
+class CountingEmbedding:
+    MODEL_NAME = "counting"
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [np.full(3, len(text), dtype=np.float32) for text in input]
+
+
+def test_round_trip_and_size(tmp_path):
+    path = str(tmp_path / 'embeddings.sqlite')
+    cache = EmbeddingCache(path)
+    cache.put_many('model', ['a', 'bb'], [np.ones(3), np.arange(3)])
+    vectors = cache.get_many('model', ['bb', 'missing', 'a'])
+    np.testing.assert_array_equal(vectors[0], np.arange(3, dtype=np.float32))
+    assert vectors[1] is None
+    np.testing.assert_array_equal(vectors[2], np.ones(3, dtype=np.float32))
+    assert cache.get_many('other model', ['a']) == [None]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Replacing a vector and repeating a text within a batch do not add entries
+    cache.put_many('model', ['a', 'ccc', 'ccc'], [np.zeros(3), np.ones(3), np.ones(3)])
+    assert len(cache) == 3
+    np.testing.assert_array_equal(cache.get_many('model', ['a'])[0], np.zeros(3, dtype=np.float32))
+    cache.close()
+    cache = EmbeddingCache(path)
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(embedding_cache, 'time', types.SimpleNamespace(time=lambda: next(clock)))
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'), max_entries=3)
+    cache.put_many('model', ['old', 'used'], [np.zeros(2), np.ones(2)])
+    cache.get_many('model', ['used'])
+    cache.put_many('model', ['new 1', 'new 2'], [np.zeros(2), np.ones(2)])
+    assert len(cache) == 3
+    assert [vector is not None for vector in cache.get_many('model', ['old', 'used', 'new 1', 'new 2'])] == [
+        False, True, True, True]
+    cache.close()
+
+
+def test_cached_function_embeds_each_missing_text_once(tmp_path):
+    embedding = CountingEmbedding()
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    function = CachedEmbeddingFunction(embedding, cache)
+    vectors = function(['a', 'bb', 'a'])
+    assert embedding.calls == [['a', 'bb']]
+    assert [vector[0] for vector in vectors] == [1, 2, 1]
+
+    vectors = function(['bb', 'ccc', 'ccc'])
+    assert embedding.calls == [['a', 'bb'], ['ccc']]
+    assert [vector[0] for vector in vectors] == [2, 3, 3]
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_counts_are_exact_across_threads(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    function = CachedEmbeddingFunction(CountingEmbedding(), cache)
+
+    def embed(worker):
+        for round_number in range(20):
+            function([f'text {worker} {round_number}', 'shared text'])
+
+    threads = [threading.Thread(target=embed, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.hits + cache.misses == 8 * 20 * 2
+    assert len(cache) == 8 * 20 + 1
+    cache.close()
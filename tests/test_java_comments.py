@@ -0,0 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import java_comments
+from java_comments import strip_comments, strip_many
+
+
+def test_strings_and_text_blocks_are_kept():
+    source = 'String s = "// not a comment"; // comment\nint x = 1; /* block */ char c = \'/\';'
+    assert strip_comments(source) == 'String s = "// not a comment"; \nint x = 1;  char c = \'/\';'
+
+
+def test_memo_eviction_is_safe_across_threads(monkeypatch):
+    monkeypatch.setattr(java_comments, '_MEMO_SIZE', 8)
+    monkeypatch.setattr(java_comments, '_memo', {})
+    sources = [f"int x{i} = {i}; // note {i}" for i in range(200)]
+
+    def strip(offset):
+        return [strip_comments(source) for source in sources[offset:] + sources[:offset]] + strip_many(sources)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for results in executor.map(strip, range(0, 200, 10)):
+            assert sorted(results[:200]) == sorted(f"int x{i} = {i}; " for i in range(200))
+    assert len(java_comments._memo) <= 8
@@ -0,0 +1,32 @@
+import os
+
+from llm_cache import LLMResponseCache
+
+MESSAGES = [{"role": "user", "content": "Extract a method"}]
+
+
+def test_database_is_created_on_first_use(tmp_path):
+    path = str(tmp_path / 'cache' / 'responses.sqlite')
+    cache = LLMResponseCache(path)
+    assert not os.path.exists(path)
+    assert cache.cached("model", 0, MESSAGES, lambda: "answer") == "answer"
+    assert os.path.exists(path)
+    cache.close()
+
+
+def test_only_deterministic_requests_are_cached_by_default(tmp_path):
+    answers = iter(["first", "second", "third"])
+    cache = LLMResponseCache(str(tmp_path / 'responses.sqlite'))
+    assert cache.cached("model", None, MESSAGES, lambda: next(answers)) == "first"
+    assert cache.cached("model", None, MESSAGES, lambda: next(answers)) == "second"
+    assert cache.cached("model", 0.0, MESSAGES, lambda: next(answers)) == "third"
+    assert cache.cached("model", 0, MESSAGES, lambda: next(answers)) == "third"
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_sampled_requests_are_cached_when_opted_in(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'responses.sqlite'), cache_sampled=True)
+    cache.cached("model", None, MESSAGES, lambda: "first")
+    assert cache.cached("model", None, MESSAGES, lambda: "second") == "first"
+    cache.close()
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("openai")
+
+from llm_client import AsyncLLMClient, RateLimiter  # noqa: E402
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    OpenAI-compatible chat completion server: the first request of every prompt is throttled with a
+    429, later ones echo the prompt after a delay that is shorter for later prompts.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = request['messages'][-1]['content']
+        with self.server.lock:
+            self.server.requests[prompt] = self.server.requests.get(prompt, 0) + 1
+            throttled = self.server.requests[prompt] == 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            if throttled:
+                self._reply(429, {"error": {"message": "slow down", "type": "rate_limit_error"}})
+                return
+            time.sleep(0.05 / (1 + int(prompt.split()[-1])))
+            self._reply(200, {
+                "id": "stub", "object": "chat.completion", "created": 0, "model": request['model'],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": f"echo {prompt}"}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            })
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttled_requests_are_retried_and_answers_keep_input_order(server):
+    async def run():
+        client = AsyncLLMClient(model="stub", max_concurrency=3, initial_backoff=0.01, max_backoff=0.02,
+                                base_url=server.base_url, api_key="test")
+        try:
+            return await client.complete_many([[{"role": "user", "content": f"prompt {i}"}] for i in range(8)])
+        finally:
+            await client.close()
+
+    answers = asyncio.run(run())
+    assert answers == [f"echo prompt {i}" for i in range(8)]
+    assert server.requests == {f"prompt {i}": 2 for i in range(8)}
+    assert server.max_in_flight <= 3
+
+
+def test_rate_limiter_spreads_requests_over_the_window():
+    async def run():
+        limiter = RateLimiter(requests_per_minute=2, period=0.2)
+        started = time.monotonic()
+        for _ in range(5):
+            await limiter.acquire()
+        return time.monotonic() - started
+
+    # Requests 3-4 wait for one window, request 5 for a second one
+    assert asyncio.run(run()) >= 0.4
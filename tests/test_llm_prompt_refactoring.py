@@ -0,0 +1,125 @@
+import importlib.util
+import json
+import os
+import types
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_openai")
+pytest.importorskip("openai")
+pytest.importorskip("rerankers")
+
+import benchmark  # noqa: E402
+import llm_client  # noqa: E402
+import rag_embedding  # noqa: E402
+from bm25 import BM25  # noqa: E402
+from llm_cache import LLMResponseCache  # noqa: E402
+from refactoring_entity import RefactoringStore  # noqa: E402
+from vector_store import LocalVectorStore  # noqa: E402
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'llm-prompt-refactoring.py')
+COLLECTION = 'refactoring_miner_em_wc_context_collection'
+
+
+class StubChatModel:
+    """Stand-in for the LangChain chat model used for code generation."""
+    model_name = "gpt-4o-mini"
+    temperature = 0.0
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.fail_on = None
+
+    def invoke(self, messages):
+        self.calls.append("generation")
+        if self.calls.count("generation") == self.fail_on:
+            raise RuntimeError("generation failed")
+        return types.SimpleNamespace(content="// refactored\n" + messages[0].content[-40:], usage_metadata=None)
+
+
+class StubOpenAI:
+    """Stand-in for the OpenAI client used for the meta prompt."""
+    def __init__(self, calls):
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+        self.calls = calls
+
+    def create(self, model, messages, temperature=None):
+        self.calls.append("meta_prompt")
+        message = types.SimpleNamespace(content="Rewritten: " + messages[-1]["content"][-40:])
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+class StubColBERT:
+    def use_document_index(self, document_index):
+        pass
+
+    def use_score_cache(self, score_cache):
+        pass
+
+
+@pytest.fixture
+def script(tmp_path, monkeypatch):
+    """Loads llm-prompt-refactoring.py in a workspace with small local indexes and stub models."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    for directory in ('data/model', 'data/refactoring_info', 'data/prompts', 'data/cache', 'data/output'):
+        os.makedirs(directory)
+    refactorings = list(benchmark.synthetic_refactorings(60))
+    ids = [refactoring['uniqueId'] for refactoring in refactorings]
+    documents = rag_embedding.build_document_texts(refactorings)
+    RefactoringStore.write('data/refactoring_info/refactoring_store_em_wc_v2.idx', refactorings)
+    BM25(documents, ids=ids, keep_texts=False).save_model(f'data/model/{COLLECTION}_bm25result.idx')
+    store = LocalVectorStore(f'data/model/{COLLECTION}_vectors.idx',
+                             embedding_function=benchmark.HashingEmbeddingFunction(32), keep_texts=False)
+    store.add(ids, documents)
+    store.save()
+    with open('data/prompts/refactoring_prompt_v2.txt', 'w') as prompt_file:
+        prompt_file.write('{task_description}\n{historical_refactorings}\n{code_to_refactor}\n{context_description}')
+    with open('data/prompts/meta_prompt.txt', 'w') as prompt_file:
+        prompt_file.write('Improve the prompt.')
+    monkeypatch.setattr(rag_embedding, 'VECTOR_STORE', 'local')
+    monkeypatch.setitem(rag_embedding._vector_stores, ('local', COLLECTION), store)
+
+    spec = importlib.util.spec_from_file_location('llm_prompt_refactoring', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.calls = []
+    module.llm = StubChatModel(module.calls)
+    module.client = StubOpenAI(module.calls)
+    module.llm_cache = LLMResponseCache(str(tmp_path / 'data/cache/llm_responses.sqlite'))
+    module.get_reranker = lambda name: StubColBERT()
+    module.reranker_function = lambda reranker: benchmark.StubReranker().rerank_ids
+
+    async def send(client, messages, temperature):
+        module.calls.append("async")
+        return "Async: " + messages[-1]["content"][-40:]
+    monkeypatch.setattr(llm_client.AsyncLLMClient, '_send', send)
+
+    module.commits = [{'commitId': refactoring['commitId'], 'branch': 'main', 'url': 'https://example.com',
+                       'refactorings': [refactoring]} for refactoring in refactorings[:12]]
+    yield module
+    module.llm_cache.close()
+
+
+@pytest.mark.parametrize("options", [{}, {"pipelined": True}, {"async_mode": True}])
+def test_second_run_makes_no_llm_calls(script, options):
+    script.process_commits(script.commits, 'data/output/first.json', 8, **options)
+    assert len(script.calls) == 16
+    del script.calls[:]
+    script.process_commits(script.commits, 'data/output/second.json', 8, **options)
+    assert script.calls == []
+    with open('data/output/first.json') as first, open('data/output/second.json') as second:
+        assert json.load(first) == json.load(second)
+
+
+def test_pipeline_failure_saves_completed_results(script):
+    script.llm.fail_on = 3
+    with pytest.raises(RuntimeError, match="generation failed"):
+        script.process_commits(script.commits, 'data/output/partial.json', 12, pipelined=True,
+                               stage_workers={"meta_prompt": 1, "generation": 1}, queue_size=1)
+    # Generation stops at the failed refactoring; the two before it are saved
+    assert script.calls.count("generation") == 3
+    with open('data/output/partial.json') as output_file:
+        saved = json.load(output_file)
+    assert [result["refactoredCode"] is not None for result in saved] == [True, True]
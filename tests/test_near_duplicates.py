@@ -0,0 +1,40 @@
+import random
+
+from near_duplicates import NearDuplicateDetector, optimal_bands
+
+
+def _pair(generator, size=200, changed=5):
+    # With one-token shingles the Jaccard similarity is exact: (size - changed) / (size + changed)
+    tokens = [f"t{generator.randrange(10 ** 9)}" for _ in range(size)]
+    edited = tokens[:size - changed] + [f"u{generator.randrange(10 ** 9)}" for _ in range(changed)]
+    return " ".join(tokens), " ".join(edited)
+
+
+def test_bands_favour_recall_at_the_threshold():
+    bands, rows = optimal_bands(0.9, 128)
+    assert 1.0 - (1.0 - 0.9 ** rows) ** bands >= 0.99
+    assert (1.0 / bands) ** (1.0 / rows) < 0.85
+
+
+def test_recall_of_pairs_above_the_threshold():
+    generator = random.Random(0)
+    found = 0
+    for pair in range(200):
+        detector = NearDuplicateDetector(threshold=0.9, shingle_size=1, seed=pair)
+        original, edited = _pair(generator)  # Jaccard 195 / 205 = 0.95
+        detector.add("original", original)
+        found += detector.add("edited", edited) == "original"
+    assert found >= 190
+
+
+def test_saved_signatures_catch_duplicates_of_stored_documents(tmp_path):
+    original, edited = _pair(random.Random(1))
+    path = str(tmp_path / 'minhash.idx')
+    first_run = NearDuplicateDetector(shingle_size=1)
+    first_run.add("original", original)
+    first_run.save_signatures(path)
+
+    second_run = NearDuplicateDetector(shingle_size=1)
+    assert second_run.load_signatures(path) == 1
+    assert second_run.add("original", original) is None
+    assert second_run.add("edited", edited) == "original"
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def test_stages_keep_input_order():
+    pipeline = Pipeline([Stage("double", lambda x: 2 * x, workers=3), Stage("add", lambda x: x + 1)])
+    assert pipeline.run(range(20)) == [2 * x + 1 for x in range(20)]
+
+
+def test_failing_input_is_raised_after_draining():
+    def items():
+        yield 1
+        yield 2
+        raise OSError("truncated input")
+
+    stage = Stage("square", lambda x: x * x, workers=2)
+    with pytest.raises(OSError, match="truncated input"):
+        Pipeline([stage]).run(items())
+    assert stage.items == 2
+
+
+def test_stage_needs_a_worker():
+    with pytest.raises(ValueError):
+        Stage("none", lambda x: x, workers=0)
+
+
+def test_failure_stops_later_work():
+    read = []
+    paid = []
+
+    def items():
+        for x in range(100):
+            read.append(x)
+            yield x
+
+    def check(x):
+        if x == 3:
+            raise RuntimeError("bad item")
+        return x
+
+    def call(x):
+        paid.append(x)
+        return -x
+
+    pipeline = Pipeline([Stage("read", lambda x: x), Stage("check", check), Stage("call", call, workers=2)],
+                        queue_size=2)
+    with pytest.raises(RuntimeError, match="bad item"):
+        pipeline.run(items())
+    # Nothing after the failed item reaches the paid stage, and the input stops being read
+    assert sorted(paid) == list(range(len(paid))) and len(paid) <= 3
+    assert len(read) < 20
+    assert pipeline.completed == [-x for x in range(len(paid))]
+
+
+def test_batch_stage_overlaps_later_stages():
+    batches = []
+    consumed = threading.Event()
+
+    def retrieve(batch):
+        if batches:
+            # The next stage is already working on the first micro-batch
+            assert consumed.wait(5)
+        batches.append(list(batch))
+        return [10 * x for x in batch]
+
+    def generate(x):
+        consumed.set()
+        return x + 1
+
+    pipeline = Pipeline([Stage("retrieval", retrieve, batch_size=4), Stage("generation", generate)], queue_size=4)
+    assert pipeline.run(range(10)) == [10 * x + 1 for x in range(10)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert pipeline.stages[0].items == 10
+
+
+def test_batch_stage_must_return_every_output():
+    with pytest.raises(ValueError, match="returned 1 outputs for 3 items"):
+        Pipeline([Stage("short", lambda batch: batch[:1], batch_size=3)]).run(range(3))
@@ -0,0 +1,14 @@
+import numpy as np
+
+from reciprocal_rank_fusion import ReciprocalRankFusion
+
+
+def test_fuse_arrays_with_no_results_requested():
+    rrf = ReciprocalRankFusion(k=60)
+    ranked = [np.array([1, 2, 3]), np.array([3, 2, 4])]
+
+    doc_ids, scores = rrf.fuse_arrays(ranked, n=0)
+    assert len(doc_ids) == 0 and len(scores) == 0
+
+    doc_ids, _ = rrf.fuse_arrays(ranked, n=2)
+    assert doc_ids.tolist() == [3, 2]
@@ -0,0 +1,26 @@
+import json
+
+from refactoring_reader import iter_commits, write_commits
+
+
+def test_rewrite_keeps_the_other_top_level_keys(tmp_path):
+    data = {"project": "gson", "commits": [{"sha1": "a", "refactorings": [{"uniqueId": "ü"}]}, {"sha1": "b"}],
+            "stats": {"commits": 2}}
+    path = str(tmp_path / 'commits.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+    with open(path, encoding='utf-8') as file:
+        expected = file.read()
+
+    fields = {}
+    write_commits(path, iter_commits(path, chunk_size=16, fields=fields), fields=fields)
+    with open(path, encoding='utf-8') as file:
+        assert file.read() == expected
+
+
+def test_layout_matches_json_dump(tmp_path):
+    path = str(tmp_path / 'commits.json')
+    for data in ({"commits": []}, {"commits": [{"sha1": "a"}]}, {"version": 2, "commits": []}):
+        write_commits(path, data["commits"], ensure_ascii=True, fields=dict(data))
+        with open(path, encoding='utf-8') as file:
+            assert file.read() == json.dumps(data, indent=4)
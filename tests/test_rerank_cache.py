@@ -0,0 +1,15 @@
+from rerank_cache import RerankScoreCache, query_hash
+
+
+def test_scores_are_not_reused_after_the_document_text_changed(tmp_path):
+    cache = RerankScoreCache(str(tmp_path / 'scores.sqlite'))
+    query_key = query_hash('int x = 1;')
+    cache.put_many('colbert', [(query_key, 'id-1', 'old text', 0.5), (query_key, 'id-2', 'same text', 0.25)])
+
+    found = cache.get_many('colbert', query_key, ['id-1', 'id-2'], ['new text', 'same text'])
+    assert found == {'id-2': 0.25}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.put_many('colbert', [(query_key, 'id-1', 'new text', 0.75)])
+    assert cache.get_many('colbert', query_key, ['id-1'], ['new text']) == {'id-1': 0.75}
+    cache.close()
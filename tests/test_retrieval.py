@@ -0,0 +1,51 @@
+from bm25 import BM25
+from retrieval import HybridRetriever, format_historical_refactorings
+
+
+class _Records(dict):
+    def document_text(self, unique_id):
+        return self[unique_id]['sourceCodeBeforeRefactoring']
+
+
+RECORDS = _Records({
+    unique_id: {"sourceCodeBeforeRefactoring": text, "sourceCodeAfterRefactoring": "", "diffSourceCode": ""}
+    for unique_id, text in [("a", "read file lines"), ("b", "write file bytes"), ("c", "parse json lines"),
+                            ("d", "draw window")]
+})
+
+
+def _retriever(reranked_batches):
+    bm25_model = BM25([record["sourceCodeBeforeRefactoring"] for record in RECORDS.values()], ids=list(RECORDS))
+
+    def search_embeddings(texts, n_results):
+        return [["d", "c"][:n_results] for _ in texts]
+
+    def rerank(texts, candidate_texts, candidates, top_k):
+        reranked_batches.append(len(texts))
+        # Prefers the candidates whose text shares the most words with the query
+        def overlap(text, unique_id):
+            return len(set(text.split()) & set(RECORDS.document_text(unique_id).split()))
+        return [sorted(ids, key=lambda unique_id: -overlap(text, unique_id))[:top_k]
+                for text, ids in zip(texts, candidates)]
+
+    return HybridRetriever(RECORDS, bm25_model, search_embeddings, rerank,
+                           params={"n_results": 2, "bm25_top_n": 2, "rrf_k": 60, "rerank_top_n": 3, "top_k": 2})
+
+
+def test_rank_many_fuses_both_searches_and_reranks_in_one_batch():
+    batches = []
+    retriever = _retriever(batches)
+    ranked = retriever.rank_many(["read lines", "write bytes"])
+    assert batches == [2]
+    assert ranked[0][0] == "a" and ranked[1][0] == "b"
+    assert all(len(top_ids) == 2 for top_ids in ranked)
+    assert retriever.rank("read lines") == ranked[0]
+
+
+def test_precomputed_results_skip_the_searches():
+    retriever = _retriever([])
+    assert sorted(retriever.rank_many(["anything"], bm25_ids=[["c"]], embedding_ids=[["d"]])[0]) == ["c", "d"]
+
+
+def test_examples_are_read_from_the_records():
+    assert format_historical_refactorings(["a"], RECORDS).startswith("Example 1:\n SourceCodeBeforeRefactoring:\n read")
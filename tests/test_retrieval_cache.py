@@ -0,0 +1,92 @@
+import itertools
+import types
+
+import retrieval_cache
+from retrieval_cache import RetrievalCache, index_version, normalize_query
+
+PARAMS = {"n_results": 10, "top_k": 3}
+
+
+def test_comment_and_whitespace_variants_share_an_entry(tmp_path):
+    cache = RetrievalCache(str(tmp_path / 'results.sqlite'), 'v1')
+    computed = []
+
+    def compute(result):
+        def run():
+            computed.append(result)
+            return result
+        return run
+
+    code = "int total = 0;\nfor (Item item : items) {\n    total += item.count();\n}"
+    variant = "// sum the items\nint total = 0;  for (Item item : items) { /* add */ total += item.count(); }"
+    assert normalize_query(code) == normalize_query(variant)
+    assert cache.cached(code, PARAMS, compute(['a', 'b'])) == ['a', 'b']
+    assert cache.cached(variant, PARAMS, compute(['c'])) == ['a', 'b']
+    assert cache.cached(code.replace('total', 'sum'), PARAMS, compute(['d'])) == ['d']
+    assert cache.cached(code, dict(PARAMS, top_k=5), compute(['e'])) == ['e']
+    assert computed == [['a', 'b'], ['d'], ['e']]
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    cache = RetrievalCache(path, 'v1', memory_entries=1)
+    cache.put('first()', PARAMS, ['a'])
+    cache.put('second()', PARAMS, ['b'])
+    assert cache.get('second()', PARAMS) == ['b']
+    # 'first()' fell out of the one-entry memory tier and is read from disk
+    assert cache.get('first()', PARAMS) == ['a']
+    assert cache.get('missing()', PARAMS) is None
+    assert cache.get('missing()', PARAMS, record_stats=False) is None
+    assert (cache.memory_hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+    cache.close()
+
+    cache = RetrievalCache(path, 'v1')
+    assert cache.get('second()', PARAMS) == ['b']
+    assert cache.get('second()', PARAMS) == ['b']
+    assert (cache.memory_hits, cache.disk_hits) == (1, 1)
+    assert cache.stats()["entries"] == 2
+    cache.close()
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(retrieval_cache, 'time', types.SimpleNamespace(time=lambda: next(clock)))
+    cache = RetrievalCache(str(tmp_path / 'results.sqlite'), 'v1', memory_entries=0, max_entries=2)
+    cache.put('a()', PARAMS, ['a'])
+    cache.put('b()', PARAMS, ['b'])
+    assert cache.get('a()', PARAMS) == ['a']
+    cache.put('b()', PARAMS, ['b2'])
+    cache.put('a()', PARAMS, ['a2'])
+    assert len(cache) == 2
+    cache.put('c()', PARAMS, ['c'])
+    assert len(cache) == 2
+    assert [cache.get(query, PARAMS) for query in ('a()', 'b()', 'c()')] == [['a2'], None, ['c']]
+    cache.close()
+
+
+def test_results_of_other_index_versions_are_dropped_at_open(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    cache = RetrievalCache(path, 'v1')
+    cache.put('a()', PARAMS, ['a'])
+    cache.put('b()', PARAMS, ['b'])
+    cache.close()
+
+    cache = RetrievalCache(path, 'v2')
+    assert cache.invalidated == 2 and len(cache) == 0
+    assert cache.get('a()', PARAMS) is None
+    cache.close()
+    cache = RetrievalCache(path, 'v1')
+    assert cache.invalidated == 0 and cache.get('a()', PARAMS) is None
+    cache.close()
+
+
+def test_index_version_follows_the_index_files(tmp_path):
+    path = tmp_path / 'bm25.idx'
+    missing = index_version([str(path)], 'store-1')
+    path.write_bytes(b'index')
+    built = index_version([str(path)], 'store-1')
+    assert len({missing, built, index_version([str(path)], 'store-2')}) == 3
+    path.write_bytes(b'larger index')
+    assert index_version([str(path)], 'store-1') != built
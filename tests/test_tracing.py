@@ -0,0 +1,112 @@
+import contextvars
+import json
+import threading
+import types
+
+import tracing
+from tracing import _NOOP_SPAN, Tracer
+
+
+def _fake_clock(monkeypatch, durations):
+    # perf_counter returns start and end of every span in turn, so each span lasts the next duration
+    readings = iter([value for duration in durations for value in (0.0, duration)])
+    monkeypatch.setattr(tracing, 'time', types.SimpleNamespace(time=lambda: 0.0, perf_counter=lambda: next(readings)))
+
+
+def test_spans_nest_within_a_thread_only():
+    tracer = Tracer()
+    seen = {}
+
+    def worker(name):
+        with tracer.span(name) as outer:
+            with tracer.span(name + '.inner') as inner:
+                seen[name] = (outer.parent, inner.parent is outer)
+
+    with tracer.span('run') as run:
+        with tracer.span('retrieval') as retrieval:
+            threads = [threading.Thread(target=worker, args=(f'worker{number}',)) for number in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # A thread started with the current context continues the trace
+            context = contextvars.copy_context()
+            thread = threading.Thread(target=context.run, args=(worker, 'copied'))
+            thread.start()
+            thread.join()
+        with tracer.span('generation') as generation:
+            pass
+
+    assert run.parent is None and retrieval.parent is run and generation.parent is run
+    # Spans of other threads never become children of this thread's open span, nor of each other
+    assert all(seen[f'worker{number}'] == (None, True) for number in range(4))
+    assert seen['copied'] == (retrieval, True)
+    assert tracer.summary()['worker0.inner']['count'] == 1
+
+
+def test_trace_file_records_parents(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    tracer = Tracer(trace_path=path)
+    with tracer.span('retrieval', unique_id='a'):
+        with tracer.span('bm25', queries=2) as bm25:
+            bm25.set(candidates=10)
+    tracer.close()
+    with open(path) as trace_file:
+        inner, outer = [json.loads(line) for line in trace_file]
+    assert (inner['name'], inner['parent_id'], inner['attributes']) == (
+        'bm25', outer['span_id'], {'queries': 2, 'candidates': 10})
+    assert (outer['name'], outer['parent_id'], outer['attributes']) == ('retrieval', None, {'unique_id': 'a'})
+
+
+def test_counter_labels_are_sorted_into_one_series():
+    tracer = Tracer()
+    tracer.count('cache_hits_total', cache='retrieval', tier='memory')
+    tracer.count('cache_hits_total', 2, tier='memory', cache='retrieval')
+    tracer.count('cache_hits_total', 0, cache='llm')
+    tracer.count('llm_tokens_total', 7)
+    assert tracer.counters() == {'cache_hits_total{cache="retrieval",tier="memory"}': 3, 'llm_tokens_total': 7}
+
+
+def test_prometheus_histogram_is_cumulative(monkeypatch):
+    _fake_clock(monkeypatch, [0.05, 0.5, 0.5, 3.0])
+    tracer = Tracer(buckets=(0.1, 1.0))
+    for _ in range(4):
+        with tracer.span('generation'):
+            pass
+    tracer.count('llm_requests_total', 4, model='gpt-4o-mini')
+    tracer.count('errors_total', error='say "hi"\n')
+    assert tracer.prometheus_text() == (
+        '# TYPE rag_errors_total counter\n'
+        'rag_errors_total{error="say \\"hi\\"\\n"} 1\n'
+        '# TYPE rag_llm_requests_total counter\n'
+        'rag_llm_requests_total{model="gpt-4o-mini"} 4\n'
+        '# TYPE rag_span_duration_seconds histogram\n'
+        'rag_span_duration_seconds_bucket{le="0.1",span="generation"} 1\n'
+        'rag_span_duration_seconds_bucket{le="1",span="generation"} 3\n'
+        'rag_span_duration_seconds_bucket{le="+Inf",span="generation"} 4\n'
+        'rag_span_duration_seconds_sum{span="generation"} 4.05\n'
+        'rag_span_duration_seconds_count{span="generation"} 4\n'
+    )
+
+
+def test_write_prometheus(tmp_path, monkeypatch):
+    _fake_clock(monkeypatch, [0.2])
+    tracer = Tracer()
+    with tracer.span('rerank'):
+        pass
+    path = tmp_path / 'metrics' / 'rag.prom'
+    tracer.write_prometheus(str(path), prefix='test_')
+    lines = path.read_text().splitlines()
+    assert 'test_span_duration_seconds_bucket{le="0.25",span="rerank"} 1' in lines
+    assert 'test_span_duration_seconds_bucket{le="0.1",span="rerank"} 0' in lines
+    assert 'test_span_duration_seconds_bucket{le="+Inf",span="rerank"} 1' in lines
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer(enabled=False)
+    span = tracer.span('retrieval', unique_id='a')
+    assert span is _NOOP_SPAN
+    with span as entered:
+        entered.set(candidates=3)
+    tracer.count('cache_hits_total', cache='llm')
+    assert tracer.counters() == {} and tracer.summary() == {} and not tracer.prometheus_text().strip()
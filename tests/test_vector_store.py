@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from vector_store import LocalVectorStore
+
+
+def _embed(texts):
+    return [[float(len(text)), float(text.count('a')), 1.0] for text in texts]
+
+
+def _add_batches(store, names):
+    for name in names:
+        store.add([name], [name], [{"name": name}])
+
+
+def test_batches_grow_the_buffers_and_query_like_one_add(tmp_path):
+    names = [f"doc{'a' * i}" for i in range(10)]
+    batched = LocalVectorStore(str(tmp_path / 'batched.idx'), embedding_function=_embed)
+    _add_batches(batched, names)
+    single = LocalVectorStore(str(tmp_path / 'single.idx'), embedding_function=_embed)
+    single.add(names, names, [{"name": name} for name in names])
+
+    assert batched.count() == 10
+    assert batched.embeddings.shape == (10, 3)
+    assert batched.query(["docaa"], 3) == single.query(["docaa"], 3)
+
+
+def test_journal_keeps_documents_added_since_the_last_save(tmp_path):
+    path = str(tmp_path / 'vectors.idx')
+    store = LocalVectorStore(path, embedding_function=_embed)
+    _add_batches(store, ["a", "b"])
+    store.save()
+    _add_batches(store, ["c", "d"])
+
+    # Interrupted before the next save: the last frame is cut off
+    with open(f"{path}.log", 'ab') as file:
+        file.write(b'\x10\x00')
+    reopened = LocalVectorStore(path, embedding_function=_embed)
+    assert list(reopened.ids) == ["a", "b", "c", "d"]
+    assert reopened.existing_ids(["c", "e"]) == {"c"}
+    np.testing.assert_array_equal(reopened.embeddings, store.embeddings)
+
+    reopened.add(["e"], ["e"])
+    reopened.save()
+    assert list(LocalVectorStore(path, embedding_function=_embed).ids) == ["a", "b", "c", "d", "e"]
+
+
+def test_store_without_texts_keeps_only_ids_and_vectors(tmp_path):
+    path = str(tmp_path / 'vectors.idx')
+    store = LocalVectorStore(path, embedding_function=_embed, keep_texts=False)
+    _add_batches(store, ["a", "bb"])
+    store.save()
+    _add_batches(store, ["ccc"])
+
+    reopened = LocalVectorStore(path, embedding_function=_embed)
+    assert reopened.documents is None
+    assert reopened.query(["xyz"], 1, include=["distances"])["ids"] == [["ccc"]]
+    with pytest.raises(ValueError):
+        reopened.query(["cc"], 1)
@@ -0,0 +1,226 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Upper bounds in seconds of the span duration histogram buckets, from an in-process lookup to an LLM call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The innermost open span of the current thread or asyncio task
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, tracer: 'Tracer', name: str, attributes: dict):
+        """One timed operation. Spans opened inside it, in the same thread or task, become its children."""
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_span_ids)
+        self.parent: Optional[Span] = None
+        self.start = 0.0
+        self.duration = 0.0
+        self._started = 0.0
+        self._token = None
+
+    def set(self, **attributes):
+        """Adds attributes to the span, e.g. the number of candidates it produced."""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.duration = time.perf_counter() - self._started
+        _current_span.reset(self._token)
+        if error_type is not None:
+            self.attributes['error'] = error_type.__name__
+        self.tracer._finish(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self, enabled: bool = True, trace_path: Optional[str] = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Lightweight spans and counters for the retrieval and generation stages.
+
+        Every finished span updates a duration histogram per span name and, when trace_path is set,
+        is appended to a JSONL trace file. Counters are keyed by name and labels. Both can be exported
+        in the Prometheus text format. A disabled tracer hands out a shared no-op span, so
+        instrumented code costs a function call.
+
+        Parameters:
+            enabled (bool): Record spans and counters (default is True).
+            trace_path (Optional[str]): JSONL file every finished span is appended to (default is none).
+            buckets (Tuple[float, ...]): Upper bounds of the duration histogram buckets in seconds.
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._durations: Dict[str, list] = {}  # name -> [count, sum, count per bucket]
+        self._trace_file = None
+        self.trace_path = None
+        if trace_path:
+            self.open_trace(trace_path)
+
+    def open_trace(self, trace_path: str):
+        """Starts appending finished spans to a JSONL file."""
+        directory = os.path.dirname(trace_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+            self._trace_file = open(trace_path, 'a', encoding='utf-8')
+            self.trace_path = trace_path
+
+    def span(self, name: str, **attributes):
+        """
+        Returns a context manager timing the enclosed block.
+
+        Parameters:
+            name (str): Name of the stage, e.g. 'bm25' or 'rerank'.
+            **attributes: Attributes written with the span to the trace file.
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Adds value to a counter, e.g. count('cache_hits_total', 3, cache='llm').
+        """
+        if not self.enabled or not value:
+            return
+        key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def _finish(self, span: Span):
+        with self._lock:
+            durations = self._durations.get(span.name)
+            if durations is None:
+                durations = self._durations[span.name] = [0, 0.0, [0] * len(self.buckets)]
+            durations[0] += 1
+            durations[1] += span.duration
+            for position, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    durations[2][position] += 1
+                    break
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+                self._trace_file.flush()
+
+    def counters(self) -> Dict[str, float]:
+        """Returns the counters as {'name{label="value"}': total}."""
+        with self._lock:
+            return {_series(name, labels): value for (name, labels), value in sorted(self._counters.items())}
+
+    def summary(self) -> Dict[str, dict]:
+        """Returns the number of spans, total and mean duration in seconds per span name."""
+        with self._lock:
+            return {name: {"count": count, "seconds": round(total, 4), "mean_seconds": round(total / count, 4)}
+                    for name, (count, total, _) in sorted(self._durations.items())}
+
+    def prometheus_text(self, prefix: str = 'rag_') -> str:
+        """Returns the counters and the span duration histograms in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            durations = sorted((name, (count, total, list(buckets)))
+                               for name, (count, total, buckets) in self._durations.items())
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# TYPE {prefix}{name} counter")
+                declared.add(name)
+            lines.append(f"{_series(prefix + name, labels)} {value:g}")
+        if durations:
+            metric = f"{prefix}span_duration_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, (count, total, buckets) in durations:
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    cumulative += bucket_count
+                    lines.append(f"{_series(metric + '_bucket', (('le', f'{bound:g}'), ('span', name)))} {cumulative}")
+                lines.append(f"{_series(metric + '_bucket', (('le', '+Inf'), ('span', name)))} {count}")
+                lines.append(f"{_series(metric + '_sum', (('span', name),))} {total:g}")
+                lines.append(f"{_series(metric + '_count', (('span', name),))} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str, prefix: str = 'rag_'):
+        """Writes prometheus_text to a file, e.g. for the node_exporter textfile collector."""
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus_text(prefix))
+        os.replace(tmp_path, file_path)
+
+    def reset(self):
+        """Clears the counters and the duration histograms."""
+        with self._lock:
+            self._counters.clear()
+            self._durations.clear()
+
+    def close(self):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+
+def _series(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return name
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return name + '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+# Process-wide tracer used by the instrumented modules; RAG_TRACING=0 disables it and
+# RAG_TRACE_FILE appends every span to a JSONL file
+tracer = Tracer(enabled=os.getenv('RAG_TRACING', '1') != '0', trace_path=os.getenv('RAG_TRACE_FILE'))
+
+
+def span(name: str, **attributes):
+    """Times a block with the process-wide tracer (see Tracer.span)."""
+    return tracer.span(name, **attributes)
+
+
+def count(name: str, value: float = 1, **labels):
+    """Adds to a counter of the process-wide tracer (see Tracer.count)."""
+    tracer.count(name, value, **labels)
@@ -2,6 +2,8 @@ import csv
 import json
 from collections import defaultdict
 
+from refactoring_reader import iter_refactorings, write_commits
+
 
 def load_json(file_path):
     with open(file_path, 'r') as f:
@@ -18,32 +20,27 @@ output_path_commits = ''
 
 
 
+# input_data['commits'] 也可以是 refactoring_reader.iter_commits 的流，结果逐个 commit 写出
 def extract_method_refactorings(input_data):
     commits = input_data['commits']
-    filtered_commits = [
+    filtered_commits = (
         commit for commit in commits
         if any(refactoring['type'] == "Extract Method" for refactoring in commit['refactorings'])
-    ]
+    )
 
-    save_json(output_path, {"commits": filtered_commits})
+    write_commits(output_path, filtered_commits, ensure_ascii=True)
 
 def extract_pure_refactoring_data(json_file, output_file):
-    # 读取 JSON 文件
-    with open(json_file, 'r') as file:
-        data = json.load(file)
-
     # 使用集合存储唯一的 (url, commitId) 对
     unique_entries = set()
 
-    # 遍历 JSON 数据，查找包含 pureRefactoring 为 true 的条目
-    for commit in data.get('commits', []):
-        # 检查每个 refactoring
-        for refactoring in commit.get('refactorings', []):
-            if refactoring.get('isPureRefactoring') is True:
-                url = commit.get('url')
-                commit_id = refactoring.get('commitId')
-                # 将 (url, commitId) 添加到集合中
-                unique_entries.add((url, commit_id))
+    # 逐个 commit 流式读取 JSON 文件，查找 pureRefactoring 为 true 的条目
+    for commit, refactoring in iter_refactorings(json_file, with_commit=True,
+                                                 predicate=lambda refactoring: refactoring.get('isPureRefactoring') is True):
+        url = commit.get('url')
+        commit_id = refactoring.get('commitId')
+        # 将 (url, commitId) 添加到集合中
+        unique_entries.add((url, commit_id))
 
     # 将结果写入文件
     # with open(output_file, mode='w', newline='') as file:
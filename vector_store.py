@@ -0,0 +1,402 @@
+import json
+import os
+import struct
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from mmap_store import MappedTexts, pack_strings, read_sections, write_sections
+
+MAGIC = b'VECSTORE'
+FORMAT_VERSION = 1
+
+# Journal frame header: lengths of the JSON part and of the float32 embeddings
+_FRAME = struct.Struct('<II')
+
+# What Chroma returns when include is not given
+DEFAULT_INCLUDE = ("metadatas", "documents", "distances")
+
+# Fields of a query result that hold one list per query text; others (e.g. Chroma's "included") do not
+QUERY_RESULT_FIELDS = ("ids", "distances", "documents", "metadatas", "embeddings", "uris", "data")
+
+
+class VectorStore(ABC):
+    """
+    Interface of the vector stores used for dense retrieval. Results use the shape of Chroma's
+    collection.query: a dict of lists with one entry per query text.
+    """
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """Returns the ids among the given ones that are already stored."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, ids: List[str], documents: List[str], metadatas: Optional[List[dict]] = None,
+            embeddings: Optional[np.ndarray] = None):
+        """Stores documents; they are embedded unless embeddings are given."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(self, query_texts: List[str], n_results: int, include: Optional[Iterable[str]] = None) -> dict:
+        """Returns the n_results nearest documents of every query text."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def export(self, batch_size: int = 1000) -> Iterator[Tuple[List[str], np.ndarray, List[str], List[dict]]]:
+        """
+        Yields (ids, embeddings, documents, metadatas) batches of every stored document; documents and
+        metadatas are None for a store that keeps no texts.
+        """
+        raise NotImplementedError
+
+    def save(self):
+        """Persists pending changes; stores that persist on add do nothing."""
+
+    def version(self) -> str:
+        """
+        Returns a fingerprint of the stored documents that changes when the store is rebuilt or
+        extended, for keying caches of search results.
+        """
+        return str(self.count())
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, collection_name: str, client=None, host: str = 'localhost', port: int = 8000,
+                 embedding_function=None):
+        """
+        Vector store backed by a Chroma collection.
+
+        Parameters:
+            collection_name (str): Name of the collection; created if it does not exist.
+            client: A chromadb client (default is an HttpClient connected to host:port).
+            host (str): Host of the Chroma server, used when no client is given.
+            port (int): Port of the Chroma server, used when no client is given.
+            embedding_function: Callable mapping a list of texts to a list of vectors. When given,
+                documents and queries are embedded with it on the client side (e.g. through an
+                embedding cache); it must produce the vectors of the collection's model.
+        """
+        if client is None:
+            import chromadb
+            client = chromadb.HttpClient(host=host, port=port)
+        self.collection = client.get_or_create_collection(name=collection_name)
+        self.embedding_function = embedding_function
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def version(self):
+        # A collection that is deleted and created again gets a new id
+        return f"chroma:{self.collection.name}:{self.collection.id}:{self.count()}"
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        if not ids:
+            return set()
+        return set(self.collection.get(ids=list(ids), include=[])['ids'])
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        if embeddings is None and self.embedding_function is not None:
+            embeddings = self.embedding_function(list(documents))
+        self.collection.add(ids=list(ids), documents=list(documents), metadatas=metadatas,
+                            embeddings=None if embeddings is None else np.asarray(embeddings).tolist())
+
+    def query(self, query_texts, n_results, include=None):
+        query_args = {} if include is None else {"include": list(include)}
+        if self.embedding_function is not None:
+            query_args["query_embeddings"] = np.asarray(self.embedding_function(list(query_texts))).tolist()
+        else:
+            query_args["query_texts"] = list(query_texts)
+        return self.collection.query(n_results=n_results, **query_args)
+
+    def export(self, batch_size=1000):
+        for offset in range(0, self.count(), batch_size):
+            batch = self.collection.get(offset=offset, limit=batch_size,
+                                        include=["embeddings", "documents", "metadatas"])
+            yield batch['ids'], np.asarray(batch['embeddings'], dtype=np.float32), batch['documents'], \
+                batch['metadatas']
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, filepath: str, embedding_function=None, ann: Optional[str] = None,
+                 ann_min_size: int = 20000, keep_texts: bool = True):
+        """
+        In-process vector store: the float32 embedding matrix lives in a memory-mapped file and queries
+        run in the calling process, with no server round trip or serialization.
+
+        Search is exact by default: squared L2 distances (Chroma's default space) from one matrix
+        product against all stored embeddings. For large corpora an HNSW index (hnswlib, optional)
+        can be used instead; it is built on first use and saved next to the store file.
+
+        Parameters:
+            filepath (str): Path of the store file; loaded if it exists.
+            embedding_function: Callable mapping a list of texts to a list of vectors (default is
+                Chroma's DefaultEmbeddingFunction, so vectors match those of a Chroma collection).
+            ann (Optional[str]): 'hnsw' to use an approximate index, or None for exact search only.
+            ann_min_size (int): Number of documents below which search stays exact even with ann set.
+            keep_texts (bool): Store the documents and metadatas as well as the ids and embeddings (default
+                is True). A store keyed by uniqueId can leave them out and resolve the ids elsewhere, e.g.
+                through the refactoring store; queries then cannot include them. An existing file keeps
+                the setting it was written with.
+        """
+        if ann not in (None, 'hnsw'):
+            raise ValueError(f"Unknown ann index {ann!r}; expected None or 'hnsw'")
+        self.filepath = filepath
+        self.ann = ann
+        self.ann_min_size = ann_min_size
+        self._embedding_function = embedding_function
+        self._hnsw = None
+        if os.path.exists(filepath):
+            _, header, arrays = read_sections(filepath, MAGIC, (FORMAT_VERSION,))
+            self._embeddings = arrays['embeddings'] if len(arrays['embeddings']) else None
+            self._norms = arrays['norms']
+            self.ids = MappedTexts(arrays['id_offsets'], arrays['ids'])
+            if header.get('texts', True):
+                self.documents = MappedTexts(arrays['document_offsets'], arrays['documents'])
+                self.metadatas = MappedTexts(arrays['metadata_offsets'], arrays['metadatas'])
+            else:
+                self.documents = self.metadatas = None
+        else:
+            self._embeddings = None
+            self._norms = np.zeros(0, dtype=np.float32)
+            self.ids = []
+            self.documents, self.metadatas = ([], []) if keep_texts else (None, None)
+        self._rows = {unique_id: row for row, unique_id in enumerate(self.ids)}
+        self._replay_journal()
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        # The buffers grow geometrically, only the first count() rows are stored documents
+        return None if self._embeddings is None else self._embeddings[:self.count()]
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._norms[:self.count()]
+
+    def _journal_path(self) -> str:
+        return f"{self.filepath}.log"
+
+    @property
+    def embedding_function(self):
+        if self._embedding_function is None:
+            from chromadb.utils import embedding_functions
+            self._embedding_function = embedding_functions.DefaultEmbeddingFunction()
+        return self._embedding_function
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.embedding_function(list(texts)), dtype=np.float32)
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def version(self):
+        if not os.path.exists(self.filepath):
+            return f"local:{self.count()}"
+        stat = os.stat(self.filepath)
+        return f"local:{stat.st_size}:{stat.st_mtime_ns}:{self.count()}"
+
+    def existing_ids(self, ids):
+        return {unique_id for unique_id in ids if unique_id in self._rows}
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        """
+        Stores documents and appends them to the store's journal, so they survive an interruption
+        before the next save; call save to write them into the store file.
+        """
+        rows = [(unique_id, document, metadata) for unique_id, document, metadata in
+                zip(ids, documents, metadatas if metadatas is not None else [None] * len(ids))]
+        duplicates = [unique_id for unique_id, _, _ in rows if unique_id in self._rows]
+        if duplicates:
+            raise ValueError(f"Ids already stored: {duplicates[:5]}")
+        if not rows:
+            return
+        embeddings = self._embed(documents) if embeddings is None else np.asarray(embeddings, dtype=np.float32)
+        if self.documents is not None:
+            documents, metadatas = list(documents), [json.dumps(metadata) for _, _, metadata in rows]
+        else:
+            documents = metadatas = None
+        self._append(list(ids), documents, metadatas, embeddings)
+        self._write_journal(list(ids), documents, metadatas, embeddings)
+
+    def _append(self, ids: List[str], documents: Optional[List[str]], metadatas: Optional[List[str]],
+                embeddings: np.ndarray):
+        count = self.count()
+        stop = count + len(ids)
+        if self._embeddings is None or stop > len(self._embeddings):
+            # Capacity doubles, so adding N documents in batches copies O(N) rows in total
+            capacity = max(stop, 2 * (0 if self._embeddings is None else len(self._embeddings)))
+            grown = np.empty((capacity, embeddings.shape[1]), dtype=np.float32)
+            grown_norms = np.empty(capacity, dtype=np.float32)
+            if count:
+                grown[:count] = self._embeddings[:count]
+                grown_norms[:count] = self._norms[:count]
+            self._embeddings, self._norms = grown, grown_norms
+        self._embeddings[count:stop] = embeddings
+        self._norms[count:stop] = np.einsum('ij,ij->i', embeddings, embeddings)
+        for texts in ('ids', 'documents', 'metadatas'):
+            if isinstance(getattr(self, texts), MappedTexts):  # texts mapped from a file
+                setattr(self, texts, list(getattr(self, texts)))
+        for unique_id in ids:
+            self._rows[unique_id] = len(self._rows)
+        self.ids.extend(ids)
+        if self.documents is not None:
+            self.documents.extend(documents)
+            self.metadatas.extend(metadatas)
+
+    def _write_journal(self, ids: List[str], documents: Optional[List[str]], metadatas: Optional[List[str]],
+                       embeddings: np.ndarray):
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        header = json.dumps({"ids": ids, "documents": documents, "metadatas": metadatas,
+                             "dim": embeddings.shape[1]}).encode('utf-8')
+        with open(self._journal_path(), 'ab') as file:
+            file.write(_FRAME.pack(len(header), embeddings.nbytes))
+            file.write(header)
+            file.write(np.ascontiguousarray(embeddings).tobytes())
+
+    def _replay_journal(self):
+        """Adds the documents journaled since the last save; a frame cut off by an interruption is dropped."""
+        if not os.path.exists(self._journal_path()):
+            return
+        with open(self._journal_path(), 'rb') as file:
+            journal = file.read()
+        position = 0
+        while position + _FRAME.size <= len(journal):
+            header_len, embeddings_len = _FRAME.unpack_from(journal, position)
+            stop = position + _FRAME.size + header_len + embeddings_len
+            if stop > len(journal):
+                break
+            frame = json.loads(journal[position + _FRAME.size:position + _FRAME.size + header_len])
+            embeddings = np.frombuffer(journal, dtype=np.float32, count=embeddings_len // 4,
+                                       offset=position + _FRAME.size + header_len).reshape(-1, frame['dim'])
+            # Frames written before an interrupted save may already be in the store file
+            keep = [row for row, unique_id in enumerate(frame['ids']) if unique_id not in self._rows]
+            if keep:
+                documents, metadatas = (None, None) if self.documents is None else (
+                    [frame['documents'][row] for row in keep], [frame['metadatas'][row] for row in keep])
+                self._append([frame['ids'][row] for row in keep], documents, metadatas, embeddings[keep])
+            position = stop
+        if position < len(journal):
+            with open(self._journal_path(), 'r+b') as file:
+                file.truncate(position)
+
+    def query(self, query_texts, n_results, include=None):
+        include = DEFAULT_INCLUDE if include is None else tuple(include)
+        if self.documents is None and ({"documents", "metadatas"} & set(include)):
+            raise ValueError("The store keeps no documents or metadatas; query with include=['distances']")
+        queries = self._embed(query_texts)
+        n_results = min(n_results, self.count())
+        if self.embeddings is None or n_results == 0:
+            rows = np.zeros((len(queries), 0), dtype=np.int64)
+            distances = np.zeros((len(queries), 0), dtype=np.float32)
+        elif self.ann == 'hnsw' and self.count() >= self.ann_min_size:
+            rows, distances = self._hnsw_index(n_results).knn_query(queries, k=n_results)
+        else:
+            rows, distances = self._exact_top_k(queries, n_results)
+
+        results = {"ids": [[self.ids[row] for row in query_rows] for query_rows in rows]}
+        if "distances" in include:
+            results["distances"] = [[float(distance) for distance in query_distances] for query_distances in distances]
+        if "documents" in include:
+            results["documents"] = [[self.documents[row] for row in query_rows] for query_rows in rows]
+        if "metadatas" in include:
+            results["metadatas"] = [[json.loads(self.metadatas[row]) for row in query_rows] for query_rows in rows]
+        if "embeddings" in include:
+            results["embeddings"] = [self.embeddings[query_rows] for query_rows in rows]
+        return results
+
+    def _exact_top_k(self, queries: np.ndarray, k: int, batch_size: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            # ||q - d||^2 = ||q||^2 + ||d||^2 - 2 q.d, with the document norms precomputed
+            batch_distances = self.norms[None, :] - 2 * (batch @ self.embeddings.T)
+            batch_distances += np.einsum('ij,ij->i', batch, batch)[:, None]
+            np.maximum(batch_distances, 0, out=batch_distances)
+            candidates = np.argpartition(batch_distances, k - 1, axis=1)[:, :k] if k < batch_distances.shape[1] \
+                else np.broadcast_to(np.arange(batch_distances.shape[1]), batch_distances.shape)
+            candidate_distances = np.take_along_axis(batch_distances, candidates, axis=1)
+            # Nearest first; equal distances keep the insertion order
+            order = np.lexsort((candidates, candidate_distances), axis=1)
+            rows[start:start + len(batch)] = np.take_along_axis(candidates, order, axis=1)
+            distances[start:start + len(batch)] = np.take_along_axis(candidate_distances, order, axis=1)
+        return rows, distances
+
+    def _hnsw_index(self, n_results: int):
+        import hnswlib
+        if self._hnsw is None:
+            self._hnsw = hnswlib.Index(space='l2', dim=self.embeddings.shape[1])
+            if os.path.exists(self._hnsw_path()):
+                self._hnsw.load_index(self._hnsw_path(), max_elements=self.count())
+            else:
+                self._hnsw.init_index(max_elements=self.count(), ef_construction=200, M=16)
+        indexed = self._hnsw.get_current_count()
+        if indexed < self.count():
+            # Only the documents added since the index was built are inserted
+            self._hnsw.resize_index(self.count())
+            self._hnsw.add_items(self.embeddings[indexed:], np.arange(indexed, self.count()))
+        self._hnsw.set_ef(max(64, n_results))
+        return self._hnsw
+
+    def _hnsw_path(self) -> str:
+        return f"{self.filepath}.hnsw"
+
+    def export(self, batch_size=1000):
+        for start in range(0, self.count(), batch_size):
+            stop = min(start + batch_size, self.count())
+            if self.documents is None:
+                yield self.ids[start:stop], np.asarray(self.embeddings[start:stop]), [None] * (stop - start), \
+                    [None] * (stop - start)
+            else:
+                yield self.ids[start:stop], np.asarray(self.embeddings[start:stop]), self.documents[start:stop], \
+                    [json.loads(metadata) for metadata in self.metadatas[start:stop]]
+
+    def save(self):
+        """Writes the store to its file, clearing the journal, and the HNSW index if one was built."""
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        id_offsets, id_blob = pack_strings(self.ids)
+        document_offsets, document_blob = pack_strings(self.documents if self.documents is not None else [])
+        metadata_offsets, metadata_blob = pack_strings(self.metadatas if self.metadatas is not None else [])
+        embeddings = self.embeddings if self.embeddings is not None else np.zeros((0, 0), dtype=np.float32)
+        write_sections(self.filepath, MAGIC, FORMAT_VERSION, {'texts': self.documents is not None}, {
+            'embeddings': embeddings,
+            'norms': self.norms,
+            'id_offsets': id_offsets,
+            'ids': id_blob,
+            'document_offsets': document_offsets,
+            'documents': document_blob,
+            'metadata_offsets': metadata_offsets,
+            'metadatas': metadata_blob,
+        })
+        if os.path.exists(self._journal_path()):
+            os.remove(self._journal_path())
+        if self._hnsw is not None:
+            self._hnsw.save_index(self._hnsw_path())
+
+
+def copy_collection(source: VectorStore, target: VectorStore, batch_size: int = 1000) -> int:
+    """
+    Copies every document of one store into another, reusing the stored embeddings, e.g. to move an
+    existing Chroma collection into a LocalVectorStore. Documents already in the target are skipped.
+
+    Returns:
+        int: Number of documents copied.
+    """
+    copied = 0
+    for ids, embeddings, documents, metadatas in source.export(batch_size=batch_size):
+        existing = target.existing_ids(ids)
+        keep = [position for position, unique_id in enumerate(ids) if unique_id not in existing]
+        if keep:
+            target.add([ids[position] for position in keep], [documents[position] for position in keep],
+                       [metadatas[position] for position in keep], embeddings=embeddings[keep])
+            copied += len(keep)
+    target.save()
+    return copied